@@ -7,7 +7,8 @@ Plots the target attribute (assumed to be the last column).
 import argparse
 
 import matplotlib.pyplot as plt
-import numpy as np
+
+from feature_store import load_features
 
 
 def plot(values):
@@ -24,7 +25,7 @@ def main():
 
     args = parser.parse_args()
 
-    data = np.loadtxt(args.filename, delimiter=",")
+    data = load_features(args.filename)
     target = data[:, -1]
 
     print "Min:   %f" % target.min()
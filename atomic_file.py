@@ -0,0 +1,37 @@
+"""
+Writes files so that readers never see a partly written file.
+"""
+
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def atomic_open(filename):
+    """
+    Yields a file handle to a temporary file in the directory of filename,
+    which replaces filename once the block completes.  If the block raises,
+    filename is left as it was.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(
+        dir=directory, prefix="." + os.path.basename(filename) + ".")
+
+    try:
+        # mkstemp creates the file readable by its owner only; give it the
+        # permissions open() would have
+        umask = os.umask(0)
+        os.umask(umask)
+        os.fchmod(fd, 0666 & ~umask)
+
+        with os.fdopen(fd, "wb") as filehandle:
+            yield filehandle
+
+            filehandle.flush()
+            os.fsync(filehandle.fileno())
+
+        os.rename(temp_filename, filename)
+    except:
+        os.remove(temp_filename)
+        raise
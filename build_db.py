@@ -6,55 +6,321 @@ Builds an SQLite database from the raw data provided.
 
 import argparse
 import csv
+import datetime
+import hashlib
+import math
+import multiprocessing
 import os
+import Queue
 import sqlite3
+import time
+import traceback
+
+from history_features import (DEFAULT_LAGS, DEFAULT_WINDOWS, WEEKS_PER_YEAR,
+                              feature_names)
 
 SALES_TRAINING_FILE = "train.csv"
 SALES_TESTING_FILE = "test.csv"
 STORES_FILE = "stores.csv"
 FEATURES_FILE = "features.csv"
 
+DEFAULT_BATCH_SIZE = 10000
+
+DIGEST_CHUNK_SIZE = 1 << 20
+
+# Limits how many parsed batches can wait for the writer in parallel mode.
+MAX_PENDING_BATCHES = 16
+
+# How often the writer checks for workers which died without reporting.
+WORKER_POLL_SECONDS = 1
+
+# Safe only because a failed build is simply rerun from scratch.
+BULK_LOAD_PRAGMAS = ("PRAGMA journal_mode = OFF",
+                     "PRAGMA synchronous = OFF")
+
 
 class TableBuilder(object):
-    def __init__(self, dbname, data_dir, filename):
+    table_name = None
+    insert_sql = None
+
+    # Unique index created once the data has been loaded.
+    key_columns = None
+
+    # An incremental refresh reads only the rows appended to the file since
+    # the last load.  If the file changed otherwise and this is True, only
+    # the rows dated on or after the latest date already loaded are read;
+    # if False, the file replaces the table.
+    append_only = False
+
+    def __init__(self, con, data_dir, filename,
+                 batch_size=DEFAULT_BATCH_SIZE):
         self._data_dir = data_dir
-        self.con = sqlite3.connect(dbname)
+        self.con = con
         self.filename = filename
+        self.batch_size = batch_size
 
         self.date_index = None
+        self.min_date = None
+        self.max_date = None
+
+        # Earliest date of the rows changed by the last refresh, or None if
+        # any row may have changed
+        self.changed_since = None
+
+    @property
+    def path(self):
+        return os.path.join(self._data_dir, self.filename)
+
+    @property
+    def upsert_sql(self):
+        return self.insert_sql.replace("INSERT", "INSERT OR REPLACE", 1)
+
+    def read_batches(self, since=None, offset=None):
+        """
+        Yields lists of at most batch_size records ready to be inserted.
+
+        Args:
+          since: str
+            If provided, records dated before this YYYY-MM-DD date are
+            skipped.
+          offset: int
+            If provided, the records before this byte offset, which must be
+            the start of a line, are skipped without being parsed.
+        """
+        self.min_date = None
+        self.max_date = None
+
+        with open(self.path, "rb") as filehandle:
+            header = next(csv.reader([filehandle.readline()]))
+            if offset is not None:
+                filehandle.seek(offset)
 
-    def insert_data(self):
-        with open(os.path.join(self._data_dir, self.filename),
-                  "rb") as filehandle:
             reader = csv.reader(filehandle)
 
-            header = filehandle.readline().split(",")
             try:
                 self.date_index = header.index("Date")
             except ValueError:
                 # Date is not a field in this input CSV file
                 self.date_index = None
 
-            # Note the header was skipped when parsing date index
+            batch = []
             for record in reader:
-                self.process_record(record)
+                if self.date_index is not None:
+                    # Dates are ISO formatted so they compare as strings
+                    date_str = record[self.date_index]
+                    if since is not None and date_str < since:
+                        continue
+
+                    if self.min_date is None or date_str < self.min_date:
+                        self.min_date = date_str
+                    self.max_date = max(self.max_date, date_str)
+
+                batch.append(self.process_record(record))
 
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+
+            if batch:
+                yield batch
+
+    def file_digests(self, offset=0):
+        """
+        Reads the file once.
+
+        Returns:
+          prefix_digest: str, the digest of the first offset bytes, or None
+            if the file is shorter
+          digest: str, the digest of the whole file
+          size: int
+        """
+        digest = hashlib.sha1()
+        prefix_digest = None
+        size = 0
+
+        with open(self.path, "rb") as filehandle:
+            for chunk in iter(lambda: filehandle.read(DIGEST_CHUNK_SIZE), ""):
+                if size <= offset < size + len(chunk):
+                    digest.update(chunk[:offset - size])
+                    prefix_digest = digest.hexdigest()
+                    digest.update(chunk[offset - size:])
+                else:
+                    digest.update(chunk)
+
+                size += len(chunk)
+
+        if offset == size:
+            prefix_digest = digest.hexdigest()
+
+        return prefix_digest, digest.hexdigest(), size
+
+    def ends_line(self, offset):
+        if offset == 0:
+            return False
+
+        with open(self.path, "rb") as filehandle:
+            filehandle.seek(offset - 1)
+            return filehandle.read(1) == "\n"
+
+    def insert_data(self):
+        start = time.time()
+        _, digest, size = self.file_digests()
+        num_rows = self._load(self.insert_sql)
+
+        self.create_indexes()
+        self.save_state(digest, self.max_date, size)
         self.con.commit()
 
+        self.report(num_rows, time.time() - start)
+
+    def refresh(self):
+        """
+        Brings the table up to date with its input file, loading only the
+        rows which may have changed since the last build.
+
+        Returns:
+          False if the file is unchanged, True otherwise.
+        """
+        self.changed_since = None
+
+        if not self.table_exists():
+            self.create_table()
+            self.insert_data()
+            return True
+
+        state = self.load_state()
+        if state is None:
+            self.replace_data()
+            return True
+
+        digest, watermark, num_bytes = state
+
+        prefix_digest, new_digest, size = self.file_digests(num_bytes)
+
+        if prefix_digest == digest:
+            if size == num_bytes:
+                print "%s: unchanged" % self.table_name
+                return False
+
+            if self.ends_line(num_bytes):
+                # The rows already loaded are unchanged, so only the
+                # appended ones need to be parsed
+                self.update_data(new_digest, size, watermark,
+                                 offset=num_bytes)
+                self.changed_since = self.min_date
+                return True
+
+        if self.append_only and watermark is not None:
+            # Rows dated before the last date loaded are taken as final
+            self.update_data(new_digest, size, watermark, since=watermark)
+            self.changed_since = watermark
+        else:
+            self.replace_data()
+
+        return True
+
+    def update_data(self, digest, size, watermark, since=None, offset=None):
+        start = time.time()
+        num_rows = self._load(self.upsert_sql, since=since, offset=offset)
+
+        self.save_state(digest, max(self.max_date, watermark), size)
+        self.con.commit()
+
+        self.report(num_rows, time.time() - start)
+
+    def replace_data(self):
+        """
+        Replaces every row of the table with those of the file, so rows
+        removed from the file are deleted.  changed_since is set to the
+        earliest date of the old and new rows.
+        """
+        start = time.time()
+        old_min_date = self.first_date()
+
+        _, digest, size = self.file_digests()
+        self.con.execute("DELETE FROM %s" % self.table_name)
+        num_rows = self._load(self.insert_sql)
+
+        self.save_state(digest, self.max_date, size)
+        self.con.commit()
+
+        dates = [date for date in (old_min_date, self.min_date)
+                 if date is not None]
+        self.changed_since = min(dates) if dates else None
+
+        self.report(num_rows, time.time() - start)
+
+    def first_date(self):
+        """
+        Returns:
+          str, the earliest YYYY-MM-DD date in the table, or None if it is
+            empty or has no dates.
+        """
+        if "year" not in self.key_columns:
+            return None
+
+        cur = self.con.execute(
+            "SELECT printf('%%04d-%%02d-%%02d', year, month, day) FROM %s "
+            "ORDER BY year, month, day LIMIT 1" % self.table_name)
+        row = cur.fetchone()
+
+        return row[0] if row is not None else None
+
+    def _load(self, sql, since=None, offset=None):
+        num_rows = 0
+        for batch in self.read_batches(since=since, offset=offset):
+            self.con.executemany(sql, batch)
+            num_rows += len(batch)
+
+        return num_rows
+
+    def table_exists(self):
+        cur = self.con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (self.table_name,))
+        return cur.fetchone() is not None
+
+    def load_state(self):
+        """
+        Returns:
+          (digest, watermark, num_bytes) recorded by the last load of this
+          table, or None if it has never been loaded.  The digest is of
+          the first num_bytes bytes of the file, the part already loaded.
+        """
+        cur = self.con.execute(
+            "SELECT digest, watermark, num_bytes FROM LoadState "
+            "WHERE table_name = ?", (self.table_name,))
+        return cur.fetchone()
+
+    def save_state(self, digest, watermark, num_bytes):
+        self.con.execute(
+            "INSERT OR REPLACE INTO LoadState "
+            "(table_name, digest, watermark, num_bytes) VALUES (?, ?, ?, ?)",
+            (self.table_name, digest, watermark, num_bytes))
+
     def create_table(self):
         raise NotImplementedError()
 
-    def _process_record(self, record):
-        raise NotImplementedError()
+    def create_indexes(self):
+        self.con.execute(
+            "CREATE UNIQUE INDEX %s_key ON %s (%s)" % (
+                self.table_name, self.table_name,
+                ", ".join(self.key_columns))
+        )
+
+    def report(self, num_rows, elapsed):
+        rate = num_rows / elapsed if elapsed > 0 else float("inf")
+        print "%s: %d rows in %.2fs (%.0f rows/sec)" % (
+            self.table_name, num_rows, elapsed, rate)
 
     def process_record(self, record):
-        if self.date_index:
+        if self.date_index is not None:
             year, month, day = self.parse_date(record[self.date_index])
             record[self.date_index] = year
             record.insert(self.date_index + 1, month)
             record.insert(self.date_index + 2, day)
 
-        self._process_record(record)
+        return record
 
     def parse_date(self, date_str):
         """
@@ -67,14 +333,19 @@ class TableBuilder(object):
 
 
 class StoresTableBuilder(TableBuilder):
-    def __init__(self, dbname, data_dir):
-        super(StoresTableBuilder, self).__init__(dbname, data_dir, STORES_FILE)
+    table_name = "Stores"
+    insert_sql = "INSERT INTO Stores VALUES (?, ?, ?)"
+    key_columns = ("store_id",)
+
+    def __init__(self, con, data_dir, batch_size=DEFAULT_BATCH_SIZE):
+        super(StoresTableBuilder, self).__init__(con, data_dir, STORES_FILE,
+                                                 batch_size=batch_size)
 
     def create_table(self):
         self.con.execute(
             """
             CREATE TABLE Stores (
-              store_id INT PRIMARY KEY,
+              store_id INT,
               type TEXT,
               size INT
             )
@@ -83,15 +354,17 @@ class StoresTableBuilder(TableBuilder):
 
         self.con.commit()
 
-    def _process_record(self, record):
-        self.con.execute(
-            "INSERT INTO Stores VALUES (?, ?, ?)", record)
-
 
 class FeaturesTableBuilder(TableBuilder):
-    def __init__(self, dbname, data_dir):
-        super(FeaturesTableBuilder, self).__init__(dbname, data_dir,
-                                                   FEATURES_FILE)
+    table_name = "Features"
+    insert_sql = ("INSERT INTO Features VALUES "
+                  "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+    key_columns = ("store_id", "year", "month", "day")
+
+    def __init__(self, con, data_dir, batch_size=DEFAULT_BATCH_SIZE):
+        super(FeaturesTableBuilder, self).__init__(con, data_dir,
+                                                   FEATURES_FILE,
+                                                   batch_size=batch_size)
 
     def create_table(self):
         self.con.execute(
@@ -110,25 +383,24 @@ class FeaturesTableBuilder(TableBuilder):
               markdown5 REAL,
               cpi REAL,
               unemployment REAL,
-              is_holiday TEXT,
-              PRIMARY KEY (store_id, year, month, day)
+              is_holiday TEXT
             )
             """
         )
 
         self.con.commit()
 
-    def _process_record(self, record):
-        self.con.execute(
-            "INSERT INTO Features VALUES "
-            "  (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            record)
-
 
 class SalesTrainTableBuilder(TableBuilder):
-    def __init__(self, dbname, data_dir):
-        super(SalesTrainTableBuilder, self).__init__(dbname, data_dir,
-                                                     SALES_TRAINING_FILE)
+    table_name = "SalesTrain"
+    insert_sql = "INSERT INTO SalesTrain VALUES (?, ?, ?, ?, ?, ?, ?)"
+    key_columns = ("store_id", "dept_id", "year", "month", "day")
+    append_only = True
+
+    def __init__(self, con, data_dir, batch_size=DEFAULT_BATCH_SIZE):
+        super(SalesTrainTableBuilder, self).__init__(con, data_dir,
+                                                     SALES_TRAINING_FILE,
+                                                     batch_size=batch_size)
 
     def create_table(self):
         self.con.execute(
@@ -140,23 +412,25 @@ class SalesTrainTableBuilder(TableBuilder):
               month INT,
               day INT,
               weekly_sales REAL,
-              is_holiday TEXT,
-              PRIMARY KEY (store_id, dept_id, year, month, day)
+              is_holiday TEXT
             )
             """
         )
 
         self.con.commit()
 
-    def _process_record(self, record):
-        self.con.execute(
-            "INSERT INTO SalesTrain VALUES (?, ?, ?, ?, ?, ?, ?)", record)
-
 
 class SalesTestTableBuilder(TableBuilder):
-    def __init__(self, dbname, data_dir):
-        super(SalesTestTableBuilder, self).__init__(dbname, data_dir,
-                                                    SALES_TESTING_FILE)
+    # The test weeks move on as they become training weeks, so a changed
+    # file replaces the table rather than adding to it.
+    table_name = "SalesTest"
+    insert_sql = "INSERT INTO SalesTest VALUES (?, ?, ?, ?, ?, ?)"
+    key_columns = ("store_id", "dept_id", "year", "month", "day")
+
+    def __init__(self, con, data_dir, batch_size=DEFAULT_BATCH_SIZE):
+        super(SalesTestTableBuilder, self).__init__(con, data_dir,
+                                                    SALES_TESTING_FILE,
+                                                    batch_size=batch_size)
 
     def create_table(self):
         self.con.execute(
@@ -167,21 +441,392 @@ class SalesTestTableBuilder(TableBuilder):
               year INT,
               month INT,
               day INT,
+              is_holiday TEXT
+            )
+            """
+        )
+
+        self.con.commit()
+
+
+class JoinedTableBuilder(object):
+    """
+    Materializes the join of Stores, Features and one of the sales tables.
+    The result is stored clustered on (store_id, dept_id, year, month, day)
+    so consumers read the joined rows in that order with a sequential scan.
+    """
+    def __init__(self, con, test=False):
+        self.con = con
+        self.test = test
+
+        if test:
+            self.table_name = "JoinedTest"
+            self.sales_table = "SalesTest"
+        else:
+            self.table_name = "JoinedTrain"
+            self.sales_table = "SalesTrain"
+
+    def create_table(self):
+        self.con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS %s (
+              store_id INT,
+              dept_id INT,
+              type TEXT,
+              size INT,
+              year INT,
+              month INT,
+              day INT,
+              temperature REAL,
+              fuel_price REAL,
+              markdown1 REAL,
+              markdown2 REAL,
+              markdown3 REAL,
+              markdown4 REAL,
+              markdown5 REAL,
+              cpi REAL,
+              unemployment REAL,
               is_holiday TEXT,
+              %s
               PRIMARY KEY (store_id, dept_id, year, month, day)
-            )
+            ) WITHOUT ROWID
+            """ % (self.table_name, "" if self.test else "weekly_sales REAL,")
+        )
+
+        self.con.commit()
+
+    def is_empty(self):
+        cur = self.con.execute("SELECT 1 FROM %s LIMIT 1" % self.table_name)
+        return cur.fetchone() is None
+
+    def join_sql(self):
+        return """
+               SELECT S.store_id, ST.dept_id, S.type, S.size, F.year,
+                      F.month, F.day, F.temperature, F.fuel_price,
+                      F.markdown1, F.markdown2, F.markdown3, F.markdown4,
+                      F.markdown5, F.cpi, F.unemployment, F.is_holiday
+                      %s
+               FROM %s ST, Stores S, Features F
+               WHERE S.store_id = F.store_id AND
+                     F.store_id = ST.store_id AND
+                     F.year = ST.year AND
+                     F.month = ST.month AND
+                     F.day = ST.day AND
+                     (ST.year, ST.month, ST.day) >= (?, ?, ?)
+               ORDER BY ST.store_id, ST.dept_id, ST.year, ST.month, ST.day
+               """ % ("" if self.test else ", ST.weekly_sales",
+                      self.sales_table)
+
+    def check_query_plan(self):
+        """
+        Raises RuntimeError if SQLite would answer the join with more than
+        one full scan, i.e. if an index needed for the lookups is missing.
+        """
+        plan = [row[-1] for row in self.con.execute(
+            "EXPLAIN QUERY PLAN " + self.join_sql(), (0, 0, 0))]
+
+        scans = [step for step in plan if step.startswith("SCAN")]
+        automatic = [step for step in plan if "AUTOMATIC" in step]
+
+        if len(scans) > 1 or automatic:
+            raise RuntimeError(
+                "Join of %s degraded to nested scans:\n  %s" % (
+                    self.sales_table, "\n  ".join(plan)))
+
+    def insert_data(self, since=None):
+        """
+        Args:
+          since: str
+            If provided, only joined rows dated on or after this YYYY-MM-DD
+            date are deleted and recomputed.  Otherwise the table is
+            rebuilt.
+        """
+        self.check_query_plan()
+
+        start = time.time()
+
+        if since is None:
+            self.con.execute("DELETE FROM %s" % self.table_name)
+            first_date = (0, 0, 0)
+        else:
+            first_date = map(int, since.split("-"))
+            self.con.execute(
+                "DELETE FROM %s WHERE (year, month, day) >= (?, ?, ?)" %
+                self.table_name, first_date)
+
+        cur = self.con.execute(
+            "INSERT OR REPLACE INTO %s %s" % (self.table_name,
+                                             self.join_sql()),
+            first_date)
+        self.con.commit()
+
+        elapsed = time.time() - start
+        print "%s: %d rows in %.2fs" % (self.table_name, cur.rowcount,
+                                        elapsed)
+
+
+# Week ordinal of a row's date, numbered as history_features.week_ordinals
+# numbers them: days since 1970-01-01, the Julian day 2440587.5, over 7
+WEEK_SQL = ("CAST(julianday(printf('%04d-%02d-%02d', year, month, day)) - "
+            "2440587.5 AS INTEGER) / 7")
+
+
+class HistoryTableBuilder(object):
+    """
+    Materializes the features of history_features.py for every store,
+    department and week of SalesTrain and SalesTest as the SalesHistory
+    table, computed inside SQLite.
+
+    The sales of both tables are first copied to a temporary table keyed by
+    (store_id, dept_id, week), so test weeks get the history of the
+    training weeks before them.  Rolling statistics are window functions
+    with RANGE frames over the week, so weeks missing from a department's
+    sales do not shift them.  Lags are lookups of the week k weeks earlier
+    on the key, which give the same values as RANGE frames of k PRECEDING
+    at a third of the cost, since SQLite makes one pass over the rows for
+    every distinct frame.
+    """
+    table_name = "SalesHistory"
+
+    def __init__(self, con, lags=DEFAULT_LAGS, windows=DEFAULT_WINDOWS):
+        self.con = con
+        self.lags = lags
+        self.windows = windows
+        self.columns = feature_names(lags, windows)
+
+        # Weeks of sales before the first recomputed week that its features
+        # can depend on.  Holidays may be a week further back than usual.
+        self.lookback = max(tuple(lags) + tuple(windows) +
+                            (WEEKS_PER_YEAR + 1,))
+
+        if not has_function(con, "sqrt(1)"):
+            con.create_function(
+                "sqrt", 1,
+                lambda value: None if value is None else math.sqrt(value))
+
+    def create_table(self):
+        # A table of other lags or windows is rebuilt
+        if self.table_exists() and self.table_columns() != self.columns:
+            self.con.execute("DROP TABLE %s" % self.table_name)
+
+        self.con.execute(
             """
+            CREATE TABLE IF NOT EXISTS %s (
+              store_id INT,
+              dept_id INT,
+              year INT,
+              month INT,
+              day INT,
+              %s,
+              PRIMARY KEY (store_id, dept_id, year, month, day)
+            ) WITHOUT ROWID
+            """ % (self.table_name,
+                   ",\n".join("%s REAL" % column for column in self.columns))
         )
 
         self.con.commit()
 
-    def _process_record(self, record):
+    def table_exists(self):
+        cur = self.con.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (self.table_name,))
+        return cur.fetchone() is not None
+
+    def table_columns(self):
+        """
+        Returns:
+          list of the feature columns of the table, after the key.
+        """
+        cur = self.con.execute("PRAGMA table_info(%s)" % self.table_name)
+        return [row[1] for row in cur][5:]
+
+    def is_empty(self):
+        cur = self.con.execute("SELECT 1 FROM %s LIMIT 1" % self.table_name)
+        return cur.fetchone() is None
+
+    def copy_sales(self, first_date):
+        self.con.execute("DROP TABLE IF EXISTS temp.WeeklySales")
         self.con.execute(
-            "INSERT INTO SalesTest VALUES (?, ?, ?, ?, ?, ?)", record)
+            """
+            CREATE TEMP TABLE WeeklySales (
+              store_id INT,
+              dept_id INT,
+              week INT,
+              year INT,
+              month INT,
+              day INT,
+              weekly_sales REAL,
+              PRIMARY KEY (store_id, dept_id, week)
+            ) WITHOUT ROWID
+            """
+        )
+
+        # Weeks with known sales replace those of the test table
+        for sql in ("SELECT store_id, dept_id, {week}, year, month, day, "
+                    "NULL FROM SalesTest "
+                    "WHERE (year, month, day) >= (?, ?, ?)",
+                    "SELECT store_id, dept_id, {week}, year, month, day, "
+                    "weekly_sales FROM SalesTrain "
+                    "WHERE (year, month, day) >= (?, ?, ?)"):
+            self.con.execute(
+                "INSERT OR REPLACE INTO WeeklySales " +
+                sql.format(week=WEEK_SQL), first_date)
+
+    def history_sql(self):
+        def lag_join(alias, weeks_back):
+            return ("LEFT JOIN WeeklySales {0} ON "
+                    "{0}.store_id = H.store_id AND "
+                    "{0}.dept_id = H.dept_id AND "
+                    "{0}.week = H.week - {1}").format(alias, weeks_back)
+
+        windowed = []
+        selected = ["L%d.weekly_sales" % lag for lag in self.lags]
+        joins = [lag_join("L%d" % lag, lag) for lag in self.lags]
+
+        for window in self.windows:
+            frame = ("OVER (PARTITION BY store_id, dept_id ORDER BY week "
+                     "RANGE BETWEEN %d PRECEDING AND 1 PRECEDING)" % window)
+            windowed += [
+                "AVG(weekly_sales) %s AS mean_%d" % (frame, window),
+                "AVG(weekly_sales * weekly_sales) %s AS square_%d" % (
+                    frame, window)
+            ]
+            selected += [
+                "H.mean_%d" % window,
+                "sqrt(MAX(H.square_%d - H.mean_%d * H.mean_%d, 0))" % (
+                    window, window, window)
+            ]
+
+        selected.append("Y.weekly_sales")
+        joins.append(lag_join("Y", "IFNULL(S.shift, %d)" % WEEKS_PER_YEAR))
+
+        # Holiday weeks are compared with last year's holiday of the same
+        # month, found by the middle day of each week
+        return """
+               WITH HolidayMonths AS (
+                 SELECT week,
+                        CAST(strftime('%Y', week * 7 + 3 + 2440587.5)
+                             AS INTEGER) * 12 +
+                        CAST(strftime('%m', week * 7 + 3 + 2440587.5)
+                             AS INTEGER) AS month
+                 FROM (SELECT DISTINCT {week} AS week FROM Features
+                       WHERE is_holiday = 'TRUE')
+               ),
+               HolidayShifts AS (
+                 SELECT C.week AS week, C.week - MAX(P.week) AS shift
+                 FROM HolidayMonths C, HolidayMonths P
+                 WHERE P.month = C.month - 12
+                 GROUP BY C.week
+               )
+               SELECT H.store_id, H.dept_id, H.year, H.month, H.day,
+                      {selected}
+               FROM (SELECT store_id, dept_id, week, year, month, day
+                            {windowed}
+                     FROM WeeklySales) H
+               LEFT JOIN HolidayShifts S ON S.week = H.week
+               {joins}
+               WHERE (H.year, H.month, H.day) >= (?, ?, ?)
+               """.format(week=WEEK_SQL,
+                          windowed="".join(",\n" + column
+                                           for column in windowed),
+                          selected=",\n".join(selected),
+                          joins="\n".join(joins))
+
+    def insert_data(self, since=None):
+        """
+        Args:
+          since: str
+            If provided, only rows dated on or after this YYYY-MM-DD date
+            are (re)computed, reading only the sales they depend on.
+            Otherwise the table is rebuilt.
+        """
+        start = time.time()
+
+        if since is None:
+            self.con.execute("DELETE FROM %s" % self.table_name)
+            first_date = (0, 0, 0)
+            first_sales_date = (0, 0, 0)
+        else:
+            first_date = tuple(map(int, since.split("-")))
+            first_sales = (datetime.date(*first_date) -
+                           datetime.timedelta(weeks=self.lookback))
+            first_sales_date = (first_sales.year, first_sales.month,
+                                first_sales.day)
+
+            self.con.execute(
+                "DELETE FROM %s WHERE (year, month, day) >= (?, ?, ?)" %
+                self.table_name, first_date)
+
+        self.copy_sales(first_sales_date)
+
+        cur = self.con.execute(
+            "INSERT OR REPLACE INTO %s %s" % (self.table_name,
+                                             self.history_sql()),
+            first_date)
+        self.con.execute("DROP TABLE temp.WeeklySales")
+        self.con.commit()
+
+        elapsed = time.time() - start
+        print "%s: %d rows in %.2fs" % (self.table_name, cur.rowcount,
+                                        elapsed)
+
+
+def has_function(con, call):
+    try:
+        con.execute("SELECT %s" % call)
+    except sqlite3.OperationalError:
+        return False
+
+    return True
+
+
+BATCH, DONE, ERROR = range(3)
+
+
+def parse_table(builder_class, data_dir, batch_size, index, queue):
+    """
+    Worker process for a parallel build.  Parses one CSV file and sends
+    the row batches to the writer, which owns the database connection.
+    """
+    try:
+        builder = builder_class(None, data_dir, batch_size=batch_size)
+        for batch in builder.read_batches():
+            queue.put((index, BATCH, batch))
+    except Exception:
+        queue.put((index, ERROR, traceback.format_exc()))
+    else:
+        queue.put((index, DONE, builder.max_date))
+
+
+def stop_workers(workers):
+    for worker in workers:
+        worker.terminate()
+        worker.join()
 
 
 class DatabaseBuilder(object):
-    def __init__(self, dbname, data_dir):
+    def __init__(self, dbname, data_dir, batch_size=DEFAULT_BATCH_SIZE,
+                 incremental=False, history=False):
+        self.data_dir = data_dir
+        self.batch_size = batch_size
+        self.history = history
+
+        self.con = sqlite3.connect(dbname)
+        if not incremental:
+            for pragma in BULK_LOAD_PRAGMAS:
+                self.con.execute(pragma)
+
+        self.con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS LoadState (
+              table_name TEXT PRIMARY KEY,
+              digest TEXT,
+              watermark TEXT,
+              num_bytes INT
+            )
+            """
+        )
+
         self.table_builders = []
 
         builder_classes = (StoresTableBuilder,
@@ -190,13 +835,131 @@ class DatabaseBuilder(object):
                            SalesTestTableBuilder)
 
         for builder_class in builder_classes:
-            self.table_builders.append(builder_class(dbname, data_dir))
+            self.table_builders.append(
+                builder_class(self.con, data_dir, batch_size=batch_size))
+
+        self.joined_builders = [JoinedTableBuilder(self.con),
+                                JoinedTableBuilder(self.con, test=True)]
+        self.history_builder = HistoryTableBuilder(self.con)
 
     def build(self):
         for table_builder in self.table_builders:
             table_builder.create_table()
             table_builder.insert_data()
 
+        self.build_joins()
+
+    def build_joins(self):
+        for joined_builder in self.joined_builders:
+            joined_builder.create_table()
+            joined_builder.insert_data()
+
+        if self.history:
+            self.history_builder.create_table()
+            self.history_builder.insert_data()
+
+    def refresh(self):
+        # Maps each changed table to the earliest date of its changed rows
+        changed = {}
+
+        for table_builder in self.table_builders:
+            if table_builder.refresh():
+                changed[table_builder.table_name] = (
+                    table_builder.changed_since)
+
+        for joined_builder in self.joined_builders:
+            joined_builder.create_table()
+
+            dates = [changed[table_name] for table_name in
+                     ("Features", joined_builder.sales_table)
+                     if table_name in changed]
+
+            if ("Stores" in changed or None in dates or
+                    joined_builder.is_empty()):
+                joined_builder.insert_data()
+            elif dates:
+                # Only rows from the first changed week on are joined again
+                joined_builder.insert_data(since=min(dates))
+
+        # Once built, the history is kept up to date with or without --history
+        if self.history or self.history_builder.table_exists():
+            self.refresh_history(changed)
+
+    def refresh_history(self, changed):
+        self.history_builder.create_table()
+
+        # New holidays in Features only change the history of their weeks
+        dates = [since for table_name, since in changed.iteritems()
+                 if table_name in ("Features", "SalesTrain", "SalesTest")]
+
+        if self.history_builder.is_empty() or None in dates:
+            self.history_builder.insert_data()
+        elif dates:
+            # Only weeks from the first changed sales or features on have
+            # new history
+            self.history_builder.insert_data(since=min(dates))
+
+    def build_parallel(self):
+        """
+        Parses every input file in its own process while this process
+        writes the parsed batches to the database.
+        """
+        queue = multiprocessing.Queue(MAX_PENDING_BATCHES)
+
+        workers = []
+        for index, table_builder in enumerate(self.table_builders):
+            table_builder.create_table()
+
+            worker = multiprocessing.Process(
+                target=parse_table,
+                args=(table_builder.__class__, self.data_dir,
+                      self.batch_size, index, queue))
+            worker.start()
+            workers.append(worker)
+
+        start = time.time()
+        num_rows = [0] * len(self.table_builders)
+        remaining = len(self.table_builders)
+
+        while remaining > 0:
+            try:
+                index, kind, payload = queue.get(timeout=WORKER_POLL_SECONDS)
+            except Queue.Empty:
+                # A worker killed before it could report an error would
+                # leave the writer waiting forever
+                for index, worker in enumerate(workers):
+                    if worker.exitcode not in (None, 0):
+                        stop_workers(workers)
+                        raise RuntimeError(
+                            "Parsing %s exited with code %d" % (
+                                self.table_builders[index].filename,
+                                worker.exitcode))
+                continue
+
+            table_builder = self.table_builders[index]
+
+            if kind == BATCH:
+                self.con.executemany(table_builder.insert_sql, payload)
+                num_rows[index] += len(payload)
+            elif kind == DONE:
+                table_builder.create_indexes()
+                _, digest, size = table_builder.file_digests()
+                table_builder.save_state(digest, payload, size)
+                table_builder.report(num_rows[index], time.time() - start)
+                remaining -= 1
+            else:
+                stop_workers(workers)
+                raise RuntimeError(
+                    "Failed to parse %s:\n%s" % (table_builder.filename,
+                                                 payload))
+
+        self.con.commit()
+
+        for worker in workers:
+            worker.join()
+
+        self.build_joins()
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -204,11 +967,32 @@ def main():
                         help="Directory containing the data.")
     parser.add_argument("--dbname", type=str, default="sales.db",
                         help="Name of the database to create.")
+    parser.add_argument("--batch-size", dest="batch_size", type=int,
+                        default=DEFAULT_BATCH_SIZE,
+                        help="Number of rows inserted per executemany call.")
+    parser.add_argument("--parallel", action="store_true",
+                        help="Parse the input files in separate processes.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Update an existing database with only the "
+                             "rows added to the data since it was built.")
+    parser.add_argument("--history", action="store_true",
+                        help="Also build the SalesHistory table of lags, "
+                             "rolling statistics and last year's sales of "
+                             "each store and department.")
 
     args = parser.parse_args()
 
-    db_builder = DatabaseBuilder(args.dbname, args.data_dir)
-    db_builder.build()
+    db_builder = DatabaseBuilder(args.dbname, args.data_dir,
+                                 batch_size=args.batch_size,
+                                 incremental=args.incremental,
+                                 history=args.history)
+
+    if args.incremental:
+        db_builder.refresh()
+    elif args.parallel:
+        db_builder.build_parallel()
+    else:
+        db_builder.build()
 
 
 if __name__ == "__main__":
@@ -5,8 +5,9 @@ Create a CSV file for each department.
 """
 
 import argparse
-import collections
 import csv
+import itertools
+import operator
 import os
 import sqlite3
 
@@ -28,49 +29,33 @@ class CsvBuilder(object):
         return os.path.join(self.output_dir, name)
 
     def join_tables(self):
+        # The join is materialized by build_db.py, clustered on this order
         if self.test:
             sql = """
-                  SELECT S.store_id, ST.dept_id, S.type, S.size, F.year,
-                         F.month, F.day, F.temperature, F.fuel_price,
-                         F.markdown1, F.markdown2, F.markdown3, F.markdown4,
-                         F.markdown5, F.cpi, F.unemployment, F.is_holiday
-                  FROM Stores S, Features F, SalesTest ST
-                  WHERE S.store_id = F.store_id AND
-                        F.store_id = ST.store_id AND
-                        F.year = ST.year AND
-                        F.month = ST.month AND
-                        F.day = ST.day
+                  SELECT * FROM JoinedTest
+                  ORDER BY store_id, dept_id, year, month, day
                   """
-
         else:
             sql = """
-                  SELECT S.store_id, ST.dept_id, S.type, S.size, F.year,
-                         F.month, F.day, F.temperature, F.fuel_price,
-                         F.markdown1, F.markdown2, F.markdown3, F.markdown4,
-                         F.markdown5, F.cpi, F.unemployment, F.is_holiday,
-                         ST.weekly_sales
-                  FROM Stores S, Features F, SalesTrain ST
-                  WHERE S.store_id = F.store_id AND
-                        F.store_id = ST.store_id AND
-                        F.year = ST.year AND
-                        F.month = ST.month AND
-                        F.day = ST.day
+                  SELECT * FROM JoinedTrain
+                  ORDER BY store_id, dept_id, year, month, day
                   """
 
-        data = collections.defaultdict(list)
-
         cur = self.con.cursor()
-        for row in cur.execute(sql):
-            key = row[:2]
-            line = row[2:]
-            data[key].append(line)
+        cur.execute(sql)
 
-        return data
+        return cur
 
     def build(self):
-        for key, lines in self.join_tables().iteritems():
+        # Rows arrive grouped by department, so each file can be written
+        # out as soon as its group has been read.
+        for key, rows in itertools.groupby(self.join_tables(),
+                                           operator.itemgetter(0, 1)):
             with open(self.filename(*key), "wb") as filehandle:
-                csv.writer(filehandle).writerows(lines)
+                writer = csv.writer(filehandle)
+
+                for row in rows:
+                    writer.writerow(row[2:])
 
 
 def main():
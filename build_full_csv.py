@@ -9,9 +9,12 @@ import csv
 import os
 import sqlite3
 
+from history_features import feature_names
+
 
 class CsvBuilder(object):
-    def __init__(self, dbname, output_filename, test=False):
+    def __init__(self, dbname, output_filename, test=False, since=None,
+                 history=False):
         if output_filename is None:
             if not test:
                 self.filename = os.path.splitext(dbname)[0] + ".csv"
@@ -23,47 +26,63 @@ class CsvBuilder(object):
         self.con = sqlite3.connect(dbname)
         self.test = test
 
+        # "YYYY-MM-DD", to only include records from that date on
+        self.since = since
+
+        # Whether to append the columns of the SalesHistory table
+        self.history = history
+
     def join_tables(self):
         cur = self.con.cursor()
 
+        # The join is materialized by build_db.py
         if self.test:
+            table_name = "JoinedTest"
+        else:
+            table_name = "JoinedTrain"
+
+        if self.history:
+            self.check_history()
+
+            # Missing values are written as NA, like missing markdowns
             sql = """
-                  SELECT S.store_id, ST.dept_id, S.type, S.size, F.year,
-                         F.month, F.day, F.temperature, F.fuel_price,
-                         F.markdown1, F.markdown2, F.markdown3, F.markdown4,
-                         F.markdown5, F.cpi, F.unemployment, F.is_holiday
-                  FROM Stores S, Features F, SalesTest ST
-                  WHERE S.store_id = F.store_id AND
-                        F.store_id = ST.store_id AND
-                        F.year = ST.year AND
-                        F.month = ST.month AND
-                        F.day = ST.day
-                  """
+                  SELECT J.*, %s
+                  FROM %s J LEFT JOIN SalesHistory H
+                  USING (store_id, dept_id, year, month, day)
+                  """ % (", ".join("IFNULL(H.%s, 'NA')" % column
+                                   for column in feature_names()),
+                         table_name)
+        else:
+            sql = "SELECT * FROM %s J" % table_name
 
+        if self.since is not None:
+            sql += " WHERE (J.year, J.month, J.day) >= (?, ?, ?)"
+            cur.execute(sql, map(int, self.since.split("-")))
         else:
-            sql = """
-                  SELECT S.store_id, ST.dept_id, S.type, S.size, F.year,
-                         F.month, F.day, F.temperature, F.fuel_price,
-                         F.markdown1, F.markdown2, F.markdown3, F.markdown4,
-                         F.markdown5, F.cpi, F.unemployment, F.is_holiday,
-                         ST.weekly_sales
-                  FROM Stores S, Features F, SalesTrain ST
-                  WHERE S.store_id = F.store_id AND
-                        F.store_id = ST.store_id AND
-                        F.year = ST.year AND
-                        F.month = ST.month AND
-                        F.day = ST.day
-                  """
-
-        cur.execute(sql)
+            cur.execute(sql)
 
         return cur
 
+    def check_history(self):
+        cur = self.con.execute("PRAGMA table_info(SalesHistory)")
+        columns = [row[1] for row in cur][5:]
+
+        if not columns:
+            raise ValueError("The database has no SalesHistory table; "
+                             "build it with build_db.py --history")
+
+        if columns != feature_names():
+            raise ValueError("The SalesHistory table has the columns %s "
+                             "rather than %s; rebuild it with build_db.py" %
+                             (", ".join(columns), ", ".join(feature_names())))
+
     def build(self):
+        rows = self.join_tables()
+
         with open(self.filename, "w") as filehandle:
             writer = csv.writer(filehandle)
 
-            for row in self.join_tables():
+            for row in rows:
                 writer.writerow(row)
 
 
@@ -77,11 +96,24 @@ def main():
                              "Defaults to the input filename with its "
                              "extension replaced by .csv")
     parser.add_argument("--test", action="store_true")
+    parser.add_argument("--since", metavar="YYYY-MM-DD",
+                        help="Only include records from this date on, "
+                             "such as a new week of sales to update a "
+                             "model with.")
+    parser.add_argument("--history", action="store_true",
+                        help="Append the lagged and last year's sales of "
+                             "the SalesHistory table built by build_db.py "
+                             "--history, with NA where they are missing.")
 
     args = parser.parse_args()
 
-    builder = CsvBuilder(args.dbname, args.output_filename, args.test)
-    builder.build()
+    builder = CsvBuilder(args.dbname, args.output_filename, args.test,
+                         since=args.since, history=args.history)
+
+    try:
+        builder.build()
+    except ValueError as e:
+        parser.error(str(e))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+"""
+Per-department feature datasets.
+
+A packed dataset is a single feature matrix holding every department's
+feature vectors, sorted by (store_id, dept_id) with those ids in its first
+two columns.  The row range of each department is indexed when the file is
+opened, so each department's data is a view into the one matrix rather than
+a separate file to open and parse.
+
+A directory of per-department feature files, as written by
+extract_dept_features.py, can be read through the same interface.
+"""
+
+import collections
+import os
+
+import numpy as np
+
+from feature_store import is_binary, load_features, write_features
+
+
+FEATURE_SUFFIXES = (".num", ".num.npy")
+
+
+class PackedDataset(object):
+    def __init__(self, filename, mmap=False):
+        self.filename = filename
+        self.data = load_features(filename, mmap=mmap)
+        self.offsets = self.index_departments(self.data)
+
+    def index_departments(self, data):
+        """
+        Returns:
+          offsets: OrderedDict mapping (store_id, dept_id) to the
+            (start, stop) range of that department's rows.
+        """
+        store_ids = data[:, 0]
+        dept_ids = data[:, 1]
+
+        offsets = collections.OrderedDict()
+        for start, stop in department_ranges(store_ids, dept_ids):
+            key = (int(store_ids[start]), int(dept_ids[start]))
+            offsets[key] = (int(start), int(stop))
+
+        return offsets
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def __getitem__(self, key):
+        start, stop = self.offsets[key]
+        return self.data[start:stop, 2:]
+
+    def iteritems(self):
+        for key in self.offsets:
+            yield key, self[key]
+
+    def to_arrays(self):
+        """
+        Returns:
+          (store_ids, dept_ids, data) for every record at once.
+        """
+        return self.data[:, 0], self.data[:, 1], self.data[:, 2:]
+
+
+def department_ranges(store_ids, dept_ids):
+    """
+    Returns:
+      list of the (start, stop) row range of each department, for records
+        sorted by store and department.
+    """
+    if len(store_ids) == 0:
+        return []
+
+    boundaries = np.flatnonzero((np.diff(store_ids) != 0) |
+                                (np.diff(dept_ids) != 0)) + 1
+    starts = np.concatenate(([0], boundaries))
+    stops = np.concatenate((boundaries, [len(store_ids)]))
+
+    return zip(starts, stops)
+
+
+class DirectoryDataset(object):
+    def __init__(self, data_dir):
+        self.filename = data_dir
+        self.paths = dict(((store_id, dept_id), path)
+                          for store_id, dept_id, path in
+                          feature_files(data_dir))
+
+    def keys(self):
+        return sorted(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, key):
+        return key in self.paths
+
+    def __getitem__(self, key):
+        return load_features(self.paths[key])
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def to_arrays(self):
+        store_ids = []
+        dept_ids = []
+        data = []
+        for (store_id, dept_id), dept_data in self.iteritems():
+            store_ids.append(np.repeat(store_id, len(dept_data)))
+            dept_ids.append(np.repeat(dept_id, len(dept_data)))
+            data.append(dept_data)
+
+        return (np.concatenate(store_ids), np.concatenate(dept_ids),
+                np.vstack(data))
+
+
+def feature_files(data_dir):
+    """
+    Yields (store_id, dept_id, path) for each department's feature file.
+    A department with both a text and a binary file, left by runs of
+    extract_dept_features.py with and without --text, gets its binary file.
+    """
+    paths = {}
+    for filename in sorted(os.listdir(data_dir)):
+        if not filename.endswith(FEATURE_SUFFIXES):
+            continue
+
+        key = tuple(map(int, filename.split(".")[0].split("-")))
+        if key not in paths or is_binary(filename):
+            paths[key] = os.path.join(data_dir, filename)
+
+    for (store_id, dept_id), path in sorted(paths.iteritems()):
+        yield store_id, dept_id, path
+
+
+def open_dataset(path, mmap=False):
+    """
+    Opens either a packed dataset file or a directory of per-department
+    feature files.
+    """
+    if os.path.isdir(path):
+        return DirectoryDataset(path)
+
+    return PackedDataset(path, mmap=mmap)
+
+
+def write_packed(store_ids, dept_ids, feature_vectors, filename):
+    """
+    Writes a packed dataset.  Records of the same department keep their
+    relative order.
+    """
+    order = np.lexsort((dept_ids, store_ids))
+
+    write_features(
+        np.column_stack((store_ids, dept_ids, feature_vectors))[order],
+        filename)
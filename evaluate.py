@@ -2,53 +2,202 @@
 
 """
 Evaluates a model's performance.
+
+By default the model is scored with rolling-origin folds: each fold trains
+on every week before a cutoff and is tested on the weeks that follow it,
+the way the model is used to forecast.  Errors are the weighted mean
+absolute error of the competition, in which holiday weeks count five times.
 """
 
 import argparse
+import multiprocessing
+import os
 import pickle
+import shutil
+import tempfile
 
 import numpy as np
-from sklearn import cross_validation
+from sklearn.base import clone
+
+from feature_store import load_features, write_features
+
+
+# Columns of the year, month and day in the files of extract_features.py,
+# with the three store types one-hot encoded
+DEFAULT_DATE_COLUMNS = (6, 7, 8)
+
+# The holiday flag is the last feature, before the target
+DEFAULT_HOLIDAY_COLUMN = -2
+
+HOLIDAY_WEIGHT = 5
+
+
+def weighted_mean_absolute_error(targets, predictions, is_holiday):
+    weights = np.where(is_holiday, HOLIDAY_WEIGHT, 1)
+    return (weights * np.abs(targets - predictions)).sum() / weights.sum()
 
 
 class ModelEvaluator(object):
-    def __init__(self, data, test_size, model):
+    def __init__(self, data, test_size, model,
+                 holiday_column=DEFAULT_HOLIDAY_COLUMN):
         self.model = model
 
-        (self.train_data,
-         self.test_data,
-         self.train_target,
-         self.test_target) = cross_validation.train_test_split(
-            data[:, :-1], data[:, -1], test_size=test_size)
+        indices = np.random.permutation(len(data))
+        num_test = int(round(test_size * len(data)))
+        train = data[indices[num_test:]]
+        test = data[indices[:num_test]]
+
+        self.model.fit(train[:, :-1], train[:, -1])
 
-        self.model.fit(self.train_data, self.train_target)
+        self.predictions = model.predict(test[:, :-1])
+        self.test_target = test[:, -1]
 
-        # Make sure to convert back to original domain
-        self.predictions = model.predict(self.test_data)
-        self.test_target = self.test_target
+        # Scaled or not, the flag is only positive for holidays
+        self.is_holiday = test[:, holiday_column] > 0
 
     def mean_absolute_error(self):
         error = np.abs(self.predictions - self.test_target)
         return error.sum() / error.shape[0]
 
+    def weighted_mean_absolute_error(self):
+        return weighted_mean_absolute_error(
+            self.test_target, self.predictions, self.is_holiday)
+
     def write_expected_and_predicted(self, output_filename):
-        with open(output_filename, "wb") as filehandle:
-            filehandle.write("Expected,Predicted\n")
+        write_expected_and_predicted(self.test_target, self.predictions,
+                                     output_filename)
+
+
+def write_expected_and_predicted(targets, predictions, output_filename):
+    with open(output_filename, "wb") as filehandle:
+        filehandle.write("Expected,Predicted\n")
+
+        assert len(targets) == len(predictions)
+        for i in xrange(len(predictions)):
+            filehandle.write("%.2f,%.2f\n" % (targets[i], predictions[i]))
+
+
+class RollingOriginEvaluator(object):
+    """
+    Scores a model on rolling-origin folds.  The last num_folds * horizon
+    weeks of the data are split into num_folds test windows of horizon
+    weeks, and each fold trains on every week before its window.
+
+    The records are written sorted by date to one temporary file, so the
+    training and test records of every fold are contiguous slices of it.
+    Folds run on a process pool and each worker memory-maps the file, so
+    all folds share a single copy of the data.
+    """
+    def __init__(self, data, model, num_folds, horizon,
+                 date_columns=DEFAULT_DATE_COLUMNS,
+                 holiday_column=DEFAULT_HOLIDAY_COLUMN):
+        self.model = model
+        self.holiday_column = holiday_column
+
+        # Scaling keeps the order of the dates, so raw or scaled features
+        # sort the same way
+        year, month, day = [data[:, column] for column in date_columns]
+        order = np.lexsort((day, month, year))
+
+        dates = np.column_stack((year, month, day))[order]
+        date_starts = np.concatenate((
+            [0],
+            np.flatnonzero((np.diff(dates, axis=0) != 0).any(axis=1)) + 1,
+            [len(data)]))
+
+        num_weeks = len(date_starts) - 1
+        first_test_week = num_weeks - num_folds * horizon
+        if first_test_week < 1:
+            raise ValueError(
+                "%d folds of %d weeks need more than the %d weeks of data" %
+                (num_folds, horizon, num_weeks))
+
+        # (train_stop, test_stop) row offsets of each fold
+        self.folds = [
+            (date_starts[first_test_week + i * horizon],
+             date_starts[first_test_week + (i + 1) * horizon])
+            for i in xrange(num_folds)
+        ]
 
-            assert len(self.test_target) == len(self.predictions)
-            for i in xrange(len(self.predictions)):
-                filehandle.write("%.2f,%.2f\n" % (
-                    self.test_target[i], self.predictions[i]))
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "by_date.npy")
+        write_features(data[order], self.filename)
+
+    def evaluate(self, jobs=1):
+        """
+        Returns:
+          list of (num_train, targets, predictions, is_holiday), one per
+            fold.
+        """
+        tasks = [(self.filename, self.model, 0, train_stop, test_stop,
+                  self.holiday_column)
+                 for train_stop, test_stop in self.folds]
+
+        if jobs <= 1:
+            return map(evaluate_fold, tasks)
+
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            return pool.map(evaluate_fold, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        shutil.rmtree(self.tmpdir)
+
+
+def evaluate_fold(task):
+    """
+    Trains a clone of a model on the records from train_start to
+    train_stop of a file sorted by date, and tests it on the records that
+    follow up to test_stop.
+
+    Returns:
+      (num_train, targets, predictions, is_holiday)
+    """
+    filename, model, train_start, train_stop, test_stop, holiday_column = (
+        task)
+
+    data = load_features(filename, mmap=True)
+    train = data[train_start:train_stop]
+    test = data[train_stop:test_stop]
+
+    model = clone(model)
+    model.fit(train[:, :-1], train[:, -1])
+
+    predictions = model.predict(test[:, :-1])
+
+    return (len(train), np.array(test[:, -1]), predictions,
+            test[:, holiday_column] > 0)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("model", help="The model to evaluate.")
     parser.add_argument("data", help="Labelled data used for evaluation.")
+    parser.add_argument("--method", choices=["rolling", "random"],
+                        default="rolling",
+                        help="Rolling-origin folds over the weeks, or a "
+                             "single random split.")
+    parser.add_argument("--folds", type=int, default=4,
+                        help="Number of rolling-origin folds.")
+    parser.add_argument("--horizon", type=int, default=4,
+                        help="Weeks tested by each rolling-origin fold.")
+    parser.add_argument("--date-columns", default=",".join(
+                            map(str, DEFAULT_DATE_COLUMNS)),
+                        help="Comma-separated columns of the year, month "
+                             "and day.")
+    parser.add_argument("--holiday-column", type=int,
+                        default=DEFAULT_HOLIDAY_COLUMN,
+                        help="Column of the holiday flag.")
+    parser.add_argument("--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of folds evaluated at once.")
     parser.add_argument("--test-size", dest="test_size", type=float,
                         default=0.7,
                         help="The proportion of the dataset to include in "
-                             "the test split.")
+                             "the test split of the random method.")
     parser.add_argument("--write", dest="output_file",
                         help="Write both the expected and predicted values "
                              "to a file.")
@@ -58,15 +207,56 @@ def main():
     with open(args.model) as filehandle:
         model = pickle.load(filehandle)
 
-    with open(args.data) as filehandle:
-        data = np.loadtxt(filehandle, delimiter=",")
+    if args.method == "random":
+        data = load_features(args.data)
+
+        evaluator = ModelEvaluator(data, args.test_size, model,
+                                   holiday_column=args.holiday_column)
+
+        print "Mean absolute error: %.5f" % evaluator.mean_absolute_error()
+        print "Weighted mean absolute error: %.5f" % (
+            evaluator.weighted_mean_absolute_error())
+
+        if args.output_file:
+            evaluator.write_expected_and_predicted(args.output_file)
+
+        return
+
+    date_columns = [int(column) for column in args.date_columns.split(",")]
+
+    try:
+        evaluator = RollingOriginEvaluator(
+            load_features(args.data, mmap=True), model, args.folds,
+            args.horizon, date_columns=date_columns,
+            holiday_column=args.holiday_column)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        results = evaluator.evaluate(jobs=args.jobs)
+    finally:
+        evaluator.close()
+
+    print "Fold\tTrain\tTest\tMAE\tWMAE"
+
+    scores = []
+    for fold, (num_train, targets, predictions, is_holiday) in enumerate(
+            results):
+        mae = np.abs(targets - predictions).mean()
+        wmae = weighted_mean_absolute_error(targets, predictions, is_holiday)
+        scores.append(wmae)
 
-    evaluator = ModelEvaluator(data, args.test_size, model)
+        print "%d\t%d\t%d\t%.2f\t%.2f" % (fold, num_train, len(targets), mae,
+                                          wmae)
 
-    print "Mean squared error: %.5f" % evaluator.mean_absolute_error()
+    print "Weighted mean absolute error: %.2f +/- %.2f" % (
+        np.mean(scores), np.std(scores))
 
     if args.output_file:
-        evaluator.write_expected_and_predicted(args.output_file)
+        write_expected_and_predicted(
+            np.concatenate([result[1] for result in results]),
+            np.concatenate([result[2] for result in results]),
+            args.output_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""
+Extracts the numerical features of extract_features.py straight from the
+database, without going through the CSV files of build_full_csv.py.
+
+The joined rows are fetched from SQLite a batch at a time and each batch is
+converted to one typed array per column, so no text is formatted or parsed
+on the way.  The arrays are transformed, scaled and written exactly as
+extract_features.py does with the CSV files.
+
+With --history the features of history_features.py, computed from the
+SalesTrain table, are added before the holiday flag, which stays the last
+feature.  Missing history values are filled with 0 and each history feature
+has an indicator column, 1 where it was missing, so that a model can tell
+them from sales of 0.
+"""
+
+import argparse
+import sqlite3
+
+import numpy as np
+from sklearn import preprocessing
+
+from build_full_csv import CsvBuilder
+from extract_features import (DAY, DEPT_ID, MONTH, STORE_ID, STRING_FEATURES,
+                              TEST_FEATURES, TRAIN_FEATURES, YEAR,
+                              NumericalFeatureExtractor, add_scaler_arguments,
+                              load_scaler, parse_float, save_scaler,
+                              scale_data, write_feature_vectors)
+from history_features import (DEFAULT_LAGS, DEFAULT_WINDOWS, SalesHistory,
+                              week_ordinals)
+
+
+DEFAULT_BATCH_SIZE = 65536
+
+
+def read_db_columns(cursor, field_names, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Reads the rows of a cursor into one array per field.
+
+    Returns:
+      columns: dict
+        Like extract_features.read_columns, maps each field name to a
+        numpy array.  Fields in STRING_FEATURES are string arrays, the rest
+        are float64 arrays with NaN for missing values, which the database
+        holds as NULL or as the text NA.
+    """
+    chunks = dict((field_name, []) for field_name in field_names)
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+
+        if len(rows[0]) != len(field_names):
+            raise ValueError("Records must all have %d fields" %
+                             len(field_names))
+
+        for field_name, values in zip(field_names, zip(*rows)):
+            if field_name in STRING_FEATURES:
+                chunks[field_name].append(np.array(values, dtype=str))
+            else:
+                chunks[field_name].append(to_floats(values))
+
+    columns = {}
+    for field_name, chunk in chunks.iteritems():
+        if not chunk:
+            dtype = str if field_name in STRING_FEATURES else np.float64
+            columns[field_name] = np.array([], dtype=dtype)
+        elif len(chunk) == 1:
+            columns[field_name] = chunk[0]
+        else:
+            columns[field_name] = np.concatenate(chunk)
+
+    return columns
+
+
+def to_floats(values):
+    # NULLs become NaN
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        return np.array([None if value == "NA" else value
+                         for value in values], dtype=np.float64)
+    except (TypeError, ValueError):
+        # Other text is rare enough to parse value by value
+        return np.array([np.nan if value is None else parse_float(value)
+                         for value in values], dtype=np.float64)
+
+
+def read_db_records(dbname, test=False, since=None,
+                    batch_size=DEFAULT_BATCH_SIZE):
+    builder = CsvBuilder(dbname, None, test=test, since=since)
+
+    try:
+        return read_db_columns(builder.join_tables(),
+                               TEST_FEATURES if test else TRAIN_FEATURES,
+                               batch_size=batch_size)
+    finally:
+        builder.con.close()
+
+
+def read_sales_history(dbname, batch_size=DEFAULT_BATCH_SIZE):
+    con = sqlite3.connect(dbname)
+
+    try:
+        sales = read_db_columns(
+            con.execute("SELECT store_id, dept_id, year, month, day, "
+                        "weekly_sales FROM SalesTrain"),
+            [STORE_ID, DEPT_ID, YEAR, MONTH, DAY, "weekly_sales"],
+            batch_size=batch_size)
+
+        holidays = read_db_columns(
+            con.execute("SELECT DISTINCT year, month, day FROM Features "
+                        "WHERE is_holiday = 'TRUE'"),
+            [YEAR, MONTH, DAY])
+    finally:
+        con.close()
+
+    return SalesHistory(
+        sales[STORE_ID], sales[DEPT_ID],
+        week_ordinals(sales[YEAR], sales[MONTH], sales[DAY]),
+        sales["weekly_sales"],
+        holiday_weeks=week_ordinals(holidays[YEAR], holidays[MONTH],
+                                    holidays[DAY]))
+
+
+def add_history_features(feature_vectors, columns, history, train,
+                         lags=DEFAULT_LAGS, windows=DEFAULT_WINDOWS):
+    """
+    Returns:
+      feature_vectors with the history features and their missing value
+        indicators inserted before the holiday flag.
+    """
+    features = history.features(
+        columns[STORE_ID], columns[DEPT_ID],
+        week_ordinals(columns[YEAR], columns[MONTH], columns[DAY]),
+        lags=lags, windows=windows)
+    missing = np.isnan(features)
+    features[missing] = 0
+
+    position = feature_vectors.shape[1] - (2 if train else 1)
+
+    return np.column_stack((feature_vectors[:, :position], features, missing,
+                            feature_vectors[:, position:]))
+
+
+def parse_ints(text):
+    return tuple(int(value) for value in text.split(",") if value)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dbname",
+                        help="The database built by build_db.py.")
+    parser.add_argument("training_output_filename")
+    parser.add_argument("testing_output_filename")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Number of rows fetched from the database at "
+                             "a time.")
+    parser.add_argument("--history", action="store_true",
+                        help="Add lagged and last year's sales of each "
+                             "store and department.")
+    parser.add_argument("--lags", type=parse_ints,
+                        default=DEFAULT_LAGS,
+                        help="Comma-separated lags in weeks, with "
+                             "--history.  Defaults to %s; shorter lags are "
+                             "missing for most test records." %
+                             ",".join(map(str, DEFAULT_LAGS)))
+    parser.add_argument("--windows", type=parse_ints,
+                        default=DEFAULT_WINDOWS,
+                        help="Comma-separated rolling windows in weeks, "
+                             "with --history.  None by default, since they "
+                             "are missing for most test records.")
+    add_scaler_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.update_scaler and args.scaler is None:
+        parser.error("--update-scaler needs --scaler")
+
+    scaler = None
+    categories = []
+    if args.update_scaler:
+        scaler, categories = load_scaler(args.scaler)
+
+    if args.history:
+        print "Reading sales history..."
+        history = read_sales_history(args.dbname,
+                                     batch_size=args.batch_size)
+
+    training_extractor = NumericalFeatureExtractor(None, train=True)
+    testing_extractor = NumericalFeatureExtractor(None, train=False)
+
+    # Both sets must be encoded with the same columns
+    training_extractor.categorical_transformer.categories = list(categories)
+    testing_extractor.categorical_transformer = (
+        training_extractor.categorical_transformer)
+
+    print "Extracting training features..."
+    columns = read_db_records(args.dbname, batch_size=args.batch_size)
+    training_data = training_extractor.transform_columns(columns)
+    if args.history:
+        training_data = add_history_features(
+            training_data, columns, history, True, lags=args.lags,
+            windows=args.windows)
+
+    print "Extracting testing features..."
+    columns = read_db_records(args.dbname, test=True,
+                              batch_size=args.batch_size)
+    testing_data = testing_extractor.transform_columns(columns)
+    if args.history:
+        testing_data = add_history_features(
+            testing_data, columns, history, False, lags=args.lags,
+            windows=args.windows)
+
+    print "Scaling..."
+    if scaler is None:
+        scaler = preprocessing.StandardScaler()
+    scaled_training, scaled_testing = scale_data(training_data, testing_data,
+                                                 scaler)
+
+    print "Writing training output..."
+    write_feature_vectors(scaled_training, args.training_output_filename)
+
+    print "Writing testing output..."
+    write_feature_vectors(scaled_testing, args.testing_output_filename)
+
+    if args.scaler is not None:
+        save_scaler(args.scaler, scaler,
+                    training_extractor.categorical_transformer.categories)
+
+
+if __name__ == "__main__":
+    main()
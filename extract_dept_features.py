@@ -1,15 +1,26 @@
 #!/usr/bin/env python
 
 """
-Script description.
+Extracts numerical features from each department's CSV file, or packs the
+features of every department in a CSV file from build_full_csv.py into a
+single dataset (see dept_dataset.py).
 """
 
 import argparse
-import csv
+import itertools
+import multiprocessing
 import os
+import sys
 
 import numpy as np
 
+import extract_features
+from extract_features import (BooleanEncoder, MarkdownTransformer,
+                              NonZeroNumTransformer, NumberTransformer,
+                              read_columns)
+from feature_store import write_features
+from dept_dataset import department_ranges, write_packed
+
 
 TYPE = "type"
 SIZE = "size"
@@ -40,37 +51,43 @@ class NumericalFeatureExtractor(object):
     def __init__(self, normalize=False):
         self.markdown_transformer = MarkdownTransformer(normalize=normalize)
         self.num_transformer = NumberTransformer(fill_value=0, normalize=normalize)
-        self.nonzeronum_transformer = NonZeroNumTransformer(fill_value=0, normalize=normalize)
+        # Separate transformers so each column fills from its own values
+        self.cpi_transformer = NonZeroNumTransformer(
+            fill_value=0, normalize=normalize)
+        self.unemployment_transformer = NonZeroNumTransformer(
+            fill_value=0, normalize=normalize)
         self.boolean_encoder = BooleanEncoder(normalize=normalize)
 
-    def read_records(self, filename):
-        records = []
+    def read_records(self, filename, test_features=TEST_FEATURES,
+                     train_features=TRAIN_FEATURES):
         with open(filename, "rb") as filehandle:
             num_fields = len(filehandle.readline().split(","))
 
             # reset filehandle to beginning of file
             filehandle.seek(0)
 
-            if num_fields == len(TEST_FEATURES):
+            if num_fields == len(test_features):
                 train = False
-            elif num_fields == len(TRAIN_FEATURES):
+            elif num_fields == len(train_features):
                 train = True
             else:
                 raise ValueError(
                     "Unexpected number of fields: %d" % num_fields)
 
-            field_names = TRAIN_FEATURES if train else TEST_FEATURES
+            field_names = train_features if train else test_features
 
-            for record in csv.DictReader(filehandle, fieldnames=field_names):
-                records.append(record)
+            columns = read_columns(filehandle, field_names)
 
-        return records, train
+        return columns, train
 
     def extract_features(self, filename):
-        records, train = self.read_records(filename)
+        columns, train = self.read_records(filename)
+
+        return self.transform_columns(columns, train)
 
+    def transform_columns(self, columns, train):
         def get_column(column_name):
-            return [record[column_name] for record in records]
+            return columns[column_name]
 
         years = self.num_transformer.transform(get_column(YEAR))
         months = self.num_transformer.transform(get_column(MONTH))
@@ -82,8 +99,9 @@ class NumericalFeatureExtractor(object):
         markdown3 = self.markdown_transformer.transform(get_column(MARKDOWN3))
         markdown4 = self.markdown_transformer.transform(get_column(MARKDOWN4))
         markdown5 = self.markdown_transformer.transform(get_column(MARKDOWN5))
-        cpis = self.nonzeronum_transformer.transform(get_column(CPI))
-        unemployment = self.nonzeronum_transformer.transform(get_column(UNEMPLOYMENT))
+        cpis = self.cpi_transformer.transform(get_column(CPI))
+        unemployment = self.unemployment_transformer.transform(
+            get_column(UNEMPLOYMENT))
         is_holiday = self.boolean_encoder.transform(get_column(IS_HOLIDAY))
 
         feature_vectors = [
@@ -110,109 +128,131 @@ class NumericalFeatureExtractor(object):
         return np.column_stack(feature_vectors)
 
 
-class Transformer(object):
-    def __init__(self, normalize=False):
-        self.normalize = normalize
-
-    def transform(self, values):
-        new_values = self._transform(values)
-
-        if self.normalize:
-            return self.do_normalize(new_values)
-
-        return new_values
-
-    def do_normalize(self, values):
-        values = np.asarray(values, dtype=np.float64)
+def write_feature_vectors(feature_vectors, output_filename):
+    write_features(feature_vectors, output_filename)
 
-        if values.max() == values.min():
-            return np.zeros_like(values)
 
-        return (values - values.min()) / (values.max() - values.min())
+def extract_file(paths):
+    """
+    Extracts the features of one department.  Each file starts from a
+    fresh extractor so its output does not depend on processing order.
+    """
+    input_filename, output_filename = paths
 
-    def _transform(self, values):
-        raise NotImplementedError()
+    feature_vectors = NumericalFeatureExtractor().extract_features(
+        input_filename)
+    write_feature_vectors(feature_vectors, output_filename)
 
 
-class MarkdownTransformer(Transformer):
-    def _transform(self, values):
-        new_values = np.zeros(len(values))
+def extract_packed(input_filename, output_filename):
+    """
+    Extracts the features of every department in a CSV file written by
+    build_full_csv.py and writes them as one packed dataset.  Each
+    department is transformed on its own, as extract_file would.
+    """
+    columns, train = NumericalFeatureExtractor().read_records(
+        input_filename, extract_features.TEST_FEATURES,
+        extract_features.TRAIN_FEATURES)
 
-        for i, value in enumerate(values):
-            if value == "NA":
-                new_values[i] = 0
-            else:
-                new_values[i] = value
+    store_ids = columns[extract_features.STORE_ID]
+    dept_ids = columns[extract_features.DEPT_ID]
 
-        return new_values
+    # Stable, so each department keeps the order of the file
+    order = np.lexsort((dept_ids, store_ids))
+    columns = dict((name, column[order])
+                   for name, column in columns.iteritems())
+    store_ids = store_ids[order]
+    dept_ids = dept_ids[order]
 
+    feature_vectors = []
+    for start, stop in department_ranges(store_ids, dept_ids):
+        dept_columns = dict((name, column[start:stop])
+                            for name, column in columns.iteritems())
+        feature_vectors.append(
+            NumericalFeatureExtractor().transform_columns(dept_columns, train))
 
-class NumberTransformer(Transformer):
-    def __init__(self, fill_value=0, normalize=False):
-        super(NumberTransformer, self).__init__(normalize=normalize)
-        self.fill_val = fill_value
+    write_packed(store_ids, dept_ids, np.vstack(feature_vectors),
+                 output_filename)
 
-    def _transform(self, values):
-        new_values = np.zeros(len(values))
 
-        for i, value in enumerate(values):
-            try:
-                new_values[i] = float(value)
-            except ValueError:
-                new_values[i] = self.fill_val
+def extract_directory(input_dir, suffix=".num.npy", jobs=1,
+                      incremental=False):
+    """
+    Extracts the features of every department's CSV file in a directory
+    to a file of the same name with the suffix appended.
 
-        return new_values
+    Args:
+      incremental: bool
+        Skip the files whose features are newer than the file itself.
 
+    Returns:
+      list of the names of the feature files written.
+    """
+    work = []
+    for filename in sorted(os.listdir(input_dir)):
+        if "." in filename:
+            # Already extracted features
+            continue
 
-class NonZeroNumTransformer(Transformer):
-    def __init__(self, fill_value=0, normalize=False):
-        super(NonZeroNumTransformer, self).__init__(normalize=normalize)
-        self.fill_val = fill_value
+        full_name = os.path.join(input_dir, filename)
+        output_filename = full_name + suffix
 
-    def _transform(self, values):
-        new_values = np.zeros(len(values))
-        temp = 0;
-        for i, value in enumerate(values):
-            try:
-                new_values[i] = float(value)
-                self.fill_val = float(value)
-            except ValueError:
-                #for now, need to get this on a curve.. but where to do it
-                new_values[i] = self.fill_val
+        if incremental and is_up_to_date(full_name, output_filename):
+            continue
 
-        return new_values
+        work.append((full_name, output_filename))
 
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(extract_file, work, chunksize=16)
+    else:
+        pool = None
+        results = itertools.imap(extract_file, work)
 
-class BooleanEncoder(Transformer):
-    def _transform(self, values):
-        new_values = np.zeros(len(values))
+    for done, _ in enumerate(results, 1):
+        sys.stderr.write("\rExtracted %d/%d files" % (done, len(work)))
+    sys.stderr.write("\n")
 
-        for i, value in enumerate(values):
-            if value == "TRUE":
-                new_values[i] = 1
-            elif value == "FALSE":
-                new_values[i] = 0
-            else:
-                raise ValueError("Must be TRUE or FALSE, but was %s" % value)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        return new_values
+    return [output_filename for _, output_filename in work]
 
 
-def write_feature_vectors(feature_vectors, output_filename):
-    np.savetxt(output_filename, feature_vectors, delimiter=",")
+def is_up_to_date(input_filename, output_filename):
+    return (os.path.exists(output_filename) and
+            os.path.getmtime(output_filename) >=
+            os.path.getmtime(input_filename))
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("directory")
+    parser.add_argument("input",
+                        help="Directory of per-department CSV files, or "
+                             "with --pack, a CSV file from build_full_csv.py.")
+    parser.add_argument("--pack", metavar="OUTPUT_FILENAME",
+                        help="Write the features of every department to "
+                             "this packed dataset file.")
+    parser.add_argument("--text", action="store_true",
+                        help="Write the features as CSV text (.num) "
+                             "instead of binary (.num.npy).")
+    parser.add_argument("--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of worker processes.  Defaults to the "
+                             "number of CPUs.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Skip files whose features are newer than "
+                             "the file itself.")
 
     args = parser.parse_args()
 
-    extractor = NumericalFeatureExtractor()
-    for filename in os.listdir(args.directory):
-        full_name = os.path.join(args.directory, filename)
-        feature_vectors = extractor.extract_features(full_name)
-        write_feature_vectors(feature_vectors, full_name + ".num")
+    if args.pack is not None:
+        extract_packed(args.input, args.pack)
+        return
+
+    extract_directory(args.input, ".num" if args.text else ".num.npy",
+                      jobs=args.jobs, incremental=args.incremental)
 
 
 if __name__ == "__main__":
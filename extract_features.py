@@ -3,14 +3,24 @@
 """
 Extracts numerical features from the full CSV file with all data (which
 contains both numerical and categorical attributes).
+
+With --scaler the scaler fit to the training features and the store type
+categories are saved, and with --update-scaler they are loaded, updated with
+new training records and used for them, so that a model can be updated with
+new weeks of sales scaled like those it was trained on.
 """
 
 import argparse
-import csv
+import cPickle as pickle
+import itertools
 
 import numpy as np
 from sklearn import preprocessing
 
+from atomic_file import atomic_open
+from feature_store import FeatureWriter, write_features
+from history_features import feature_names
+
 
 STORE_ID = "store_id"
 DEPT_ID = "dept_id"
@@ -38,46 +48,117 @@ TEST_FEATURES = [STORE_ID, DEPT_ID, TYPE, SIZE, YEAR, MONTH, DAY, TEMPERATURE,
 # Includes the target attribute
 TRAIN_FEATURES = TEST_FEATURES + [WEEKLY_SALES]
 
+# Appended to the fields by build_full_csv.py --history, and placed before
+# the holiday flag in the feature vectors, followed by an indicator of each
+# one's missing values
+HISTORY_FEATURES = feature_names()
+
+# The fields of each kind of input file, by their number
+FIELD_LAYOUTS = dict(
+    (len(field_names), field_names)
+    for field_names in (TEST_FEATURES, TRAIN_FEATURES,
+                        TEST_FEATURES + HISTORY_FEATURES,
+                        TRAIN_FEATURES + HISTORY_FEATURES))
+
+# Read as strings by read_columns, all other fields are parsed as floats
+STRING_FEATURES = [TYPE, IS_HOLIDAY]
+
+# Number of records parsed at a time by read_columns
+READ_CHUNK_SIZE = 65536
+
 
 class NumericalFeatureExtractor(object):
-    def __init__(self, input_filename, normalize=False):
-        self.records, self.train = self.read_records(input_filename)
+    def __init__(self, input_filename, normalize=False, train=None):
+        """
+        Args:
+          input_filename: str
+            May be None if the columns are read elsewhere and passed to
+            transform_columns, in which case train must be given.
+          train: bool
+            Whether the records include the target.  By default this is
+            found from the number of fields in input_filename.
+        """
+        self.input_filename = input_filename
+        self.normalize = normalize
+        if train is None:
+            self.field_names = self.read_field_names(input_filename)
+        else:
+            self.field_names = TRAIN_FEATURES if train else TEST_FEATURES
+        self.train = WEEKLY_SALES in self.field_names
 
         self.categorical_transformer = OneHotEncoder(normalize=normalize)
         self.markdown_transformer = MarkdownTransformer(normalize=normalize)
         self.month_transformer = MonthTransformer(normalize=normalize)
         self.day_transformer = DayTransformer(normalize=normalize)
         self.num_transformer = NumberTransformer(fill_value=0, normalize=normalize)
-        self.nonzeronum_transformer = NonZeroNumTransformer(fill_value=0, normalize=normalize)
         self.boolean_encoder = BooleanEncoder(normalize=normalize)
+        self.missing_indicator = MissingIndicator(normalize=normalize)
         self.target_transformer = NumberTransformer(normalize=False)
 
-    def read_records(self, filename):
-        records = []
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the state carried from one chunk of records to the next.
+        """
+        # Separate transformers so each column fills from its own values
+        self.cpi_transformer = NonZeroNumTransformer(
+            fill_value=0, normalize=self.normalize)
+        self.unemployment_transformer = NonZeroNumTransformer(
+            fill_value=0, normalize=self.normalize)
+
+    def read_field_names(self, filename):
+        """
+        Returns:
+          the fields of a file, found from their number: test or training
+          records, with or without the history features.
+        """
         with open(filename, "rb") as filehandle:
             num_fields = len(filehandle.readline().split(","))
 
-            # reset filehandle to beginning of file
-            filehandle.seek(0)
+        if num_fields not in FIELD_LAYOUTS:
+            raise ValueError(
+                "Unexpected number of fields: %d" % num_fields)
 
-            if num_fields == len(TEST_FEATURES):
-                train = False
-            elif num_fields == len(TRAIN_FEATURES):
-                train = True
-            else:
-                raise ValueError(
-                    "Unexpected number of fields: %d" % num_fields)
+        return FIELD_LAYOUTS[num_fields]
 
-            field_names = TRAIN_FEATURES if train else TEST_FEATURES
+    def read_records(self):
+        with open(self.input_filename, "rb") as filehandle:
+            return read_columns(filehandle, self.field_names)
 
-            for record in csv.DictReader(filehandle, fieldnames=field_names):
-                records.append(record)
+    def iter_records(self, chunk_size):
+        with open(self.input_filename, "rb") as filehandle:
+            for columns in iter_column_chunks(filehandle, self.field_names,
+                                              chunk_size):
+                yield columns
 
-        return records, train
+    def fit_categories(self, chunk_size=READ_CHUNK_SIZE):
+        """
+        Finds every category of the categorical features up front, so that
+        each chunk is encoded with the same columns.
+        """
+        for columns in self.iter_records(chunk_size):
+            self.categorical_transformer.fit(columns[TYPE])
 
     def extract_features(self):
+        self.reset()
+        return self.transform_columns(self.read_records())
+
+    def iter_features(self, chunk_size):
+        """
+        Yields the feature vectors of at most chunk_size records at a time.
+        Call fit_categories first so all chunks have the same columns.
+        """
+        if self.normalize:
+            raise ValueError("Normalization needs all records at once")
+
+        self.reset()
+        for columns in self.iter_records(chunk_size):
+            yield self.transform_columns(columns)
+
+    def transform_columns(self, columns):
         def get_column(column_name):
-            return [record[column_name] for record in self.records]
+            return columns[column_name]
 
         store_ids = self.num_transformer.transform(get_column(STORE_ID))
         dept_ids = self.num_transformer.transform(get_column(DEPT_ID))
@@ -93,8 +174,8 @@ class NumericalFeatureExtractor(object):
         markdown3 = self.markdown_transformer.transform(get_column(MARKDOWN3))
         markdown4 = self.markdown_transformer.transform(get_column(MARKDOWN4))
         markdown5 = self.markdown_transformer.transform(get_column(MARKDOWN5))
-        cpis = self.nonzeronum_transformer.transform(get_column(CPI))
-        unemployment = self.nonzeronum_transformer.transform(get_column(UNEMPLOYMENT))
+        cpis = self.cpi_transformer.transform(get_column(CPI))
+        unemployment = self.unemployment_transformer.transform(get_column(UNEMPLOYMENT))
         is_holiday = self.boolean_encoder.transform(get_column(IS_HOLIDAY))
 
         feature_vectors = [
@@ -113,9 +194,18 @@ class NumericalFeatureExtractor(object):
             markdown5,
             cpis,
             unemployment,
-            is_holiday
         ]
 
+        if HISTORY_FEATURES[0] in columns:
+            for field_name in HISTORY_FEATURES:
+                feature_vectors.append(
+                    self.num_transformer.transform(get_column(field_name)))
+            for field_name in HISTORY_FEATURES:
+                feature_vectors.append(
+                    self.missing_indicator.transform(get_column(field_name)))
+
+        feature_vectors.append(is_holiday)
+
         for i in xrange(types.shape[1]):
             feature_vectors.insert(2 + i, types[:, i])
 
@@ -152,32 +242,43 @@ class Transformer(object):
 
 
 class OneHotEncoder(Transformer):
-    def _transform(self, values):
-        encodings = {}
-        index = 0
+    def __init__(self, normalize=False):
+        super(OneHotEncoder, self).__init__(normalize=normalize)
+
+        # In order of first appearance
+        self.categories = []
 
-        for value in values:
-            if value not in encodings:
-                encodings[value] = index
-                index += 1
+    def fit(self, values):
+        """
+        Adds the categories which have not been seen before.
+        """
+        uniques, first_indices = np.unique(values, return_index=True)
 
-        numerical = np.zeros((len(values), index))
+        known = set(self.categories)
+        for value in uniques[np.argsort(first_indices)]:
+            if value not in known:
+                self.categories.append(value)
 
-        for i, value in enumerate(values):
-            numerical[i][encodings[value]] = 1
+        return self
+
+    def _transform(self, values):
+        values = np.asarray(values)
+        self.fit(values)
+
+        categories = np.array(self.categories)
+        order = np.argsort(categories)
+        encodings = order[np.searchsorted(categories[order], values)]
+
+        numerical = np.zeros((len(values), len(categories)))
+        numerical[np.arange(len(values)), encodings] = 1
 
         return numerical
 
 
 class MarkdownTransformer(Transformer):
     def _transform(self, values):
-        new_values = np.zeros(len(values))
-
-        for i, value in enumerate(values):
-            if value == "NA":
-                new_values[i] = 0
-            else:
-                new_values[i] = value
+        new_values, valid = parse_floats(values)
+        new_values[~valid] = 0
 
         return new_values
 
@@ -188,13 +289,8 @@ class NumberTransformer(Transformer):
         self.fill_val = fill_value
 
     def _transform(self, values):
-        new_values = np.zeros(len(values))
-
-        for i, value in enumerate(values):
-            try:
-                new_values[i] = float(value)
-            except ValueError:
-                new_values[i] = self.fill_val
+        new_values, valid = parse_floats(values)
+        new_values[~valid] = self.fill_val
 
         return new_values
 
@@ -205,15 +301,18 @@ class NonZeroNumTransformer(Transformer):
         self.fill_val = fill_value
 
     def _transform(self, values):
-        new_values = np.zeros(len(values))
-        temp = 0;
-        for i, value in enumerate(values):
-            try:
-                new_values[i] = float(value)
-                self.fill_val = float(value)
-            except ValueError:
-                #for now, need to get this on a curve.. but where to do it
-                new_values[i] = self.fill_val
+        parsed, valid = parse_floats(values)
+
+        # Missing values are filled with the last valid value before them
+        last_valid = np.where(valid, np.arange(len(parsed)), -1)
+        np.maximum.accumulate(last_valid, out=last_valid)
+
+        #for now, need to get this on a curve.. but where to do it
+        new_values = np.where(last_valid >= 0, parsed[last_valid],
+                              self.fill_val)
+
+        if valid.any():
+            self.fill_val = parsed[last_valid[-1]]
 
         return new_values
 
@@ -235,52 +334,246 @@ class DayTransformer(NumberTransformer):
 
 class BooleanEncoder(Transformer):
     def _transform(self, values):
-        new_values = np.zeros(len(values))
+        values = np.asarray(values, dtype=str)
 
-        for i, value in enumerate(values):
-            if value == "TRUE":
-                new_values[i] = 1
-            elif value == "FALSE":
-                new_values[i] = 0
-            else:
-                raise ValueError("Must be TRUE or FALSE, but was %s" % value)
+        is_true = values == "TRUE"
+        invalid = ~(is_true | (values == "FALSE"))
+        if invalid.any():
+            raise ValueError(
+                "Must be TRUE or FALSE, but was %s" % values[invalid][0])
 
-        return new_values
+        return is_true.astype(np.float64)
+
+
+class MissingIndicator(Transformer):
+    def _transform(self, values):
+        # 1 where a value is missing or could not be parsed
+        return (~parse_floats(values)[1]).astype(np.float64)
 
 
 class LogarithmicTransformer(Transformer):
     def _transform(self, values):
-        new_values = np.zeros(len(values))
+        nums = np.asarray(values, dtype=np.float64)
 
-        for i, value in enumerate(values):
-            num = float(value)
-            if num <= 0:
-                new_values[i] = 0
-            else:
-                new_values[i] = np.log2(num)
+        new_values = np.zeros(len(nums))
+
+        positive = ~(nums <= 0)
+        new_values[positive] = np.log2(nums[positive])
 
         return new_values
 
 
+def read_columns(filehandle, field_names):
+    """
+    Parses CSV records into one array per field, without building an
+    object per record.  Fields must not contain quoted commas, which holds
+    for the files written by build_full_csv.py and build_dept_csv.py.
+
+    Returns:
+      columns: dict
+        Maps each field name to a numpy array.  Fields in STRING_FEATURES
+        are string arrays, the rest are float64 arrays with NaN for
+        missing values.
+    """
+    chunks = list(iter_column_chunks(filehandle, field_names))
+
+    if len(chunks) == 1:
+        return chunks[0]
+
+    return dict((field_name,
+                 np.concatenate([chunk[field_name] for chunk in chunks]))
+                for field_name in field_names)
+
+
+def iter_column_chunks(filehandle, field_names, chunk_size=READ_CHUNK_SIZE):
+    """
+    Like read_columns, but yields the columns of at most chunk_size records
+    at a time.  At least one chunk is yielded, even for an empty file.
+    """
+    num_fields = len(field_names)
+
+    while True:
+        lines = list(itertools.islice(filehandle, chunk_size))
+
+        fields = ",".join(lines).replace("\r", "").replace("\n", "")
+        fields = fields.split(",") if fields else []
+
+        if len(fields) != len(lines) * num_fields:
+            raise ValueError("Records must all have %d fields" % num_fields)
+
+        columns = {}
+        for index, field_name in enumerate(field_names):
+            values = fields[index::num_fields]
+
+            if field_name in STRING_FEATURES:
+                columns[field_name] = np.array(values, dtype=str)
+            else:
+                columns[field_name] = parse_floats(values)[0]
+
+        yield columns
+
+        if len(lines) < chunk_size:
+            break
+
+
+def parse_floats(values):
+    """
+    Converts values to floats.
+
+    Returns:
+      floats: numpy array of float64
+      valid: numpy array of bool, False where a value is missing (NA or
+        NaN) or could not be parsed.  The corresponding floats are NaN.
+    """
+    if isinstance(values, np.ndarray) and values.dtype.kind in "biuf":
+        floats = values.astype(np.float64)
+    else:
+        if isinstance(values, np.ndarray):
+            values = values.tolist()
+
+        # Parse all the values in one pass through NumPy's C parser.  It
+        # stops at the first value it can't handle, but reads a last value
+        # such as "2x" or "2-3" as 2, so a valid value is parsed after it.
+        floats = np.fromstring((",".join(values) + ",0").replace("NA", "nan"),
+                               sep=",")
+
+        if len(floats) == len(values) + 1:
+            floats = floats[:-1]
+        else:
+            floats = np.array([parse_float(value) for value in values],
+                              dtype=np.float64)
+
+    return floats, ~np.isnan(floats)
+
+
+def parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
 def write_feature_vectors(feature_vectors, output_filename):
-    np.savetxt(output_filename, feature_vectors, delimiter=",")
+    write_features(feature_vectors, output_filename)
 
 
-def scale_data(training_data, testing_data):
-    scaler = preprocessing.StandardScaler()
+def scale_data(training_data, testing_data, scaler=None):
+    """
+    Args:
+      scaler: StandardScaler
+        If provided, a scaler fit to earlier training records, which is
+        updated with these.  Otherwise a new scaler is fit.
+    """
+    if scaler is None:
+        scaler = preprocessing.StandardScaler()
 
     # Don't scale target attribute
-    feature_data = training_data[:, :-1]
-    target_data = training_data[:, -1]
+    scaler.partial_fit(training_data[:, :-1])
+
+    return (scale(scaler, training_data, True),
+            scale(scaler, testing_data, False))
 
-    scaler.fit(feature_data)
 
-    scaled_training = scaler.transform(feature_data)
-    scaled_training = np.column_stack((scaled_training, target_data))
+def scale(scaler, data, has_target):
+    if not has_target:
+        return scaler.transform(data)
 
-    scaled_testing = scaler.transform(testing_data)
+    # Don't scale target attribute
+    return np.column_stack((scaler.transform(data[:, :-1]), data[:, -1]))
+
+
+def extract_chunked(training_filename, testing_filename,
+                    training_output_filename, testing_output_filename,
+                    chunk_size, scaler=None, categories=()):
+    """
+    Extracts, scales and writes the features chunk_size records at a time,
+    so memory use depends on the chunk size rather than on the data.
+
+    Args:
+      scaler, categories: as loaded by load_scaler, to update rather than
+        fit a new scaler.
+
+    Returns:
+      (scaler, categories) for save_scaler
+    """
+    training_extractor = NumericalFeatureExtractor(training_filename)
+    testing_extractor = NumericalFeatureExtractor(testing_filename)
+
+    # Both files must be encoded with the same columns
+    training_extractor.categorical_transformer.categories = list(categories)
+    testing_extractor.categorical_transformer = (
+        training_extractor.categorical_transformer)
+
+    print "Finding categories..."
+    training_extractor.fit_categories(chunk_size)
+    testing_extractor.fit_categories(chunk_size)
+
+    print "Computing scaling statistics..."
+    if scaler is None:
+        scaler = preprocessing.StandardScaler()
+    num_training = 0
+    for feature_vectors in training_extractor.iter_features(chunk_size):
+        scaler.partial_fit(feature_vectors[:, :-1])
+        num_training += len(feature_vectors)
+
+    print "Writing training output..."
+    write_scaled_chunks(training_extractor, scaler, training_output_filename,
+                        num_training, chunk_size)
+
+    print "Writing testing output..."
+    write_scaled_chunks(testing_extractor, scaler, testing_output_filename,
+                        count_records(testing_filename), chunk_size)
 
-    return scaled_training, scaled_testing
+    return scaler, training_extractor.categorical_transformer.categories
+
+
+def write_scaled_chunks(extractor, scaler, output_filename, num_records,
+                        chunk_size):
+    writer = FeatureWriter(output_filename, num_records)
+
+    for feature_vectors in extractor.iter_features(chunk_size):
+        writer.write(scale(scaler, feature_vectors, extractor.train))
+
+    writer.close()
+
+
+def count_records(filename):
+    with open(filename, "rb") as filehandle:
+        return sum(1 for _ in filehandle)
+
+
+def load_scaler(filename):
+    """
+    Returns:
+      scaler: the StandardScaler saved by save_scaler
+      categories: list of the store types, in the order of their one-hot
+        columns
+    """
+    with open(filename, "rb") as filehandle:
+        state = pickle.load(filehandle)
+
+    return state["scaler"], state["categories"]
+
+
+def save_scaler(filename, scaler, categories):
+    # The categories are saved as plain strings so the file loads from
+    # any script
+    with atomic_open(filename) as filehandle:
+        pickle.dump({"scaler": scaler,
+                     "categories": [str(value) for value in categories]},
+                    filehandle, pickle.HIGHEST_PROTOCOL)
+
+
+def add_scaler_arguments(parser):
+    parser.add_argument("--scaler", metavar="FILENAME",
+                        help="Save the scaler fit to the training features "
+                             "and the store type categories to this file.")
+    parser.add_argument("--update-scaler", action="store_true",
+                        help="Load the scaler and categories from --scaler, "
+                             "update them with the training records, such "
+                             "as a new week of sales, and save them again, "
+                             "instead of fitting new ones.  train_sgdr.py "
+                             "--update needs records scaled this way.")
 
 
 def main():
@@ -289,25 +582,55 @@ def main():
     parser.add_argument("testing_filename")
     parser.add_argument("training_output_filename")
     parser.add_argument("testing_output_filename")
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int,
+                        help="Process this many records at a time so that "
+                             "memory use does not grow with the data.  "
+                             "By default all records are processed at once.")
+    add_scaler_arguments(parser)
 
     args = parser.parse_args()
 
-    print "Extracting training features..."
-    training_data = NumericalFeatureExtractor(
-        args.training_filename).extract_features()
+    if args.update_scaler and args.scaler is None:
+        parser.error("--update-scaler needs --scaler")
 
-    print "Extracting testing features..."
-    testing_data = NumericalFeatureExtractor(
-        args.testing_filename).extract_features()
+    scaler = None
+    categories = []
+    if args.update_scaler:
+        scaler, categories = load_scaler(args.scaler)
 
-    print "Scaling..."
-    scaled_training, scaled_testing = scale_data(training_data, testing_data)
+    if args.chunk_size:
+        scaler, categories = extract_chunked(
+            args.training_filename, args.testing_filename,
+            args.training_output_filename, args.testing_output_filename,
+            args.chunk_size, scaler=scaler, categories=categories)
+    else:
+        training_extractor = NumericalFeatureExtractor(args.training_filename)
+        testing_extractor = NumericalFeatureExtractor(args.testing_filename)
+        for extractor in (training_extractor, testing_extractor):
+            extractor.categorical_transformer.categories = list(categories)
 
-    print "Writing training output..."
-    write_feature_vectors(scaled_training, args.training_output_filename)
+        print "Extracting training features..."
+        training_data = training_extractor.extract_features()
 
-    print "Writing testing output..."
-    write_feature_vectors(scaled_testing, args.testing_output_filename)
+        print "Extracting testing features..."
+        testing_data = testing_extractor.extract_features()
+
+        print "Scaling..."
+        if scaler is None:
+            scaler = preprocessing.StandardScaler()
+        scaled_training, scaled_testing = scale_data(training_data,
+                                                     testing_data, scaler)
+
+        print "Writing training output..."
+        write_feature_vectors(scaled_training, args.training_output_filename)
+
+        print "Writing testing output..."
+        write_feature_vectors(scaled_testing, args.testing_output_filename)
+
+        categories = training_extractor.categorical_transformer.categories
+
+    if args.scaler is not None:
+        save_scaler(args.scaler, scaler, categories)
 
 
 if __name__ == "__main__":
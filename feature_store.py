@@ -0,0 +1,97 @@
+"""
+Reads and writes numerical feature matrices.
+
+Matrices are stored in NumPy's binary .npy format, which records the dtype
+and shape in its header and loads at close to the speed of a memory copy.
+Filenames with any other extension are written as CSV text instead, which
+is kept for inspecting the data and for exporting it to other tools.
+"""
+
+import os
+
+import numpy as np
+
+
+BINARY_EXTENSION = ".npy"
+
+
+def is_binary(filename):
+    return os.path.splitext(filename)[1] == BINARY_EXTENSION
+
+
+def write_features(feature_vectors, filename):
+    if is_binary(filename):
+        np.save(filename, np.asarray(feature_vectors, dtype=np.float64))
+    else:
+        np.savetxt(filename, feature_vectors, delimiter=",")
+
+
+class FeatureWriter(object):
+    """
+    Writes a feature matrix a block of rows at a time.  The number of rows
+    is needed up front to size binary files.
+    """
+    def __init__(self, filename, num_rows):
+        self.filename = filename
+        self.num_rows = num_rows
+
+        self.row = 0
+        self.data = None
+        self.filehandle = None
+
+        if not is_binary(filename):
+            self.filehandle = open(filename, "wb")
+
+    def write(self, feature_vectors):
+        if self.filehandle is not None:
+            np.savetxt(self.filehandle, feature_vectors, delimiter=",")
+        else:
+            if self.data is None:
+                self.data = np.lib.format.open_memmap(
+                    self.filename, mode="w+", dtype=np.float64,
+                    shape=(self.num_rows, feature_vectors.shape[1]))
+
+            self.data[self.row:self.row + len(feature_vectors)] = (
+                feature_vectors)
+
+        self.row += len(feature_vectors)
+
+    def close(self):
+        if self.row != self.num_rows:
+            raise ValueError("Expected %d rows but %d were written" % (
+                self.num_rows, self.row))
+
+        if self.filehandle is not None:
+            self.filehandle.close()
+        elif self.data is not None:
+            self.data.flush()
+            self.data = None
+        else:
+            write_features(np.zeros((0, 0)), self.filename)
+
+
+def load_features(filename, mmap=False):
+    """
+    Args:
+      filename: str
+      mmap: bool
+        If True the matrix is opened as a read-only memory map instead of
+        being read into memory, so processes loading the same file share
+        its pages through the OS page cache.  Only binary files can be
+        memory-mapped.
+
+    Returns:
+      data: 2-D numpy array, even when the file holds a single record.
+    """
+    if is_binary(filename):
+        data = np.load(filename, mmap_mode="r" if mmap else None)
+    elif mmap:
+        raise ValueError("Only %s files can be memory-mapped: %s" % (
+            BINARY_EXTENSION, filename))
+    else:
+        data = np.loadtxt(filename, delimiter=",")
+
+    if data.ndim == 1:
+        data = data.reshape((1, -1))
+
+    return data
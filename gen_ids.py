@@ -7,38 +7,67 @@ Generates IDs for the records in the format required by Kaggle.
 import argparse
 import os
 
+import numpy as np
 
-def generate_id(record):
-    return (record[0] + "_" + record[1] + "_" +
-            record[4] + "-" + record[5].zfill(2) + "-" + record[6].zfill(2))
+import submission
+
+
+# Fields of the store, department, year, month and day in the CSV files
+ID_FIELDS = (0, 1, 4, 5, 6)
 
 
 def generate_ids(features_filename):
     with open(features_filename, "rb") as filehandle:
-        return [generate_id(line.split(",")) for line in filehandle]
+        lines = filehandle.read().splitlines()
+
+    if not lines:
+        return np.array([], dtype=str)
+
+    num_fields = len(lines[0].split(","))
+    fields = ",".join(lines).split(",")
+    if len(fields) != len(lines) * num_fields:
+        raise ValueError("Records must all have %d fields" % num_fields)
+
+    return submission.generate_ids(*[
+        np.fromstring(",".join(fields[index::num_fields]), dtype=np.int64,
+                      sep=",")
+        for index in ID_FIELDS])
 
 
 def write_ids(output_filename, ids):
     with open(output_filename, "wb") as filehandle:
-        for id_ in ids:
-            filehandle.write(id_ + "\n")
+        filehandle.write("".join(id_ + "\n"
+                                 for id_ in np.asarray(ids).tolist()))
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("features_filename",
+    parser.add_argument("features_filename", nargs="?",
                         help="The CSV file with unprocessed features.")
     parser.add_argument("-o", dest="output_filename",
                         help="The file to output IDs to.")
+    parser.add_argument("--dbname",
+                        help="Read the records of the SalesTest table of "
+                             "this database instead of a CSV file.")
 
     args = parser.parse_args()
 
-    if args.output_filename is None:
+    if (args.features_filename is None) == (args.dbname is None):
+        parser.error("Give either features_filename or --dbname")
+
+    if args.output_filename is not None:
+        output_filename = args.output_filename
+    elif args.dbname is not None:
+        output_filename = "test.ids"
+    else:
         output_filename = os.path.splitext(args.features_filename)[0] + ".ids"
+
+    if args.dbname is not None:
+        ids = submission.read_test_ids(args.dbname)
     else:
-        output_filename = args.output_filename
+        ids = generate_ids(args.features_filename)
 
-    write_ids(output_filename, generate_ids(args.features_filename))
+    write_ids(output_filename, ids)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+"""
+Features computed from the sales history of each store and department.
+
+For a record of week w these are:
+  lag_K: the sales of week w - K, for each K in the lags.
+  rolling_mean_W, rolling_std_W: the mean and standard deviation of the
+    sales of the W weeks before w, for each W in the windows.
+  yoy: the sales of the same week last year.  Holiday weeks are aligned to
+    last year's week of the same holiday, i.e. its holiday week in the same
+    month, which need not be exactly 52 weeks earlier.  Other weeks use 52.
+
+Only weeks before w are used, so training records never see their own
+target.  Values that cannot be computed, such as lags into weeks without
+sales, are NaN.  Lags and windows shorter than the forecast horizon are
+mostly missing for test records, whose recent weeks have no sales yet, so
+the default lag is the 39 weeks of the test set and there are no rolling
+windows by default.
+
+Weeks are numbered by their ordinal since the epoch, so gaps in the sales of
+a department do not shift the lags.  The history is kept as one array of
+sales sorted by (store, department, week), and every feature is found with
+np.searchsorted and differences of cumulative sums, without a loop over
+records or departments.
+"""
+
+import numpy as np
+
+
+# Weeks from the last known sales to the last test week
+FORECAST_HORIZON = 39
+
+DEFAULT_LAGS = (FORECAST_HORIZON,)
+
+DEFAULT_WINDOWS = ()
+
+WEEKS_PER_YEAR = 52
+
+# Bits of a history code holding the week and the department
+WEEK_BITS = 24
+DEPT_BITS = 20
+
+
+def week_ordinals(years, months, days):
+    """
+    Returns:
+      numpy array of int64, the number of the week since the epoch of each
+        date.  Dates a week apart are numbered one apart.
+    """
+    dates = dates_to_days(years, months, days)
+    return dates // 7
+
+
+def dates_to_days(years, months, days):
+    dates = (np.asarray(years, dtype=np.int64) - 1970).astype("M8[Y]")
+    dates = dates + (np.asarray(months, dtype=np.int64) - 1).astype("m8[M]")
+    dates = dates + (np.asarray(days, dtype=np.int64) - 1).astype("m8[D]")
+
+    return dates.astype("M8[D]").astype(np.int64)
+
+
+def encode(store_ids, dept_ids, weeks):
+    return ((np.asarray(store_ids, dtype=np.int64) <<
+             (DEPT_BITS + WEEK_BITS)) +
+            (np.asarray(dept_ids, dtype=np.int64) << WEEK_BITS) +
+            np.asarray(weeks, dtype=np.int64))
+
+
+def feature_names(lags=DEFAULT_LAGS, windows=DEFAULT_WINDOWS):
+    names = ["lag_%d" % lag for lag in lags]
+    for window in windows:
+        names += ["rolling_mean_%d" % window, "rolling_std_%d" % window]
+
+    return names + ["yoy"]
+
+
+class SalesHistory(object):
+    def __init__(self, store_ids, dept_ids, weeks, weekly_sales,
+                 holiday_weeks=()):
+        """
+        Args:
+          store_ids, dept_ids, weeks, weekly_sales: 1-D numpy arrays, the
+            known sales, in any order.  Weeks are from week_ordinals.
+          holiday_weeks: the week ordinals of the holidays
+        """
+        self.codes = np.zeros(0, dtype=np.int64)
+        self.sales = np.zeros(0)
+        self.set_holidays(holiday_weeks)
+
+        self.add(store_ids, dept_ids, weeks, weekly_sales)
+
+    def set_holidays(self, holiday_weeks):
+        self.holiday_weeks = np.unique(np.asarray(holiday_weeks,
+                                                  dtype=np.int64))
+
+        # Months since the epoch of the middle day of each holiday week, to
+        # pair each holiday with last year's
+        holiday_days = (self.holiday_weeks * 7 + 3).astype("M8[D]")
+        holiday_months = holiday_days.astype("M8[M]").astype(np.int64)
+
+        # Weeks back to the same holiday last year
+        self.holiday_shifts = np.repeat(WEEKS_PER_YEAR,
+                                        len(self.holiday_weeks))
+        for i, month in enumerate(holiday_months):
+            previous = np.flatnonzero(holiday_months == month - 12)
+            if len(previous):
+                self.holiday_shifts[i] = (self.holiday_weeks[i] -
+                                          self.holiday_weeks[previous[-1]])
+
+    def add(self, store_ids, dept_ids, weeks, weekly_sales):
+        """
+        Adds the sales of new weeks, replacing any known sales of the same
+        store, department and week.  Only the new records are sorted; they
+        are merged into the history in linear time.
+        """
+        codes = encode(store_ids, dept_ids, weeks)
+        sales = np.asarray(weekly_sales, dtype=np.float64)
+
+        order = np.argsort(codes, kind="mergesort")
+        codes = codes[order]
+        sales = sales[order]
+
+        # Keep the last of the new sales of any one week
+        last = np.concatenate((codes[1:] != codes[:-1], [True]))
+        codes = codes[last]
+        sales = sales[last]
+
+        positions = np.searchsorted(self.codes, codes)
+        known = positions < len(self.codes)
+        known[known] = self.codes[positions[known]] == codes[known]
+
+        self.sales[positions[known]] = sales[known]
+
+        self.codes = np.insert(self.codes, positions[~known], codes[~known])
+        self.sales = np.insert(self.sales, positions[~known], sales[~known])
+
+        self.update_sums()
+
+    def update_sums(self):
+        # Sales are centered on the mean of their department before they
+        # are squared, which keeps the cumulative sums of squares small
+        # enough for the variance of small departments to be accurate.
+        self.centers = np.zeros(len(self.codes))
+
+        if len(self.codes):
+            departments = self.codes >> WEEK_BITS
+            starts = np.flatnonzero(np.concatenate((
+                [True], departments[1:] != departments[:-1])))
+            counts = np.diff(np.concatenate((starts, [len(self.codes)])))
+
+            means = np.add.reduceat(self.sales, starts) / counts
+            self.centers = np.repeat(means, counts)
+
+        centered = self.sales - self.centers
+
+        self.sums = np.concatenate(([0], np.cumsum(centered)))
+        self.squares = np.concatenate(([0], np.cumsum(centered ** 2)))
+
+    def lag(self, store_ids, dept_ids, weeks, lag):
+        """
+        Returns:
+          numpy array of the sales lag weeks before each week, or NaN where
+            they are not known.
+        """
+        return self.lookup(encode(store_ids, dept_ids,
+                                  np.asarray(weeks) - lag))
+
+    def lookup(self, codes):
+        positions = np.minimum(np.searchsorted(self.codes, codes),
+                               max(0, len(self.codes) - 1))
+
+        values = np.repeat(np.nan, len(codes))
+        if len(self.codes):
+            found = self.codes[positions] == codes
+            values[found] = self.sales[positions[found]]
+
+        return values
+
+    def rolling(self, store_ids, dept_ids, weeks, window):
+        """
+        Returns:
+          (means, stds) of the known sales of the window weeks before each
+            week, NaN where none of them are known.
+        """
+        weeks = np.asarray(weeks, dtype=np.int64)
+        stops = np.searchsorted(self.codes, encode(store_ids, dept_ids,
+                                                   weeks))
+        starts = np.searchsorted(self.codes, encode(store_ids, dept_ids,
+                                                    weeks - window))
+        counts = stops - starts
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = (self.sums[stops] - self.sums[starts]) / counts
+            variances = (self.squares[stops] - self.squares[starts]) / counts
+            variances = np.maximum(variances - means ** 2, 0)
+
+        # Undo the centering; any row of the department has its center
+        has_sales = counts > 0
+        means[has_sales] += self.centers[starts[has_sales]]
+
+        means[~has_sales] = np.nan
+        stds = np.sqrt(variances)
+        stds[~has_sales] = np.nan
+
+        return means, stds
+
+    def year_over_year(self, store_ids, dept_ids, weeks):
+        weeks = np.asarray(weeks, dtype=np.int64)
+
+        shifts = np.repeat(WEEKS_PER_YEAR, len(weeks))
+        if len(self.holiday_weeks):
+            positions = np.minimum(
+                np.searchsorted(self.holiday_weeks, weeks),
+                len(self.holiday_weeks) - 1)
+            is_holiday = self.holiday_weeks[positions] == weeks
+            shifts[is_holiday] = self.holiday_shifts[positions[is_holiday]]
+
+        return self.lookup(encode(store_ids, dept_ids, weeks - shifts))
+
+    def features(self, store_ids, dept_ids, weeks, lags=DEFAULT_LAGS,
+                 windows=DEFAULT_WINDOWS):
+        """
+        Returns:
+          2-D numpy array with the columns of feature_names(lags, windows)
+        """
+        columns = [self.lag(store_ids, dept_ids, weeks, lag) for lag in lags]
+        for window in windows:
+            columns.extend(self.rolling(store_ids, dept_ids, weeks, window))
+        columns.append(self.year_over_year(store_ids, dept_ids, weeks))
+
+        return np.column_stack(columns)
@@ -0,0 +1,257 @@
+"""
+Vectorized prediction for per-department linear models.
+
+A CompositePredictor holds one StandardScaler and one regressor per
+department, and predicting with it costs a few Python calls for every
+department.  For linear regressors the fitted models are just arrays, so
+LinearInferenceEngine stacks every department's scaler mean and scale and
+regressor coefficients and intercept into one matrix each.  Every record is
+then scored in a single pass, whichever department it belongs to.
+
+The engine is saved as a NumPy .npz archive of those arrays, which loads
+without sklearn and without unpickling thousands of sklearn objects.
+load_model and load_engine read either kind of model file.
+"""
+
+import cPickle as pickle
+import os
+import sys
+
+import numpy as np
+
+from atomic_file import atomic_open
+from submission import generate_ids
+
+
+ARCHIVE_EXTENSION = ".npz"
+
+# Stands for any department of a store in the keys of LinearInferenceEngine,
+# for departments the model has never seen.
+ANY_DEPT = -1
+
+
+class LinearInferenceEngine(object):
+    def __init__(self, keys, rows, means, scales, coefs, intercepts,
+                 default_row=-1):
+        """
+        Args:
+          keys: list of (store_id, dept_id)
+            dept_id may be ANY_DEPT, to give the model of departments of the
+            store that are not listed.
+          rows: 1-D numpy array, the model row of each key.  Departments
+            that fall back to a model shared with others map to its row.
+          means, scales, coefs: 2-D numpy arrays, (num_models, num_features)
+          intercepts: 1-D numpy array, (num_models,)
+          default_row: int
+            The model row of keys not listed, or -1 to predict 0 for them.
+        """
+        self.keys = list(keys)
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.means = means
+        self.scales = scales
+        self.coefs = coefs
+        self.intercepts = intercepts
+        self.default_row = default_row
+
+        codes = encode_keys(np.array([key[0] for key in self.keys]),
+                            np.array([key[1] for key in self.keys]))
+        self.code_order = np.argsort(codes)
+        self.sorted_codes = codes[self.code_order]
+
+    @staticmethod
+    def supports(model):
+        """
+        Returns True if every model of a CompositePredictor, including its
+        fallback models, is linear, i.e. has coef_ and intercept_
+        attributes.
+        """
+        predictors = (model.predictors.values() +
+                      model.fallback_predictors.values())
+
+        return all(hasattr(predictor, "coef_") and
+                   hasattr(predictor, "intercept_")
+                   for predictor in predictors)
+
+    @classmethod
+    def from_composite(cls, model):
+        """
+        Departments outside the model's precomputed fallback table use the
+        global fallback model, if there is one.
+        """
+        if not cls.supports(model):
+            raise ValueError("Model has non-linear department models")
+
+        dept_keys = sorted(model.predictors)
+        fallback_keys = sorted(model.fallback_predictors)
+
+        scalers = ([model.scalers[key] for key in dept_keys] +
+                   [model.fallback_scalers[key] for key in fallback_keys])
+        predictors = (
+            [model.predictors[key] for key in dept_keys] +
+            [model.fallback_predictors[key] for key in fallback_keys])
+
+        fallback_rows = dict((fallback, len(dept_keys) + i)
+                             for i, fallback in enumerate(fallback_keys))
+
+        fallbacks = sorted(model.fallbacks.iteritems())
+
+        store_ids = sorted(set(store_id for store_id, _ in
+                               dept_keys + model.fallbacks.keys()))
+        for store_id in store_ids:
+            fallback = model.find_fallback(store_id, None)
+            if fallback is not None:
+                fallbacks.append(((store_id, ANY_DEPT), fallback))
+
+        keys = dept_keys + [key for key, _ in fallbacks]
+        rows = range(len(dept_keys)) + [fallback_rows[fallback]
+                                        for _, fallback in fallbacks]
+
+        # The fallback of a store and department the model knows nothing of
+        default = model.find_fallback(None, None)
+
+        return cls(
+            keys,
+            rows,
+            np.array([scaler.mean_ for scaler in scalers]),
+            np.array([scaler.scale_ for scaler in scalers]),
+            np.array([np.ravel(predictor.coef_) for predictor in predictors]),
+            np.array([np.ravel(predictor.intercept_)[0]
+                      for predictor in predictors]),
+            default_row=fallback_rows.get(default, -1))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as archive:
+            keys = zip(archive["store_ids"].tolist(),
+                       archive["dept_ids"].tolist())
+
+            return cls(keys, archive["rows"], archive["means"],
+                       archive["scales"], archive["coefs"],
+                       archive["intercepts"],
+                       default_row=int(archive["default_row"]))
+
+    def save(self, filename):
+        with atomic_open(filename) as filehandle:
+            np.savez(filehandle,
+                     store_ids=np.array([key[0] for key in self.keys],
+                                        dtype=np.int64),
+                     dept_ids=np.array([key[1] for key in self.keys],
+                                       dtype=np.int64),
+                     rows=self.rows,
+                     means=self.means,
+                     scales=self.scales,
+                     coefs=self.coefs,
+                     intercepts=self.intercepts,
+                     default_row=self.default_row)
+
+    def lookup(self, store_ids, dept_ids):
+        """
+        Returns:
+          rows: 1-D numpy array of the model row of each record, or -1 for
+            records that are predicted as 0.
+        """
+        store_ids = np.asarray(store_ids)
+
+        found, rows = self.search(encode_keys(store_ids, dept_ids))
+
+        if not found.all():
+            missing = ~found
+            store_found, store_rows = self.search(
+                encode_keys(store_ids[missing], ANY_DEPT))
+            rows[missing] = np.where(store_found, store_rows,
+                                     self.default_row)
+
+        return rows
+
+    def search(self, codes):
+        """
+        Returns:
+          (found, rows)
+            Whether each key code is listed, and its model row if it is.
+        """
+        if len(self.sorted_codes) == 0:
+            return (np.zeros(len(codes), dtype=bool),
+                    np.zeros(len(codes), dtype=np.int64))
+
+        positions = np.searchsorted(self.sorted_codes, codes)
+        positions = np.minimum(positions, len(self.sorted_codes) - 1)
+        found = self.sorted_codes[positions] == codes
+
+        return found, self.rows[self.code_order[positions]]
+
+    def predict(self, store_ids, dept_ids, data):
+        """
+        Args:
+          store_ids, dept_ids: 1-D numpy arrays
+          data: 2-D numpy array of feature vectors, starting with the year,
+            month and day.
+
+        Returns:
+          (ids, predictions)
+        """
+        rows = self.lookup(store_ids, dept_ids)
+        found = rows >= 0
+        rows = rows[found]
+
+        scaled_data = (data[found] - self.means[rows]) / self.scales[rows]
+
+        predictions = np.zeros(len(data))
+        predictions[found] = (
+            np.einsum("ij,ij->i", scaled_data, self.coefs[rows]) +
+            self.intercepts[rows])
+
+        ids = generate_ids(store_ids, dept_ids,
+                           data[:, 0], data[:, 1], data[:, 2])
+
+        return ids, predictions
+
+
+def is_archive(filename):
+    return os.path.splitext(filename)[1] == ARCHIVE_EXTENSION
+
+
+def load_model(model_filename):
+    """
+    Returns:
+      a LinearInferenceEngine for a model archive, and otherwise the
+        unpickled model, usually a CompositePredictor.  sklearn is only
+        imported for pickled models.
+    """
+    if is_archive(model_filename):
+        return LinearInferenceEngine.load(model_filename)
+
+    with open(model_filename, "rb") as filehandle:
+        unpickler = pickle.Unpickler(filehandle)
+        unpickler.find_global = find_class
+
+        return unpickler.load()
+
+
+def load_engine(model_filename):
+    """
+    Returns:
+      LinearInferenceEngine, from a model archive or a pickled model with
+        only linear department models.
+    """
+    model = load_model(model_filename)
+
+    if isinstance(model, LinearInferenceEngine):
+        return model
+
+    return LinearInferenceEngine.from_composite(model)
+
+
+def find_class(module_name, name):
+    # Models pickled by running train_per_dept.py refer to its classes as
+    # those of __main__
+    if module_name == "__main__" and name == "CompositePredictor":
+        from train_per_dept import CompositePredictor
+        return CompositePredictor
+
+    __import__(module_name)
+    return getattr(sys.modules[module_name], name)
+
+
+def encode_keys(store_ids, dept_ids):
+    return ((np.asarray(store_ids, dtype=np.int64) << 32) +
+            np.asarray(dept_ids, dtype=np.int64))
@@ -6,17 +6,10 @@ Examine feature weights in models.
 
 import argparse
 import collections
-import pickle
 
 import matplotlib.pyplot as plt
 
-# Must be in namespace when loading pickled predictor
-from train_per_dept import CompositePredictor
-
-
-def load_model(model_filename):
-    with open(model_filename, "rb") as filehandle:
-        return pickle.load(filehandle)
+from linear_inference import load_engine
 
 
 def mean(values):
@@ -25,15 +18,15 @@ def mean(values):
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("model_filename", help="the pickled model.")
+    parser.add_argument("model_filename",
+                        help="the pickled model, or a .npz model archive.")
 
     args = parser.parse_args()
 
     coefficients = collections.defaultdict(list)
 
-    model = load_model(args.model_filename)
-    for department_model in model.predictors.values():
-        coef_ = department_model.coef_
+    model = load_engine(args.model_filename)
+    for coef_ in model.coefs:
         for i in xrange(coef_.shape[0]):
             coefficients[i].append(coef_[i])
 
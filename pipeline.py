@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+
+"""
+Runs the preprocessing, training and prediction scripts as a graph of
+stages, rerunning only the stages whose results are out of date.
+
+Each stage is keyed by a hash of its command, the contents of its input
+files and the code of its script and the local modules it imports.  The key
+and a hash of each output are recorded in STATE_DIR when the stage
+succeeds.  A stage is rerun only if its key changed or its outputs were
+changed or removed since, so editing train_sgdr.py retrains and predicts
+without rebuilding the database or the features.  Stages whose inputs are
+ready run concurrently.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from atomic_file import atomic_open
+
+
+STATE_DIR = ".pipeline"
+
+HASH_CHUNK_SIZE = 1 << 20
+
+IMPORT_RE = re.compile(r"^\s*(?:from|import)\s+(\w+)", re.MULTILINE)
+
+
+class Stage(object):
+    def __init__(self, name, command, inputs=(), outputs=()):
+        """
+        Args:
+          name: str
+          command: list of str, the script to run and its arguments
+          inputs: list of files or directories read by the command
+          outputs: list of files or directories written by the command
+        """
+        self.name = name
+        self.command = command
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+
+def full_pipeline(data_dir, alg):
+    """
+    The stages of preprocess.sh, followed by training and prediction.  The
+    features and the ids are read straight from the database, so no CSV
+    file is built.
+    """
+    train_script = {
+        "sgdr": "./train_sgdr.py",
+        "svr": "./train_svr.py",
+        "bayes": "./train_bayridge.py",
+        "elastic": "./train_elasticnet.py",
+    }[alg]
+    model = alg + ".model"
+
+    return [
+        Stage("db", ["./build_db.py", "--incremental", data_dir],
+              inputs=[data_dir], outputs=["sales.db"]),
+        Stage("ids", ["./gen_ids.py", "--dbname", "sales.db", "-o",
+                      "test.ids"],
+              inputs=["sales.db"], outputs=["test.ids"]),
+        Stage("features", ["./extract_db_features.py", "--scaler",
+                           "scaler.pickle", "sales.db", "train.num.npy",
+                           "test.num.npy"],
+              inputs=["sales.db"],
+              outputs=["train.num.npy", "test.num.npy", "scaler.pickle"]),
+        Stage("train", [train_script, "train.num.npy", model],
+              inputs=["train.num.npy"], outputs=[model]),
+        Stage("predict", ["./predict.py", model, "test.num.npy", "test.ids",
+                          "predictions.csv"],
+              inputs=[model, "test.num.npy", "test.ids"],
+              outputs=["predictions.csv"]),
+    ]
+
+
+def dept_pipeline(data_dir, alg):
+    """
+    The stages of preprocess_dept.sh, followed by prediction.
+    """
+    # Support vector models cannot be saved as linear archives
+    model = "pd.model" if alg == "svr" else "pd.npz"
+
+    return [
+        Stage("db", ["./build_db.py", "--incremental", data_dir],
+              inputs=[data_dir], outputs=["sales.db"]),
+        Stage("train_csv", ["./build_full_csv.py", "--o", "train_full.csv",
+                            "sales.db"],
+              inputs=["sales.db"], outputs=["train_full.csv"]),
+        Stage("test_csv", ["./build_full_csv.py", "--test", "--o",
+                           "test_full.csv", "sales.db"],
+              inputs=["sales.db"], outputs=["test_full.csv"]),
+        Stage("train_features", ["./extract_dept_features.py", "--pack",
+                                 "train_dept.npy", "train_full.csv"],
+              inputs=["train_full.csv"], outputs=["train_dept.npy"]),
+        Stage("test_features", ["./extract_dept_features.py", "--pack",
+                                "test_dept.npy", "test_full.csv"],
+              inputs=["test_full.csv"], outputs=["test_dept.npy"]),
+        Stage("train", ["./train_per_dept.py", "--alg", alg, "--dbname",
+                        "sales.db", "train_dept.npy", model],
+              inputs=["train_dept.npy", "sales.db"], outputs=[model]),
+        Stage("predict", ["./predict_per_dept.py", model, "test_dept.npy",
+                          "predictions_dept.csv"],
+              inputs=[model, "test_dept.npy"],
+              outputs=["predictions_dept.csv"]),
+    ]
+
+
+class FileHasher(object):
+    """
+    Hashes file contents, remembering the hash of each file by its size
+    and modification time so unchanged files are not read again.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+        try:
+            with open(filename, "rb") as filehandle:
+                self.known = json.load(filehandle)
+        except IOError:
+            self.known = {}
+
+    def hash_path(self, path):
+        """
+        Returns:
+          str, the hash of a file or of every file in a directory, or None
+            if the path does not exist.
+        """
+        if os.path.isdir(path):
+            digest = hashlib.sha1()
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    full_path = os.path.join(dirpath, filename)
+                    digest.update(os.path.relpath(full_path, path))
+                    digest.update(self.hash_file(full_path))
+            return digest.hexdigest()
+        elif os.path.exists(path):
+            return self.hash_file(path)
+
+        return None
+
+    def hash_file(self, path):
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime]
+
+        with self.lock:
+            known = self.known.get(path)
+        if known is not None and known[0] == signature:
+            return known[1]
+
+        digest = hashlib.sha1()
+        with open(path, "rb") as filehandle:
+            for chunk in iter(lambda: filehandle.read(HASH_CHUNK_SIZE), ""):
+                digest.update(chunk)
+
+        with self.lock:
+            self.known[path] = [signature, digest.hexdigest()]
+
+        return digest.hexdigest()
+
+    def save(self):
+        with self.lock:
+            with atomic_open(self.filename) as filehandle:
+                json.dump(self.known, filehandle)
+
+
+def code_files(script):
+    """
+    Returns:
+      sorted list of a script and the local modules it imports, directly
+      or through other local modules.
+    """
+    directory = os.path.dirname(os.path.abspath(script))
+
+    found = set()
+    pending = [os.path.normpath(script)]
+    while pending:
+        path = pending.pop()
+        if path in found:
+            continue
+        found.add(path)
+
+        with open(path, "rb") as filehandle:
+            source = filehandle.read()
+
+        for module in IMPORT_RE.findall(source):
+            module_path = os.path.join(directory, module + ".py")
+            if os.path.exists(module_path):
+                pending.append(os.path.relpath(module_path))
+
+    return sorted(found)
+
+
+class Pipeline(object):
+    def __init__(self, stages, state_dir=STATE_DIR):
+        self.stages = dict((stage.name, stage) for stage in stages)
+        self.order = [stage.name for stage in stages]
+        self.state_dir = state_dir
+
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+
+        self.hasher = FileHasher(os.path.join(state_dir, "hashes.json"))
+
+        producers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                producers[output] = stage.name
+
+        # Names of the stages producing the inputs of each stage
+        self.dependencies = dict(
+            (stage.name, sorted(set(producers[path]
+                                    for path in stage.inputs
+                                    if path in producers) - {stage.name}))
+            for stage in stages)
+
+    def required(self, targets):
+        """
+        Returns:
+          set of the names of the targets and the stages they depend on.
+        """
+        required = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in required:
+                required.add(name)
+                pending.extend(self.dependencies[name])
+
+        return required
+
+    def stage_key(self, stage):
+        digest = hashlib.sha1()
+        digest.update(json.dumps(stage.command))
+
+        for path in stage.inputs:
+            digest.update(json.dumps([path, self.hasher.hash_path(path)]))
+
+        scripts = [arg for arg in stage.command
+                   if arg.endswith(".py") and os.path.isfile(arg)]
+        for script in scripts:
+            for path in code_files(script):
+                digest.update(json.dumps([path, self.hasher.hash_file(path)]))
+
+        return digest.hexdigest()
+
+    def state_filename(self, stage):
+        return os.path.join(self.state_dir, stage.name + ".json")
+
+    def is_up_to_date(self, stage, key):
+        try:
+            with open(self.state_filename(stage), "rb") as filehandle:
+                state = json.load(filehandle)
+        except IOError:
+            return False
+
+        return (state["key"] == key and
+                all(self.hasher.hash_path(path) == state["outputs"].get(path)
+                    for path in stage.outputs))
+
+    def record(self, stage, key):
+        state = {
+            "key": key,
+            "outputs": dict((path, self.hasher.hash_path(path))
+                            for path in stage.outputs)
+        }
+
+        with atomic_open(self.state_filename(stage)) as filehandle:
+            json.dump(state, filehandle)
+
+    def run_stage(self, stage, force):
+        """
+        Returns:
+          True if the stage ran or was up to date, False if it failed.
+        """
+        key = self.stage_key(stage)
+
+        if not force and self.is_up_to_date(stage, key):
+            log("%s is up to date" % stage.name)
+            return True
+
+        log("Running %s: %s" % (stage.name, " ".join(stage.command)))
+        start = time.time()
+
+        if subprocess.call(stage.command) != 0:
+            log("%s failed" % stage.name)
+            return False
+
+        missing = [path for path in stage.outputs if not os.path.exists(path)]
+        if missing:
+            log("%s did not write %s" % (stage.name, ", ".join(missing)))
+            return False
+
+        self.record(stage, key)
+        log("%s finished in %.1fs" % (stage.name, time.time() - start))
+
+        return True
+
+    def run(self, targets=None, jobs=1, force=()):
+        """
+        Runs the targets, by default every stage, after the stages they
+        depend on.  At most jobs stages run at once.
+
+        Args:
+          force: names of stages to rerun even if they are up to date
+
+        Returns:
+          True if every stage succeeded.
+        """
+        pending = self.required(targets or self.order)
+        done = set()
+        running = set()
+        failed = []
+
+        condition = threading.Condition()
+
+        def run_in_thread(stage):
+            succeeded = self.run_stage(stage, stage.name in force)
+
+            with condition:
+                running.discard(stage.name)
+                if succeeded:
+                    done.add(stage.name)
+                else:
+                    failed.append(stage.name)
+                condition.notify()
+
+        with condition:
+            while pending or running:
+                if not failed:
+                    ready = [name for name in self.order
+                             if name in pending and
+                             all(dependency in done for dependency
+                                 in self.dependencies[name])]
+
+                    for name in ready[:max(0, jobs - len(running))]:
+                        pending.discard(name)
+                        running.add(name)
+
+                        thread = threading.Thread(
+                            target=run_in_thread, args=(self.stages[name],))
+                        thread.daemon = True
+                        thread.start()
+
+                if not running:
+                    break
+
+                # A timeout keeps the wait interruptible
+                condition.wait(1)
+
+        self.hasher.save()
+
+        return not failed and not pending
+
+
+def log(message):
+    sys.stderr.write("[pipeline] %s\n" % message)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("targets", nargs="*",
+                        help="Stages to bring up to date, with the stages "
+                             "they depend on.  Defaults to every stage.")
+    parser.add_argument("--dept", action="store_true",
+                        help="Run the per-department pipeline.")
+    parser.add_argument("--data-dir", default="data/",
+                        help="Directory containing the data.")
+    parser.add_argument("--alg", choices=["sgdr", "svr", "bayes", "elastic"],
+                        default="sgdr",
+                        help="The algorithm of the train stage.")
+    parser.add_argument("--jobs", type=int, default=2,
+                        help="Number of stages run at once.")
+    parser.add_argument("--force", action="append", default=[],
+                        metavar="STAGE",
+                        help="Rerun a stage even if it is up to date.  May "
+                             "be repeated.")
+    parser.add_argument("--list", action="store_true",
+                        help="List the stages and exit.")
+
+    args = parser.parse_args()
+
+    if args.dept:
+        stages = dept_pipeline(args.data_dir, args.alg)
+        state_dir = os.path.join(STATE_DIR, "dept")
+    else:
+        stages = full_pipeline(args.data_dir, args.alg)
+        state_dir = STATE_DIR
+
+    pipeline = Pipeline(stages, state_dir=state_dir)
+
+    if args.list:
+        for stage in stages:
+            print "%s\t%s" % (stage.name, " ".join(stage.command))
+        return
+
+    for name in args.targets + args.force:
+        if name not in pipeline.stages:
+            parser.error("Unknown stage: %s" % name)
+
+    if not pipeline.run(args.targets, jobs=args.jobs, force=args.force):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,8 @@ Plots each feature.
 import argparse
 
 import matplotlib.pyplot as plt
-import numpy as np
+
+from feature_store import load_features
 
 
 def plot(values):
@@ -24,7 +25,7 @@ def main():
 
     args = parser.parse_args()
 
-    data = np.loadtxt(args.filename, delimiter=",")
+    data = load_features(args.filename)
 
     for col_index in xrange(data.shape[1]):
         plot(data[:, col_index])
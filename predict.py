@@ -7,7 +7,8 @@ Predict values for input records using the provided model.
 import argparse
 import pickle
 
-import numpy as np
+import submission
+from feature_store import load_features
 
 
 class Predictor(object):
@@ -18,19 +19,24 @@ class Predictor(object):
         with open(model_filename, "rb") as filehandle:
             return pickle.load(filehandle)
 
-    def predict(self, features_filename):
-        data = np.loadtxt(features_filename, delimiter=",")
+    def predict(self, features_filename, mmap=False):
+        data = load_features(features_filename, mmap=mmap)
         return self.model.predict(data)
 
 
-def write_predictions(predictions, ids_filename, output_filename):
-    with open(ids_filename, "rb") as ids_file, open(output_filename, "wb") as output_file:
-        output_file.write("Id,Weekly_Sales\n")
+def read_ids(ids_filename):
+    with open(ids_filename, "rb") as filehandle:
+        return filehandle.read().splitlines()
 
-        for i, line in enumerate(ids_file):
-            id_ = line.rstrip()
 
-            output_file.write("%s,%.2f\n" % (id_, predictions[i]))
+def write_predictions(predictions, ids_filename, output_filename,
+                      dbname=None):
+    ids = read_ids(ids_filename)
+
+    if dbname is not None:
+        submission.validate(ids, dbname)
+
+    submission.write_submission(output_filename, ids, predictions)
 
 
 def main():
@@ -42,13 +48,25 @@ def main():
     parser.add_argument("ids_filename",
                         help="File with the IDs for Kaggle submission.")
     parser.add_argument("output_filename",
-                        help="Output predictions to this file.")
+                        help="Output predictions to this file, "
+                             "compressed with gzip if it ends with .gz.")
+    parser.add_argument("--mmap", action="store_true",
+                        help="Memory-map the features instead of reading "
+                             "them into memory (binary files only).")
+    parser.add_argument("--dbname",
+                        help="Check that the ids are those of the SalesTest "
+                             "table of this database, in order.")
 
     args = parser.parse_args()
 
     predictions = Predictor(args.model_filename).predict(
-        args.features_filename)
-    write_predictions(predictions, args.ids_filename, args.output_filename)
+        args.features_filename, mmap=args.mmap)
+
+    try:
+        write_predictions(predictions, args.ids_filename,
+                          args.output_filename, dbname=args.dbname)
+    except ValueError as e:
+        parser.error(str(e))
 
 
 if __name__ == "__main__":
@@ -5,60 +5,71 @@ Prediction using per-department model.
 """
 
 import argparse
-import pickle
-import os
 
 import numpy as np
 
-# Must be in namespace when loading pickled predictor
-from train_per_dept import CompositePredictor
+import submission
+from dept_dataset import open_dataset
+from linear_inference import LinearInferenceEngine, load_model
 
 
 class Predictor(object):
-    def __init__(self, model_filename, output_filename):
-        self.model = self.load_model(model_filename)
-
-        self.output_file = open(output_filename, "wb")
-        self.output_file.write("Id,Weekly_Sales\n")
-
-    def load_model(self, model_filename):
-        with open(model_filename, "rb") as filehandle:
-            return pickle.load(filehandle)
-
-    def predict_all(self, data_dir):
-        for filename in os.listdir(data_dir):
-            if not filename.endswith(".num"):
-                continue
-
-            store_id, dept_id = map(int, filename.split(".")[0].split("-"))
-
-            full_path = os.path.join(data_dir, filename)
-
-            data = np.loadtxt(full_path, delimiter=",")
-            if data.ndim == 1:
-                data = data.reshape((1, -1))
-
-            ids, predictions = self.model.predict(store_id, dept_id, data)
-            self.write_predictions(ids, predictions)
+    def __init__(self, model_filename, output_filename, dbname=None):
+        self.model = load_model(model_filename)
+        self.output_filename = output_filename
+        self.dbname = dbname
+
+    def predict_all(self, dataset):
+        if isinstance(self.model, LinearInferenceEngine):
+            engine = self.model
+        elif LinearInferenceEngine.supports(self.model):
+            engine = LinearInferenceEngine.from_composite(self.model)
+        else:
+            engine = None
+
+        if engine is not None:
+            # Scores every department in one pass
+            ids, predictions = engine.predict(*dataset.to_arrays())
+        else:
+            results = [self.model.predict(store_id, dept_id, data)
+                       for (store_id, dept_id), data in dataset.iteritems()]
+            ids = np.concatenate([result[0] for result in results])
+            predictions = np.concatenate([result[1] for result in results])
+
+        self.write_predictions(ids, predictions)
 
     def write_predictions(self, ids, predictions):
-        for index, id_ in enumerate(ids):
-            self.output_file.write("%s,%.2f\n" % (id_, predictions[index]))
+        if self.dbname is not None:
+            submission.validate(ids, self.dbname)
+
+        submission.write_submission(self.output_filename, ids, predictions)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("model_filename",
-                        help="The pickled model.")
-    parser.add_argument("data_dir",
-                        help="The numerical feature data.")
+                        help="The pickled model, or a .npz model "
+                             "archive.")
+    parser.add_argument("data_path",
+                        help="The numerical feature data: a packed dataset "
+                             "file or a directory of per-department files.")
     parser.add_argument("output_filename",
-                        help="Output predictions to this file.")
+                        help="Output predictions to this file, "
+                             "compressed with gzip if it ends with .gz.")
+    parser.add_argument("--dbname",
+                        help="Check that the predictions are for the "
+                             "records of the SalesTest table of this "
+                             "database, in order.")
 
     args = parser.parse_args()
 
-    Predictor(args.model_filename, args.output_filename).predict_all(
-        args.data_dir)
+    predictor = Predictor(args.model_filename, args.output_filename,
+                          dbname=args.dbname)
+
+    try:
+        predictor.predict_all(open_dataset(args.data_path))
+    except ValueError as e:
+        parser.error(str(e))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+"""
+Serves predictions of a per-department model over HTTP on localhost.
+
+The model is loaded once and kept in memory.  POST a JSON object to
+/predict with a "records" list, each record holding store_id, dept_id, date
+("2012-11-02"), is_holiday and the raw numerical fields of a department's
+CSV file (temperature, fuel_price, markdown1-5, cpi, unemployment), which
+may be null when missing.  The response holds the submission ids and
+predictions of the records in order.
+
+Requests arriving while a batch is being scored are scored together as the
+next batch.  GET /stats reports request latency percentiles.
+
+Only linear models are served, since they are scored for every department
+at once (see linear_inference.py).
+"""
+
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import Queue
+import SocketServer
+import threading
+import time
+
+import numpy as np
+
+from dept_dataset import department_ranges
+from extract_dept_features import (CPI, DAY, FUEL_PRICE, IS_HOLIDAY,
+                                   MARKDOWN1, MARKDOWN2, MARKDOWN3, MARKDOWN4,
+                                   MARKDOWN5, MONTH, TEMPERATURE,
+                                   UNEMPLOYMENT, YEAR,
+                                   NumericalFeatureExtractor)
+from extract_features import parse_floats
+from linear_inference import load_engine
+
+
+NUMERICAL_FIELDS = [TEMPERATURE, FUEL_PRICE, MARKDOWN1, MARKDOWN2, MARKDOWN3,
+                    MARKDOWN4, MARKDOWN5, CPI, UNEMPLOYMENT]
+
+# Fields whose missing values are filled from earlier weeks
+FORWARD_FILLED_FIELDS = [CPI, UNEMPLOYMENT]
+
+DEFAULT_MAX_BATCH_RECORDS = 100000
+
+# Number of recent requests the latency percentiles are computed over
+LATENCY_WINDOW = 10000
+
+
+def parse_records(records):
+    """
+    Extracts features from records as extract_dept_features.py does from a
+    department's CSV file.  The records are sorted by department and date
+    first, so missing cpi and unemployment values are filled from earlier
+    weeks of the same department whatever the order of the records.
+
+    Returns:
+      (store_ids, dept_ids, data), in the order of the records.
+    """
+    def format_value(value):
+        if value is None:
+            return "NA"
+        elif isinstance(value, float):
+            return repr(value)
+
+        return str(value)
+
+    def format_bool(value):
+        if isinstance(value, bool):
+            return "TRUE" if value else "FALSE"
+
+        return str(value)
+
+    if not records:
+        raise ValueError("No records")
+
+    store_ids = np.array([int(record["store_id"]) for record in records])
+    dept_ids = np.array([int(record["dept_id"]) for record in records])
+
+    dates = []
+    for record in records:
+        year, month, day = record["date"].split("-")
+        dates.append((int(year), int(month), int(day)))
+    dates = np.array(dates)
+
+    columns = {}
+    for i, field_name in enumerate([YEAR, MONTH, DAY]):
+        columns[field_name] = dates[:, i].astype(str)
+
+    for field_name in NUMERICAL_FIELDS:
+        columns[field_name] = np.array(
+            [format_value(record.get(field_name)) for record in records],
+            dtype=str)
+
+    columns[IS_HOLIDAY] = np.array(
+        [format_bool(record.get(IS_HOLIDAY, False)) for record in records],
+        dtype=str)
+
+    order = np.lexsort((dates[:, 2], dates[:, 1], dates[:, 0], dept_ids,
+                        store_ids))
+    columns = dict((name, column[order])
+                   for name, column in columns.iteritems())
+
+    # A fresh extractor fills a department's leading missing values with 0.
+    # Setting them to 0 keeps the forward fill of the one extractor used for
+    # every department from carrying the previous department's values.
+    starts = np.array([start for start, _ in department_ranges(
+        store_ids[order], dept_ids[order])])
+    for field_name in FORWARD_FILLED_FIELDS:
+        _, valid = parse_floats(columns[field_name][starts])
+        columns[field_name][starts[~valid]] = "0"
+
+    data = NumericalFeatureExtractor().transform_columns(columns, False)[
+        np.argsort(order)]
+
+    return store_ids, dept_ids, data
+
+
+class LatencyStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.num_requests = 0
+        self.num_records = 0
+        self.num_batches = 0
+        self.num_errors = 0
+
+    def add_request(self, latency, num_records, error=False):
+        with self.lock:
+            self.latencies.append(latency)
+            self.num_requests += 1
+            self.num_records += num_records
+            self.num_errors += error
+
+    def add_batch(self):
+        with self.lock:
+            self.num_batches += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            summary = {
+                "requests": self.num_requests,
+                "records": self.num_records,
+                "batches": self.num_batches,
+                "errors": self.num_errors,
+            }
+
+        if len(latencies) > 0:
+            summary["p50_ms"] = np.percentile(latencies, 50)
+            summary["p99_ms"] = np.percentile(latencies, 99)
+
+        return summary
+
+
+class PendingRequest(object):
+    def __init__(self, store_ids, dept_ids, data):
+        self.store_ids = store_ids
+        self.dept_ids = dept_ids
+        self.data = data
+
+        self.done = threading.Event()
+        self.ids = None
+        self.predictions = None
+        self.error = None
+
+
+class Batcher(threading.Thread):
+    """
+    Scores the requests of concurrent clients together, in one thread.
+    """
+    def __init__(self, engine, stats,
+                 max_batch_records=DEFAULT_MAX_BATCH_RECORDS):
+        super(Batcher, self).__init__()
+        self.daemon = True
+
+        self.engine = engine
+        self.stats = stats
+        self.max_batch_records = max_batch_records
+
+        self.queue = Queue.Queue()
+
+    def predict(self, store_ids, dept_ids, data):
+        request = PendingRequest(store_ids, dept_ids, data)
+        self.queue.put(request)
+
+        # A timeout keeps the wait interruptible
+        while not request.done.wait(60):
+            pass
+
+        if request.error is not None:
+            raise request.error
+
+        return request.ids, request.predictions
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            num_records = len(batch[0].data)
+
+            while num_records < self.max_batch_records:
+                try:
+                    request = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+
+                batch.append(request)
+                num_records += len(request.data)
+
+            self.score(batch)
+
+    def score(self, batch):
+        try:
+            ids, predictions = self.engine.predict(
+                np.concatenate([request.store_ids for request in batch]),
+                np.concatenate([request.dept_ids for request in batch]),
+                np.vstack([request.data for request in batch]))
+        except Exception as e:
+            for request in batch:
+                request.error = e
+                request.done.set()
+            return
+
+        self.stats.add_batch()
+
+        start = 0
+        for request in batch:
+            stop = start + len(request.data)
+            request.ids = ids[start:stop]
+            request.predictions = predictions[start:stop]
+            request.done.set()
+            start = stop
+
+
+class PredictionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_error(404)
+            return
+
+        start = time.time()
+
+        try:
+            length = int(self.headers.getheader("content-length"))
+            records = json.loads(self.rfile.read(length))["records"]
+            store_ids, dept_ids, data = parse_records(records)
+        except (AttributeError, IndexError, KeyError, TypeError,
+                ValueError) as e:
+            self.send_error(400, "Invalid request: %s" % e)
+            return
+
+        try:
+            ids, predictions = self.server.batcher.predict(store_ids,
+                                                           dept_ids, data)
+        except Exception as e:
+            self.send_error(500, "Prediction failed: %s" % e)
+            self.server.stats.add_request(time.time() - start, 0, error=True)
+            return
+
+        self.send_json({
+            "ids": ids.tolist(),
+            "predictions": predictions.tolist()
+        })
+
+        self.server.stats.add_request(time.time() - start, len(ids))
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.send_error(404)
+            return
+
+        self.send_json(self.server.stats.summary())
+
+    def send_json(self, obj):
+        body = json.dumps(obj)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Logging every request to stderr would cost more than scoring it
+        pass
+
+
+class PredictionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, engine,
+                 max_batch_records=DEFAULT_MAX_BATCH_RECORDS):
+        BaseHTTPServer.HTTPServer.__init__(self, address, PredictionHandler)
+
+        self.stats = LatencyStats()
+        self.batcher = Batcher(engine, self.stats,
+                               max_batch_records=max_batch_records)
+        self.batcher.start()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model_filename",
+                        help="The pickled model, or a .npz model archive.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-records", type=int,
+                        default=DEFAULT_MAX_BATCH_RECORDS,
+                        help="Largest number of records scored together.")
+
+    args = parser.parse_args()
+
+    server = PredictionServer(("localhost", args.port),
+                              load_engine(args.model_filename),
+                              max_batch_records=args.max_batch_records)
+
+    print "Serving predictions on http://localhost:%d/predict" % args.port
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
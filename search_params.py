@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+"""
+Searches the hyperparameters of an algorithm of train_per_dept.py.
+
+Candidates are scored the way evaluate.py scores a model, on rolling-origin
+folds by the weighted mean absolute error, with the (candidate, fold)
+evaluations running on a process pool.  The score of each fold is cached on
+disk under a hash of the algorithm, parameters, training budget, fold and a
+fingerprint of the data, so an interrupted search resumes where it stopped.
+
+Strategies:
+  grid: every combination of the listed values.
+  random: --candidates combinations sampled from the listed values and
+    ranges.
+  halving: successive halving of random candidates.  They are first scored
+    with models trained on only the most recent --min-budget fraction of
+    each fold's training records.  The best 1/eta of them are then scored
+    with eta times as many, and so on until the survivors are trained on
+    all the records, so poor candidates are stopped cheaply.
+
+Parameters are given as NAME=V1,V2,... or, for random and halving searches,
+as NAME=LOW:HIGH to sample log-uniformly, e.g.
+
+  ./search_params.py train.num.npy --alg elastic --strategy halving \\
+      --param alpha=0.0001:10 --param l1_ratio=0.1,0.5,0.9
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from atomic_file import atomic_open
+from evaluate import (DEFAULT_DATE_COLUMNS, DEFAULT_HOLIDAY_COLUMN,
+                      RollingOriginEvaluator, evaluate_fold,
+                      weighted_mean_absolute_error)
+from feature_store import load_features
+from train_per_dept import get_algorithm
+
+
+DEFAULT_CACHE_DIR = ".search_cache"
+
+FINGERPRINT_CHUNK_SIZE = 1 << 20
+
+
+def parse_value(text):
+    for parse in (int, float):
+        try:
+            return parse(text)
+        except ValueError:
+            pass
+
+    constants = {"None": None, "True": True, "False": False}
+
+    return constants.get(text, text)
+
+
+def parse_param(spec):
+    """
+    Returns:
+      (name, values)
+        values is a list, or a (low, high) tuple for a range.
+    """
+    name, _, values = spec.partition("=")
+
+    if not name or not values:
+        raise ValueError("Parameters must be NAME=VALUES: %s" % spec)
+
+    if ":" in values:
+        low, high = [parse_value(value) for value in values.split(":")]
+        if not 0 < low < high:
+            raise ValueError("Ranges must be positive and increasing: %s" %
+                             spec)
+
+        return name, (low, high)
+
+    return name, [parse_value(value) for value in values.split(",")]
+
+
+def grid_candidates(space):
+    names = sorted(space)
+
+    for name in names:
+        if isinstance(space[name], tuple):
+            raise ValueError("Grid search needs lists of values: %s" % name)
+
+    return [dict(zip(names, values))
+            for values in itertools.product(*[space[name] for name in names])]
+
+
+def random_candidates(space, num_candidates, random):
+    candidates = []
+
+    for _ in xrange(num_candidates):
+        params = {}
+
+        for name in sorted(space):
+            values = space[name]
+
+            if isinstance(values, tuple):
+                low, high = values
+                value = float(np.exp(random.uniform(np.log(low),
+                                                    np.log(high))))
+                if isinstance(low, int) and isinstance(high, int):
+                    value = int(round(value))
+            else:
+                value = values[random.randint(len(values))]
+
+            params[name] = value
+
+        candidates.append(params)
+
+    return candidates
+
+
+def fingerprint(filename):
+    digest = hashlib.sha1()
+
+    with open(filename, "rb") as filehandle:
+        for chunk in iter(lambda: filehandle.read(FINGERPRINT_CHUNK_SIZE),
+                          ""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class FoldCache(object):
+    """
+    Stores one JSON file per fold score.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, *parts):
+        return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "rb") as filehandle:
+                return json.load(filehandle)
+        except IOError:
+            return None
+
+    def put(self, key, result):
+        with atomic_open(self.path(key)) as filehandle:
+            json.dump(result, filehandle)
+
+
+def build_model(algorithm, params, random_state=None):
+    """
+    Seeds models of algorithms that take a random_state, unless the
+    parameters being searched include it.
+    """
+    model = get_algorithm(algorithm)(**params)
+
+    if (random_state is not None and "random_state" not in params and
+            "random_state" in model.get_params()):
+        model.set_params(random_state=random_state)
+
+    return model
+
+
+def score_fold(task):
+    """
+    Returns:
+      (key, index, weighted mean absolute error)
+    """
+    key, index, algorithm, params, random_state, fold_task = task
+
+    model = build_model(algorithm, params, random_state)
+    _, targets, predictions, is_holiday = evaluate_fold(
+        (fold_task[0], model) + fold_task[1:])
+
+    return key, index, weighted_mean_absolute_error(targets, predictions,
+                                                    is_holiday)
+
+
+class Search(object):
+    def __init__(self, evaluator, algorithm, cache, jobs=1,
+                 random_state=None):
+        self.evaluator = evaluator
+        self.algorithm = algorithm
+        self.cache = cache
+        self.jobs = jobs
+        self.random_state = random_state
+
+        self.data_fingerprint = fingerprint(evaluator.filename)
+
+    def score(self, candidates, budget):
+        """
+        Args:
+          candidates: list of parameter dicts
+          budget: float
+            Fraction of each fold's training records, the most recent
+            ones, that models are trained on.
+
+        Returns:
+          list of the mean weighted mean absolute error of each candidate
+            over the folds.
+        """
+        scores = {}
+        tasks = []
+
+        for i, params in enumerate(candidates):
+            for fold, (train_stop, test_stop) in enumerate(
+                    self.evaluator.folds):
+                key = self.cache.key(
+                    self.algorithm, params, self.random_state, budget,
+                    train_stop, test_stop, self.evaluator.holiday_column,
+                    self.data_fingerprint)
+
+                cached = self.cache.get(key)
+                if cached is not None:
+                    scores[(i, fold)] = cached["wmae"]
+                    continue
+
+                train_start = train_stop - max(1, int(budget * train_stop))
+                fold_task = (self.evaluator.filename, train_start,
+                             train_stop, test_stop,
+                             self.evaluator.holiday_column)
+                tasks.append((key, (i, fold), self.algorithm, params,
+                              self.random_state, fold_task))
+
+        if self.jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(self.jobs, len(tasks)))
+            results = pool.imap_unordered(score_fold, tasks)
+        else:
+            pool = None
+            results = itertools.imap(score_fold, tasks)
+
+        try:
+            for key, index, wmae in results:
+                # Cached as soon as it is known, so that an interrupted
+                # search keeps it
+                self.cache.put(key, {"wmae": wmae})
+                scores[index] = wmae
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        num_folds = len(self.evaluator.folds)
+
+        return [np.mean([scores[(i, fold)] for fold in xrange(num_folds)])
+                for i in xrange(len(candidates))]
+
+
+def successive_halving(search, candidates, eta, min_budget):
+    """
+    Returns:
+      (candidates, scores) of the candidates scored with the full budget.
+    """
+    budget = min_budget
+
+    while True:
+        print "Scoring %d candidates on %.3g of the training records..." % (
+            len(candidates), budget)
+
+        scores = search.score(candidates, budget)
+
+        if budget >= 1:
+            return candidates, scores
+
+        keep = np.argsort(scores, kind="mergesort")[
+            :max(1, len(candidates) // eta)]
+        candidates = [candidates[i] for i in keep]
+        budget = min(1.0, budget * eta)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data", help="Labelled data used for evaluation.")
+    parser.add_argument("--alg", choices=["sgdr", "svr", "bayes", "elastic"],
+                        default="sgdr",
+                        help="The algorithm whose parameters are searched.")
+    parser.add_argument("--param", dest="params", action="append",
+                        default=[],
+                        help="NAME=V1,V2,... or NAME=LOW:HIGH.  May be "
+                             "repeated.")
+    parser.add_argument("--strategy", choices=["grid", "random", "halving"],
+                        default="grid")
+    parser.add_argument("--candidates", type=int, default=27,
+                        help="Number of random or halving candidates.")
+    parser.add_argument("--eta", type=int, default=3,
+                        help="Halving keeps the best 1/eta candidates of "
+                             "each round.")
+    parser.add_argument("--min-budget", type=float, default=1.0 / 9,
+                        help="Fraction of the training records of the first "
+                             "halving round.")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed for sampling candidates and for "
+                             "the models of algorithms that use one, so "
+                             "that scores are reproducible.")
+    parser.add_argument("--folds", type=int, default=4,
+                        help="Number of rolling-origin folds.")
+    parser.add_argument("--horizon", type=int, default=4,
+                        help="Weeks tested by each rolling-origin fold.")
+    parser.add_argument("--date-columns", default=",".join(
+                            map(str, DEFAULT_DATE_COLUMNS)),
+                        help="Comma-separated columns of the year, month "
+                             "and day.")
+    parser.add_argument("--holiday-column", type=int,
+                        default=DEFAULT_HOLIDAY_COLUMN,
+                        help="Column of the holiday flag.")
+    parser.add_argument("--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of evaluations run at once.")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="Directory of cached fold scores.")
+    parser.add_argument("--output",
+                        help="Write the best parameters to this JSON file.")
+
+    args = parser.parse_args()
+
+    try:
+        space = dict(parse_param(spec) for spec in args.params)
+
+        if args.strategy == "grid":
+            candidates = grid_candidates(space)
+        else:
+            candidates = random_candidates(
+                space, args.candidates, np.random.RandomState(args.seed))
+    except ValueError as e:
+        parser.error(str(e))
+
+    date_columns = [int(column) for column in args.date_columns.split(",")]
+
+    try:
+        evaluator = RollingOriginEvaluator(
+            load_features(args.data, mmap=True), None, args.folds,
+            args.horizon, date_columns=date_columns,
+            holiday_column=args.holiday_column)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        search = Search(evaluator, args.alg, FoldCache(args.cache_dir),
+                        jobs=args.jobs, random_state=args.seed)
+
+        if args.strategy == "halving":
+            candidates, scores = successive_halving(
+                search, candidates, args.eta, args.min_budget)
+        else:
+            print "Scoring %d candidates..." % len(candidates)
+            scores = search.score(candidates, 1.0)
+    finally:
+        evaluator.close()
+
+    print "WMAE\tParameters"
+    for i in np.argsort(scores, kind="mergesort"):
+        print "%.2f\t%s" % (scores[i], json.dumps(candidates[i],
+                                                  sort_keys=True))
+
+    if args.output:
+        best = candidates[int(np.argmin(scores))]
+        with open(args.output, "wb") as filehandle:
+            json.dump(best, filehandle, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Builds Kaggle ids and writes submission files.
+
+Ids are formatted from integer arrays of the stores, departments and dates,
+formatting each distinct department and date once.  The submission is
+formatted with a single string operation and written with a single call,
+compressed with gzip when the filename ends with .gz.
+"""
+
+import gzip
+import sqlite3
+
+import numpy as np
+
+
+HEADER = "Id,Weekly_Sales\n"
+
+GZIP_EXTENSION = ".gz"
+
+# Rows of SalesTest in the order of the test files of build_full_csv.py
+TEST_KEYS_SQL = """
+                SELECT store_id, dept_id, year, month, day FROM SalesTest
+                ORDER BY store_id, dept_id, year, month, day
+                """
+
+
+def generate_ids(store_ids, dept_ids, years, months, days):
+    """
+    Returns:
+      ids: numpy array of strings like "1_1_2012-11-02"
+    """
+    key_codes, key_index = np.unique(
+        (np.asarray(store_ids, dtype=np.int64) << 32) +
+        np.asarray(dept_ids, dtype=np.int64), return_inverse=True)
+    prefixes = np.array(["%d_%d_" % (code >> 32, code & 0xffffffff)
+                         for code in key_codes.tolist()], dtype=str)
+
+    date_codes = (np.asarray(years, dtype=np.int64) * 10000 +
+                  np.asarray(months, dtype=np.int64) * 100 +
+                  np.asarray(days, dtype=np.int64))
+    date_codes, date_index = np.unique(date_codes, return_inverse=True)
+    dates = np.array(["%d-%02d-%02d" % (code // 10000, code // 100 % 100,
+                                        code % 100)
+                      for code in date_codes.tolist()], dtype=str)
+
+    return np.char.add(prefixes[key_index], dates[date_index])
+
+
+def format_predictions(ids, predictions):
+    """
+    Returns:
+      str, a "%s,%.2f" line for each id and prediction.
+    """
+    if len(ids) != len(predictions):
+        raise ValueError("%d ids but %d predictions" % (len(ids),
+                                                        len(predictions)))
+
+    fields = [None] * (2 * len(ids))
+    fields[0::2] = np.asarray(ids).tolist()
+    fields[1::2] = np.asarray(predictions, dtype=np.float64).tolist()
+
+    return ("%s,%.2f\n" * len(ids)) % tuple(fields)
+
+
+def open_output(filename):
+    if filename.endswith(GZIP_EXTENSION):
+        return gzip.open(filename, "wb")
+
+    return open(filename, "wb")
+
+
+def write_submission(filename, ids, predictions):
+    text = HEADER + format_predictions(ids, predictions)
+
+    with open_output(filename) as filehandle:
+        filehandle.write(text)
+
+
+def read_test_ids(dbname):
+    con = sqlite3.connect(dbname)
+
+    try:
+        keys = np.array(con.execute(TEST_KEYS_SQL).fetchall(),
+                        dtype=np.int64).reshape((-1, 5))
+    finally:
+        con.close()
+
+    return generate_ids(*keys.T)
+
+
+def validate(ids, dbname):
+    """
+    Raises ValueError unless ids are those of the SalesTest table, in the
+    same order.
+    """
+    expected = read_test_ids(dbname)
+
+    if len(ids) != len(expected):
+        raise ValueError("%d rows but SalesTest has %d" % (len(ids),
+                                                           len(expected)))
+
+    mismatches = np.flatnonzero(np.asarray(ids) != expected)
+    if len(mismatches):
+        i = mismatches[0]
+        raise ValueError("Row %d is %s but SalesTest has %s (%d rows differ)"
+                         % (i, ids[i], expected[i], len(mismatches)))
@@ -1,8 +1,42 @@
+import cPickle
+import datetime
+import gzip
+import json
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
+import urllib2
 
-from extract_features import (NumericalFeatureExtractor,
-                              NumberTransformer, OneHotEncoder, Transformer)
+import numpy as np
+from sklearn.linear_model import LinearRegression, SGDRegressor
+from sklearn.preprocessing import StandardScaler
+
+import extract_dept_features
+from build_db import (DatabaseBuilder, FeaturesTableBuilder,
+                      HistoryTableBuilder, JoinedTableBuilder,
+                      SalesTestTableBuilder, SalesTrainTableBuilder,
+                      StoresTableBuilder)
+from dept_dataset import PackedDataset, open_dataset, write_packed
+from evaluate import RollingOriginEvaluator, weighted_mean_absolute_error
+from extract_db_features import add_history_features, read_db_columns
+from extract_features import (DAY, DEPT_ID, MONTH, STORE_ID, YEAR,
+                              BooleanEncoder, MissingIndicator,
+                              NonZeroNumTransformer,
+                              NumericalFeatureExtractor, NumberTransformer,
+                              OneHotEncoder, Transformer, extract_chunked,
+                              load_scaler, save_scaler, scale_data)
+from feature_store import write_features
+from history_features import SalesHistory, feature_names, week_ordinals
+from linear_inference import LinearInferenceEngine, load_engine, load_model
+from pipeline import Pipeline, Stage
+from predict_server import PredictionServer, parse_records
+from search_params import (build_model, grid_candidates, parse_param,
+                           successive_halving)
+from submission import generate_ids, read_test_ids, validate, write_submission
+from train_per_dept import CompositePredictor, train_model
 
 
 def path(filename):
@@ -85,6 +119,64 @@ class NumberTransformerTeset(BaseTest):
         )
 
 
+class NumberTransformerFillTest(BaseTest):
+    def test_transform_missing(self):
+        transformer = NumberTransformer(fill_value=-1)
+
+        self.assertListEqual(
+            transformer.transform(["1.5", "NA", "", "junk", "2"]).tolist(),
+            [1.5, -1, -1, -1, 2]
+        )
+
+    def test_transform_trailing_text(self):
+        transformer = NumberTransformer(fill_value=-1)
+
+        # Invalid like any other text, as float() has it
+        self.assertListEqual(transformer.transform(["1", "2x"]).tolist(),
+                             [1, -1])
+        self.assertListEqual(transformer.transform(["1", "2-3"]).tolist(),
+                             [1, -1])
+
+
+class NonZeroNumTransformerTest(BaseTest):
+    def test_forward_fill(self):
+        transformer = NonZeroNumTransformer(fill_value=7)
+
+        self.assertListEqual(
+            transformer.transform(["NA", "1", "NA", "NA", "3", "NA"]).tolist(),
+            [7, 1, 1, 1, 3, 3]
+        )
+
+    def test_forward_fill_across_calls(self):
+        transformer = NonZeroNumTransformer()
+
+        transformer.transform(["1", "2"])
+        self.assertListEqual(
+            transformer.transform(["NA", "4"]).tolist(),
+            [2, 4]
+        )
+
+
+class BooleanEncoderTest(BaseTest):
+    def test_transform(self):
+        self.assertListEqual(
+            BooleanEncoder().transform(["TRUE", "FALSE", "TRUE"]).tolist(),
+            [1, 0, 1]
+        )
+
+    def test_transform_invalid(self):
+        self.assertRaises(ValueError, BooleanEncoder().transform,
+                          ["TRUE", "maybe"])
+
+
+class MissingIndicatorTest(BaseTest):
+    def test_transform(self):
+        self.assertListEqual(
+            MissingIndicator().transform(["1.5", "NA", "0", "x"]).tolist(),
+            [0, 1, 0, 1]
+        )
+
+
 class NumericalFeatureExtractorTest(BaseTest):
     def test_extract_dates_and_categorical(self):
         extractor = NumericalFeatureExtractor(path("head_full_csv"))
@@ -136,5 +228,992 @@ class NumericalFeatureExtractorTest(BaseTest):
         )
 
 
+class ExtractChunkedTest(BaseTest):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        # cpi and unemployment are missing in runs across the chunks of 3
+        # records, and the store types are one-hot encoded
+        self.training_filename = self.write("train.csv", [
+            "1,%d,%s,100,2010,2,%d,%d,2.5,NA,%d,NA,NA,NA,%s,%s,FALSE,%d" % (
+                dept_id, store_type, day, 40 + day, day * 10, cpi,
+                unemployment, 1000 * day)
+            for dept_id, store_type, day, cpi, unemployment in (
+                (1, "A", 5, "NA", "8.1"), (1, "A", 12, "210", "NA"),
+                (1, "A", 19, "NA", "NA"), (2, "B", 5, "NA", "8.3"),
+                (2, "B", 12, "NA", "NA"), (2, "B", 19, "212", "NA"),
+                (3, "C", 5, "NA", "8.5"), (3, "A", 12, "214", "NA"))])
+        self.testing_filename = self.write("test.csv", [
+            "1,%d,%s,100,2010,3,%d,%d,2.5,NA,NA,NA,NA,NA,%s,NA,TRUE" % (
+                dept_id, store_type, day, 30 + day, cpi)
+            for dept_id, store_type, day, cpi in (
+                (1, "A", 5, "NA"), (1, "B", 12, "NA"), (2, "C", 5, "211"),
+                (2, "A", 12, "NA"), (3, "A", 5, "NA"))])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, filename, lines):
+        filename = os.path.join(self.tmpdir, filename)
+        with open(filename, "wb") as filehandle:
+            filehandle.write("".join(line + "\n" for line in lines))
+
+        return filename
+
+    def test_matches_in_memory(self):
+        training_output = os.path.join(self.tmpdir, "train.num.npy")
+        testing_output = os.path.join(self.tmpdir, "test.num.npy")
+        extract_chunked(self.training_filename, self.testing_filename,
+                        training_output, testing_output, 3)
+
+        expected_training, expected_testing = scale_data(
+            NumericalFeatureExtractor(
+                self.training_filename).extract_features(),
+            NumericalFeatureExtractor(
+                self.testing_filename).extract_features())
+
+        for output, expected in ((training_output, expected_training),
+                                 (testing_output, expected_testing)):
+            actual = np.load(output)
+            self.assertEqual(expected.shape, actual.shape)
+            self.assertTrue(np.allclose(expected, actual, rtol=0,
+                                        atol=1e-12))
+
+
+class DeptFeatureExtractorTest(BaseTest):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_columns_fill_separately(self):
+        filename = os.path.join(self.tmpdir, "1-1.csv")
+        with open(filename, "wb") as filehandle:
+            filehandle.write(
+                "A,100,2010,2,5,50,3,NA,NA,NA,NA,NA,200,NA,FALSE\n"
+                "A,100,2010,2,12,50,3,NA,NA,NA,NA,NA,NA,8,TRUE\n")
+
+        extractor = extract_dept_features.NumericalFeatureExtractor()
+        feature_vectors = extractor.extract_features(filename)
+
+        self.assert_array_equals(feature_vectors[:, 10:12],
+                                 [[200, 0], [200, 8]])
+
+
+class ExtractDirectoryTest(BaseTest):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        # Three departments' files from the rows of head_full_csv, without
+        # their store and department ids
+        with open(path("head_full_csv"), "rb") as filehandle:
+            rows = [line.split(",", 2)[2] for line in filehandle]
+
+        for directory in ("serial", "parallel"):
+            os.mkdir(os.path.join(self.tmpdir, directory))
+            for i, name in enumerate(("1-1", "1-2", "2-1")):
+                with open(os.path.join(self.tmpdir, directory, name),
+                          "wb") as filehandle:
+                    filehandle.write("".join(rows[i:i + 3]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_jobs_match_serial(self):
+        serial = extract_dept_features.extract_directory(
+            os.path.join(self.tmpdir, "serial"))
+        parallel = extract_dept_features.extract_directory(
+            os.path.join(self.tmpdir, "parallel"), jobs=2)
+
+        self.assertEqual(3, len(serial))
+        for serial_filename, parallel_filename in zip(serial, parallel):
+            self.assertTrue(np.array_equal(np.load(serial_filename),
+                                           np.load(parallel_filename)))
+
+    def test_incremental(self):
+        directory = os.path.join(self.tmpdir, "serial")
+        extract_dept_features.extract_directory(directory)
+
+        # Inputs older than their features are skipped
+        for name in ("1-1", "1-2", "2-1"):
+            os.utime(os.path.join(directory, name), (0, 0))
+        self.assertEqual([], extract_dept_features.extract_directory(
+            directory, incremental=True))
+
+        # A touched input is extracted again
+        os.utime(os.path.join(directory, "1-2"), None)
+        os.utime(os.path.join(directory, "1-2.num.npy"), (0, 0))
+        self.assertEqual(
+            [os.path.join(directory, "1-2.num.npy")],
+            extract_dept_features.extract_directory(directory,
+                                                    incremental=True))
+
+
+class JoinedTableBuilderTest(unittest.TestCase):
+    def setUp(self):
+        self.con = sqlite3.connect(":memory:")
+
+        self.table_builders = [
+            builder_class(self.con, None)
+            for builder_class in (StoresTableBuilder, FeaturesTableBuilder,
+                                  SalesTrainTableBuilder)
+        ]
+
+        for table_builder in self.table_builders:
+            table_builder.create_table()
+
+    def test_check_query_plan(self):
+        for table_builder in self.table_builders:
+            table_builder.create_indexes()
+
+        JoinedTableBuilder(self.con).check_query_plan()
+
+    def test_check_query_plan_without_indexes(self):
+        self.assertRaises(RuntimeError,
+                          JoinedTableBuilder(self.con).check_query_plan)
+
+
+class DataDirTest(unittest.TestCase):
+    """
+    Writes a small data directory of one store, two departments, two
+    training weeks and two test weeks.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        dates = ["2012-10-%02d" % day for day in (5, 12, 19, 26)]
+        self.write("stores.csv", ["Store,Type,Size", "1,A,100"])
+        self.write("features.csv", [
+            "Store,Date,Temperature,Fuel_Price,MarkDown1,MarkDown2,"
+            "MarkDown3,MarkDown4,MarkDown5,CPI,Unemployment,IsHoliday"] + [
+            "1,%s,50,3,NA,NA,NA,NA,NA,200,8,FALSE" % date for date in dates])
+
+        self.train = ["Store,Dept,Date,Weekly_Sales,IsHoliday"] + [
+            "1,%d,%s,%d,FALSE" % (dept_id, date, dept_id * 100 + i)
+            for dept_id in (1, 2) for i, date in enumerate(dates[:2])]
+        self.test = ["Store,Dept,Date,IsHoliday"] + [
+            "1,%d,%s,FALSE" % (dept_id, date)
+            for dept_id in (1, 2) for date in dates[2:]]
+
+        self.write("train.csv", self.train)
+        self.write("test.csv", self.test)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, filename, lines):
+        with open(os.path.join(self.tmpdir, filename), "wb") as filehandle:
+            filehandle.write("".join(line + "\n" for line in lines))
+
+
+class RefreshTest(DataDirTest):
+    def build(self, dbname, incremental):
+        builder = DatabaseBuilder(os.path.join(self.tmpdir, dbname),
+                                  self.tmpdir, incremental=incremental,
+                                  history=True)
+        if incremental:
+            builder.refresh()
+        else:
+            builder.build()
+
+        tables = {}
+        for table_name in ("SalesTrain", "SalesTest", "JoinedTrain",
+                           "JoinedTest", "SalesHistory"):
+            tables[table_name] = sorted(builder.con.execute(
+                "SELECT * FROM %s" % table_name).fetchall())
+        builder.con.close()
+
+        return tables
+
+    def test_refresh_matches_build(self):
+        self.build("sales.db", False)
+
+        # The week of 2012-10-19 moves from the test to the training file
+        self.train += ["1,1,2012-10-19,102,FALSE", "1,2,2012-10-19,202,FALSE"]
+        self.test = [line for line in self.test if "10-19" not in line]
+        self.write("train.csv", self.train)
+        self.write("test.csv", self.test)
+
+        refreshed = self.build("sales.db", True)
+        self.assertEqual(self.build("full.db", False), refreshed)
+        self.assertEqual(2, len(refreshed["SalesTest"]))
+
+        # Rows inserted before the end of the file are read as well
+        self.train.insert(3, "1,3,2012-10-19,302,FALSE")
+        self.write("train.csv", self.train)
+
+        os.remove(os.path.join(self.tmpdir, "full.db"))
+        self.assertEqual(self.build("full.db", False),
+                         self.build("sales.db", True))
+
+    def test_refresh_new_week(self):
+        self.build("sales.db", False)
+
+        # Marks the rows built so far, to tell which are rewritten
+        con = sqlite3.connect(os.path.join(self.tmpdir, "sales.db"))
+        for table_name in ("JoinedTrain", "JoinedTest"):
+            con.execute("UPDATE %s SET temperature = -1" % table_name)
+        con.execute("UPDATE SalesHistory SET yoy = -1")
+        con.commit()
+        con.close()
+
+        with open(os.path.join(self.tmpdir, "features.csv"), "ab") as fh:
+            fh.write("1,2012-11-02,40,3,NA,NA,NA,NA,NA,201,8,FALSE\n")
+        self.test += ["1,1,2012-11-02,FALSE", "1,2,2012-11-02,FALSE"]
+        self.write("test.csv", self.test)
+
+        refreshed = self.build("sales.db", True)
+        full = self.build("full.db", False)
+
+        # The column of the date and of the marked value of each table
+        for table_name, date, column in (("JoinedTrain", 4, 7),
+                                         ("JoinedTest", 4, 7),
+                                         ("SalesHistory", 2, -1)):
+            for row, expected in zip(refreshed[table_name],
+                                     full[table_name]):
+                if tuple(row[date:date + 3]) >= (2012, 11, 2):
+                    self.assertEqual(expected, row)
+                else:
+                    self.assertEqual(-1, row[column])
+
+            self.assertEqual(len(full[table_name]),
+                             len(refreshed[table_name]))
+
+
+class CrashingStoresTableBuilder(StoresTableBuilder):
+    def read_batches(self, since=None, offset=None):
+        # Dies without reporting, like a worker killed by the OS
+        os._exit(1)
+
+
+class ParallelBuildTest(DataDirTest):
+    def tables(self, builder):
+        tables = {}
+        for table_name in ("Stores", "Features", "SalesTrain", "SalesTest",
+                           "JoinedTrain", "JoinedTest", "LoadState"):
+            tables[table_name] = sorted(builder.con.execute(
+                "SELECT * FROM %s" % table_name).fetchall())
+
+        return tables
+
+    def builder(self, dbname):
+        return DatabaseBuilder(os.path.join(self.tmpdir, dbname), self.tmpdir,
+                               batch_size=2)
+
+    def test_matches_serial_build(self):
+        serial = self.builder("serial.db")
+        serial.build()
+
+        parallel = self.builder("parallel.db")
+        parallel.build_parallel()
+
+        self.assertEqual(self.tables(serial), self.tables(parallel))
+
+    def test_missing_file(self):
+        os.remove(os.path.join(self.tmpdir, "train.csv"))
+
+        self.assertRaises(RuntimeError,
+                          self.builder("sales.db").build_parallel)
+
+    def test_worker_killed(self):
+        builder = self.builder("sales.db")
+        builder.table_builders[0] = CrashingStoresTableBuilder(
+            builder.con, self.tmpdir)
+
+        self.assertRaises(RuntimeError, builder.build_parallel)
+
+
+class HistoryTableBuilderTest(unittest.TestCase):
+    def setUp(self):
+        self.con = sqlite3.connect(":memory:")
+
+        for builder_class in (FeaturesTableBuilder, SalesTrainTableBuilder,
+                              SalesTestTableBuilder):
+            builder_class(self.con, None).create_table()
+
+        # Department (1, 2) sells in 60 weeks but not the tenth, and the
+        # two weeks after them are test weeks
+        self.dates = [datetime.date(2010, 2, 5) + datetime.timedelta(weeks=i)
+                      for i in xrange(62)]
+        self.sales = [[1, 2, date.year, date.month, date.day, 100.0 + i * i,
+                       "FALSE"]
+                      for i, date in enumerate(self.dates[:60]) if i != 9]
+
+        self.con.executemany(
+            "INSERT INTO SalesTest VALUES (?, ?, ?, ?, ?, ?)",
+            [[1, 2, date.year, date.month, date.day, "FALSE"]
+             for date in self.dates[60:]])
+
+        # Short lags and windows, to cover their SQL
+        self.lags = (1, 2, 52)
+        self.windows = (4,)
+        self.builder = HistoryTableBuilder(self.con, self.lags, self.windows)
+        self.builder.create_table()
+
+    def insert_sales(self, sales):
+        self.con.executemany(
+            "INSERT INTO SalesTrain VALUES (?, ?, ?, ?, ?, ?, ?)", sales)
+
+    def rows(self):
+        return self.con.execute(
+            "SELECT * FROM SalesHistory "
+            "ORDER BY store_id, dept_id, year, month, day").fetchall()
+
+    def test_matches_sales_history(self):
+        self.insert_sales(self.sales)
+        self.builder.insert_data()
+
+        rows = self.rows()
+        self.assertEqual(len(self.sales) + 2, len(rows))
+
+        sales = np.array(self.sales, dtype=object)
+        history = SalesHistory(
+            sales[:, 0], sales[:, 1],
+            week_ordinals(sales[:, 2], sales[:, 3], sales[:, 4]),
+            sales[:, 5])
+
+        columns = np.array(rows, dtype=np.float64)
+        expected = history.features(
+            columns[:, 0], columns[:, 1],
+            week_ordinals(columns[:, 2], columns[:, 3], columns[:, 4]),
+            lags=self.lags, windows=self.windows)
+
+        self.assertEqual(np.isnan(expected).tolist(),
+                         np.isnan(columns[:, 5:]).tolist())
+        self.assertTrue(np.allclose(expected[~np.isnan(expected)],
+                                    columns[:, 5:][~np.isnan(expected)]))
+
+    def test_incremental(self):
+        self.insert_sales(self.sales[:-1])
+        self.builder.insert_data()
+
+        self.insert_sales(self.sales[-1:])
+        self.builder.insert_data(since="%d-%02d-%02d" % tuple(
+            self.sales[-2][2:5]))
+        updated = self.rows()
+
+        self.builder.insert_data()
+        self.assertEqual(self.rows(), updated)
+
+    def test_rebuilds_table_of_other_features(self):
+        self.insert_sales(self.sales)
+        self.builder.insert_data()
+
+        builder = HistoryTableBuilder(self.con)
+        builder.create_table()
+
+        self.assertEqual(feature_names(), builder.table_columns())
+        self.assertTrue(builder.is_empty())
+
+        builder.insert_data()
+        self.assertEqual(len(self.sales) + 2, len(self.rows()))
+
+
+class ReadDbColumnsTest(unittest.TestCase):
+    def test_missing_values(self):
+        con = sqlite3.connect(":memory:")
+        con.execute("CREATE TABLE T (type TEXT, markdown1 REAL)")
+        con.executemany("INSERT INTO T VALUES (?, ?)",
+                        [("A", 1.5), ("B", "NA"), ("A", None), ("C", 2)])
+
+        columns = read_db_columns(con.execute("SELECT * FROM T"),
+                                  ["type", "markdown1"], batch_size=3)
+
+        self.assertEqual(["A", "B", "A", "C"], columns["type"].tolist())
+        self.assertEqual([False, True, True, False],
+                         np.isnan(columns["markdown1"]).tolist())
+        self.assertEqual([1.5, 2], columns["markdown1"][[0, 3]].tolist())
+
+
+class AddHistoryFeaturesTest(unittest.TestCase):
+    def test_missing_indicators(self):
+        history = SalesHistory([1, 1], [1, 1], [0, 1], [10.0, 20.0])
+        weeks = (np.array([1, 3]) * 7 + 4).astype("M8[D]").astype(object)
+        columns = {STORE_ID: np.ones(2), DEPT_ID: np.ones(2),
+                   YEAR: [date.year for date in weeks],
+                   MONTH: [date.month for date in weeks],
+                   DAY: [date.day for date in weeks]}
+
+        # Records of weeks 1 and 3, with a holiday flag and a target
+        features = add_history_features(np.zeros((2, 2)), columns, history,
+                                        True, lags=(1,), windows=())
+
+        self.assertEqual([[10, 0, 0, 1, 0, 0], [0, 0, 1, 1, 0, 0]],
+                         features.tolist())
+
+
+class SalesHistoryTest(unittest.TestCase):
+    def setUp(self):
+        # Department (1, 1) sells 10 * week in weeks 0 to 59 but not week 57
+        weeks = np.delete(np.arange(60), 57)
+        self.history = SalesHistory(np.ones(59), np.ones(59), weeks,
+                                    10.0 * weeks, holiday_weeks=[2, 55])
+
+    def test_week_ordinals(self):
+        self.assertEqual([0, 1, 1, 53],
+                         (week_ordinals([2010, 2010, 2010, 2011],
+                                        [12, 12, 12, 12],
+                                        [24, 31, 31, 30]) -
+                          week_ordinals([2010], [12], [24])).tolist())
+
+    def test_lags(self):
+        lags = self.history.lag([1, 1, 1, 2], [1, 1, 1, 1], [10, 0, 58, 10],
+                                1)
+
+        self.assertEqual(90, lags[0])
+        self.assertTrue(np.isnan(lags[1:]).all())
+
+    def test_rolling(self):
+        means, stds = self.history.rolling([1, 1, 1], [1, 1, 1], [10, 59, 0],
+                                           3)
+
+        self.assertAlmostEqual(80, means[0])
+        self.assertAlmostEqual(570, means[1])
+        self.assertAlmostEqual(np.std([70, 80, 90]), stds[0])
+        self.assertAlmostEqual(np.std([560, 580]), stds[1])
+        self.assertTrue(np.isnan(means[2]) and np.isnan(stds[2]))
+
+    def test_year_over_year(self):
+        # The holiday of week 55 was in week 2 last year, 53 weeks earlier
+        self.assertEqual([20, 40], self.history.year_over_year(
+            [1, 1], [1, 1], [55, 56]).tolist())
+
+    def test_add(self):
+        self.history.add([1, 1], [1, 1], [57, 10], [1.0, 2.0])
+
+        self.assertEqual([2, 1], self.history.lag([1, 1], [1, 1], [11, 58],
+                                                  1).tolist())
+        self.assertAlmostEqual(np.mean([560, 1, 580, 590]),
+                               self.history.rolling([1], [1], [60], 4)[0][0])
+
+
+class PackedDatasetTest(BaseTest):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "dept.npy")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_departments(self):
+        write_packed(np.array([2, 1, 1, 2]), np.array([1, 3, 3, 1]),
+                     np.array([[1.0], [2.0], [3.0], [4.0]]), self.filename)
+
+        dataset = PackedDataset(self.filename)
+
+        self.assertEqual([(1, 3), (2, 1)], dataset.keys())
+        self.assert_array_equals(dataset[(1, 3)], [[2.0], [3.0]])
+        self.assert_array_equals(dataset[(2, 1)], [[1.0], [4.0]])
+        self.assertFalse((1, 1) in dataset)
+
+    def test_directory_prefers_binary_files(self):
+        write_features(np.array([[1.0]]), os.path.join(self.tmpdir, "1-2.num"))
+        write_features(np.array([[2.0]]),
+                       os.path.join(self.tmpdir, "1-2.num.npy"))
+
+        dataset = open_dataset(self.tmpdir)
+
+        self.assertEqual([(1, 2)], dataset.keys())
+        self.assert_array_equals(dataset[(1, 2)], [[2.0]])
+
+
+class TrainModelTest(BaseTest):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "dept.npy")
+
+        random = np.random.RandomState(0)
+        write_packed(np.repeat([1, 2], 20), np.repeat([5, 6], 20),
+                     random.rand(40, 3), self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parallel_matches_serial(self):
+        serial = CompositePredictor(SGDRegressor, random_state=1)
+        parallel = CompositePredictor(SGDRegressor, random_state=1)
+
+        train_model(PackedDataset(self.filename), serial)
+        train_model(PackedDataset(self.filename), parallel, jobs=2)
+
+        self.assertEqual(sorted(serial.predictors),
+                         sorted(parallel.predictors))
+        for key in serial.predictors:
+            self.assertTrue(np.array_equal(serial.predictors[key].coef_,
+                                           parallel.predictors[key].coef_))
+            self.assertTrue(np.array_equal(serial.scalers[key].scale_,
+                                           parallel.scalers[key].scale_))
+
+
+class FallbackTest(BaseTest):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "dept.npy")
+
+        random = np.random.RandomState(0)
+        write_packed(np.repeat([1, 1, 2], 20), np.repeat([5, 6, 6], 20),
+                     random.rand(60, 4) * [2012, 12, 28, 1], self.filename)
+
+        self.dataset = PackedDataset(self.filename)
+        self.model = CompositePredictor(SGDRegressor, random_state=1)
+        train_model(self.dataset, self.model)
+        self.model.train_fallbacks(self.dataset, {1: "A", 2: "A", 3: "B"})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_fallbacks(self):
+        self.assertEqual(("type", "A", 5), self.model.fallbacks[(2, 5)])
+        self.assertEqual(("global",), self.model.fallbacks[(3, 6)])
+        self.assertFalse((1, 5) in self.model.fallbacks)
+        self.assertEqual(("store", 2), self.model.find_fallback(2, 7))
+        self.assertEqual(("global",), self.model.find_fallback(4, 5))
+
+    def test_engine_matches_fallbacks(self):
+        engine = LinearInferenceEngine.from_composite(self.model)
+        data = self.dataset[(1, 5)][:1, :-1]
+
+        for store_id, dept_id in [(2, 5), (3, 6), (2, 7), (4, 5)]:
+            _, expected = self.model.predict(store_id, dept_id, data)
+            _, predictions = engine.predict(
+                np.array([store_id]), np.array([dept_id]), data)
+
+            self.assertEqual((1,), expected.shape)
+            self.assertAlmostEqual(expected[0], predictions[0])
+
+    def test_model_pickled_without_fallbacks(self):
+        for name in ("fallback_predictors", "fallback_scalers", "fallbacks",
+                     "store_types", "random_state"):
+            del self.model.__dict__[name]
+
+        model = cPickle.loads(cPickle.dumps(self.model))
+        data = self.dataset[(1, 5)][:1, :-1]
+
+        _, predictions = model.predict(3, 6, data)
+        self.assert_array_equals(predictions.reshape((1, -1)), [[0]])
+        self.assertEqual([(1, 5), (1, 6), (2, 6)],
+                         LinearInferenceEngine.from_composite(model).keys)
+
+
+class UpdateTest(BaseTest):
+    def test_update(self):
+        random = np.random.RandomState(0)
+        model = CompositePredictor(SGDRegressor, random_state=1)
+        model.train(1, 5, random.rand(20, 4))
+        model.fallbacks[(2, 6)] = ("store", 1)
+
+        coef = model.predictors[(1, 5)].coef_.copy()
+        model.update(1, 5, random.rand(4, 4))
+        model.update(2, 6, random.rand(4, 4))
+
+        self.assertEqual(24, model.scalers[(1, 5)].n_samples_seen_)
+        self.assertFalse(np.array_equal(coef,
+                                        model.predictors[(1, 5)].coef_))
+        self.assertTrue((2, 6) in model.predictors)
+        self.assertFalse((2, 6) in model.fallbacks)
+
+
+class ScalerTest(BaseTest):
+    def test_update_scaler(self):
+        random = np.random.RandomState(0)
+        old = random.rand(20, 4)
+        new = random.rand(5, 4)
+        testing = random.rand(3, 3)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "scaler.pickle")
+            _, expected = scale_data(np.vstack((old, new)), testing)
+
+            fitted = StandardScaler()
+            scale_data(old, testing, fitted)
+            save_scaler(filename, fitted, np.array(["A", "B"]))
+            scaler, categories = load_scaler(filename)
+            scaled_new, scaled_testing = scale_data(new, testing, scaler)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual(["A", "B"], categories)
+        self.assertEqual(25, scaler.n_samples_seen_)
+        self.assert_array_equals(scaled_testing, expected)
+        # The target is not scaled
+        self.assertTrue(np.array_equal(new[:, -1], scaled_new[:, -1]))
+
+
+class LinearInferenceEngineTest(BaseTest):
+    def test_matches_composite_predictor(self):
+        random = np.random.RandomState(0)
+        model = CompositePredictor(SGDRegressor, random_state=1)
+        model.train(1, 5, random.rand(20, 4) * [2012, 12, 28, 1])
+        model.train(2, 6, random.rand(20, 4) * [2012, 12, 28, 1])
+
+        data = random.rand(6, 3) * [2012, 12, 28]
+        store_ids = np.array([1, 2, 1, 3, 2, 1])
+        dept_ids = np.array([5, 6, 5, 5, 6, 5])
+
+        engine = LinearInferenceEngine.from_composite(model)
+        ids, predictions = engine.predict(store_ids, dept_ids, data)
+
+        for i in xrange(len(data)):
+            expected_ids, expected = model.predict(
+                store_ids[i], dept_ids[i], data[i:i + 1])
+            self.assertEqual(expected_ids[0], ids[i])
+            self.assertAlmostEqual(float(expected[0]), predictions[i])
+
+    def test_save_load(self):
+        engine = LinearInferenceEngine(
+            [(1, 5), (2, 6)], [0, 1], np.array([[1.0], [2.0]]),
+            np.array([[3.0], [4.0]]), np.array([[5.0], [6.0]]),
+            np.array([7.0, 8.0]))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "model.npz")
+            engine.save(filename)
+            loaded = LinearInferenceEngine.load(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual([(1, 5), (2, 6)], loaded.keys)
+        self.assert_array_equals(loaded.coefs, [[5.0], [6.0]])
+        self.assert_array_equals(loaded.lookup(np.array([2, 1, 3]),
+                                               np.array([6, 5, 5]))
+                                 .reshape((1, -1)), [[1, 0, -1]])
+
+    def test_load_model_pickled_by_script(self):
+        model = CompositePredictor(SGDRegressor, random_state=1)
+        model.train(1, 5, np.random.RandomState(0).rand(20, 4))
+
+        # As pickled when train_per_dept.py runs as __main__
+        pickled = cPickle.dumps(model, cPickle.HIGHEST_PROTOCOL).replace(
+            "ctrain_per_dept\nCompositePredictor\n",
+            "c__main__\nCompositePredictor\n")
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "model.pickle")
+            with open(filename, "wb") as filehandle:
+                filehandle.write(pickled)
+
+            loaded = load_model(filename)
+            engine = load_engine(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEqual([(1, 5)], sorted(loaded.predictors))
+        self.assertEqual([(1, 5)], engine.keys)
+
+
+class ParseRecordsTest(BaseTest):
+    def test_parse_records(self):
+        store_ids, dept_ids, data = parse_records([
+            {"store_id": 1, "dept_id": 5, "date": "2012-11-02",
+             "temperature": 63.5, "fuel_price": 3.75, "markdown1": None,
+             "cpi": 211.0, "unemployment": 7.5, "is_holiday": True},
+            {"store_id": 2, "dept_id": 6, "date": "2012-11-09",
+             "temperature": None, "fuel_price": 3.5, "markdown2": 2.5,
+             "cpi": None, "unemployment": None, "is_holiday": False},
+        ])
+
+        self.assertEqual([1, 2], store_ids.tolist())
+        self.assertEqual([5, 6], dept_ids.tolist())
+
+        # Store 2 has no earlier week to fill cpi and unemployment from
+        self.assert_array_equals(data, [
+            [2012, 11, 2, 63.5, 3.75, 0, 0, 0, 0, 0, 211.0, 7.5, 1],
+            [2012, 11, 9, 0, 3.5, 0, 2.5, 0, 0, 0, 0, 0, 0],
+        ])
+
+    def test_fills_from_same_department(self):
+        _, _, data = parse_records([
+            {"store_id": 1, "dept_id": 5, "date": "2012-11-09", "cpi": None},
+            {"store_id": 2, "dept_id": 5, "date": "2012-11-02", "cpi": 190.0},
+            {"store_id": 1, "dept_id": 5, "date": "2012-11-02", "cpi": 211.0},
+        ])
+
+        self.assert_array_equals(data[:, [2, 10]], [[9, 211.0], [2, 190.0],
+                                                    [2, 211.0]])
+
+    def test_invalid_dates(self):
+        for date in ("2012", "2012-11-xx"):
+            self.assertRaises(ValueError, parse_records, [
+                {"store_id": 1, "dept_id": 5, "date": date}])
+
+
+class PredictionServerTest(BaseTest):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        model = CompositePredictor(SGDRegressor, random_state=1)
+        model.train(1, 5, random.rand(20, 14))
+        model.train(2, 6, random.rand(20, 14))
+        self.engine = LinearInferenceEngine.from_composite(model)
+
+        self.server = self.start(self.engine)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def start(self, engine):
+        server = PredictionServer(("localhost", 0), engine)
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return server
+
+    def url(self, path, server=None):
+        return "http://localhost:%d%s" % (
+            (server or self.server).server_address[1], path)
+
+    def post(self, body, server=None):
+        return json.loads(urllib2.urlopen(self.url("/predict", server),
+                                          body).read())
+
+    def records(self, store_id, dept_id, num_records):
+        return [{"store_id": store_id, "dept_id": dept_id,
+                 "date": "2012-11-%02d" % (2 + 7 * i), "temperature": 60.0 + i,
+                 "fuel_price": 3.5, "cpi": 211.0, "unemployment": 7.5,
+                 "is_holiday": False}
+                for i in xrange(num_records)]
+
+    def test_concurrent_requests(self):
+        batches = [self.records(1, 5, 3), self.records(2, 6, 4)]
+        responses = [None] * len(batches)
+
+        def post(i):
+            responses[i] = self.post(json.dumps({"records": batches[i]}))
+
+        threads = [threading.Thread(target=post, args=(i,))
+                   for i in xrange(len(batches))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for records, response in zip(batches, responses):
+            store_ids, dept_ids, data = parse_records(records)
+            ids, predictions = self.engine.predict(store_ids, dept_ids, data)
+
+            self.assertEqual(ids.tolist(), response["ids"])
+            self.assertTrue(np.allclose(predictions,
+                                        response["predictions"]))
+
+        stats = json.loads(urllib2.urlopen(self.url("/stats")).read())
+        self.assertEqual(2, stats["requests"])
+        self.assertEqual(7, stats["records"])
+        self.assertTrue(0 < stats["p50_ms"] <= stats["p99_ms"])
+
+    def test_invalid_request(self):
+        for body in ("{", json.dumps({"records": [{"store_id": 1}]})):
+            try:
+                self.post(body)
+            except urllib2.HTTPError as e:
+                self.assertEqual(400, e.code)
+            else:
+                self.fail("Expected a 400 response")
+
+    def test_prediction_error(self):
+        class BrokenEngine(object):
+            def predict(self, store_ids, dept_ids, data):
+                raise RuntimeError("broken")
+
+        server = self.start(BrokenEngine())
+        try:
+            self.post(json.dumps({"records": self.records(1, 5, 1)}),
+                      server)
+        except urllib2.HTTPError as e:
+            self.assertEqual(500, e.code)
+        else:
+            self.fail("Expected a 500 response")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(1, server.stats.summary()["errors"])
+
+
+class RollingOriginEvaluatorTest(BaseTest):
+    def test_folds(self):
+        # Two records a week for six weeks, in reverse order of date:
+        # year, month, day, holiday, target
+        weeks = np.repeat(np.arange(6)[::-1], 2)
+        data = np.column_stack((np.repeat(2012, 12), 1 + weeks // 4,
+                                1 + weeks % 4 * 7, weeks == 4, weeks))
+
+        evaluator = RollingOriginEvaluator(
+            data, LinearRegression(), num_folds=2, horizon=2,
+            date_columns=(0, 1, 2), holiday_column=3)
+
+        try:
+            self.assertEqual([(4, 8), (8, 12)], evaluator.folds)
+
+            results = evaluator.evaluate()
+        finally:
+            evaluator.close()
+
+        self.assertEqual([4, 8], [result[0] for result in results])
+        self.assertEqual([2, 2, 3, 3], results[0][1].tolist())
+        self.assertEqual([False, False, False, False],
+                         results[0][3].tolist())
+        self.assertEqual([True, True, False, False], results[1][3].tolist())
+
+    def test_weighted_mean_absolute_error(self):
+        self.assertAlmostEqual(
+            (5 * 2 + 1 * 4) / 6.0,
+            weighted_mean_absolute_error(np.array([1.0, 1.0]),
+                                         np.array([3.0, 5.0]),
+                                         np.array([True, False])))
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        self.source = self.path("source")
+        self.write(self.source, "a")
+
+        # Each stage copies its input and logs that it ran
+        self.stages = [
+            Stage(name, ["sh", "-c", "cat %s > %s && echo %s >> %s" % (
+                      self.path(input_name), self.path(name), name,
+                      self.path("log"))],
+                  inputs=[self.path(input_name)], outputs=[self.path(name)])
+            for name, input_name in (("first", "source"),
+                                     ("second", "first"),
+                                     ("third", "first"))
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def write(self, filename, text):
+        with open(filename, "wb") as filehandle:
+            filehandle.write(text)
+
+    def run_pipeline(self, targets=None):
+        pipeline = Pipeline(self.stages, state_dir=self.path("state"))
+        self.assertTrue(pipeline.run(targets, jobs=2))
+
+        with open(self.path("log")) as filehandle:
+            ran = filehandle.read().split()
+        os.remove(self.path("log"))
+
+        return sorted(ran)
+
+    def test_reruns_invalidated_stages(self):
+        self.assertEqual(["first", "second", "third"], self.run_pipeline())
+
+        self.write(self.path("log"), "")
+        self.assertEqual([], self.run_pipeline())
+
+        os.remove(self.path("third"))
+        self.assertEqual(["third"], self.run_pipeline())
+
+        self.write(self.source, "bb")
+        self.assertEqual(["first"], self.run_pipeline(["first"]))
+        self.assertEqual(["second", "third"], self.run_pipeline())
+
+    def test_failure(self):
+        self.stages[0].command = ["false"]
+
+        pipeline = Pipeline(self.stages, state_dir=self.path("state"))
+        self.assertFalse(pipeline.run(jobs=2))
+        self.assertFalse(os.path.exists(self.path("second")))
+
+
+class SubmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ids = generate_ids([1, 1, 12], [3, 3, 99], [2012, 2012, 2013],
+                                [11, 12, 1], [2, 7, 25])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_generate_ids(self):
+        self.assertEqual(["1_3_2012-11-02", "1_3_2012-12-07",
+                          "12_99_2013-01-25"], self.ids.tolist())
+
+    def test_write_submission(self):
+        expected = ("Id,Weekly_Sales\n1_3_2012-11-02,1.50\n"
+                    "1_3_2012-12-07,-2.00\n12_99_2013-01-25,1234.57\n")
+
+        for filename in ("out.csv", "out.csv.gz"):
+            filename = os.path.join(self.tmpdir, filename)
+            write_submission(filename, self.ids, [1.5, -2, 1234.567])
+
+            opener = gzip.open if filename.endswith(".gz") else open
+            with opener(filename, "rb") as filehandle:
+                self.assertEqual(expected, filehandle.read())
+
+        self.assertRaises(ValueError, write_submission, filename, self.ids,
+                          [1.5])
+
+    def test_validate(self):
+        dbname = os.path.join(self.tmpdir, "test.db")
+        con = sqlite3.connect(dbname)
+        SalesTestTableBuilder(con, None).create_table()
+        con.executemany("INSERT INTO SalesTest VALUES (?, ?, ?, ?, ?, ?)",
+                        [(12, 99, 2013, 1, 25, "FALSE"),
+                         (1, 3, 2012, 12, 7, "FALSE"),
+                         (1, 3, 2012, 11, 2, "FALSE")])
+        con.commit()
+        con.close()
+
+        self.assertEqual(self.ids.tolist(), read_test_ids(dbname).tolist())
+
+        validate(self.ids, dbname)
+        self.assertRaises(ValueError, validate, self.ids[::-1], dbname)
+        self.assertRaises(ValueError, validate, self.ids[:2], dbname)
+
+
+class SearchParamsTest(unittest.TestCase):
+    def test_parse_param(self):
+        self.assertEqual(("C", [1, 0.5, "rbf", None]),
+                         parse_param("C=1,0.5,rbf,None"))
+        self.assertEqual(("alpha", (0.001, 10)), parse_param("alpha=0.001:10"))
+        self.assertRaises(ValueError, parse_param, "alpha=10:1")
+
+    def test_grid_candidates(self):
+        self.assertEqual(
+            [{"a": 1, "b": 3}, {"a": 1, "b": 4},
+             {"a": 2, "b": 3}, {"a": 2, "b": 4}],
+            grid_candidates({"a": [1, 2], "b": [3, 4]}))
+
+    def test_build_model_seeds(self):
+        self.assertEqual(
+            3, build_model("sgdr", {"alpha": 0.1}, 3).random_state)
+        self.assertEqual(
+            5, build_model("sgdr", {"random_state": 5}, 3).random_state)
+        self.assertEqual(
+            None, build_model("sgdr", {}).random_state)
+        # BayesianRidge has no random_state
+        build_model("bayes", {}, 3)
+
+    def test_successive_halving(self):
+        class FakeSearch(object):
+            def __init__(self):
+                self.budgets = []
+
+            def score(self, candidates, budget):
+                self.budgets.append((len(candidates), budget))
+                return [abs(params["x"] - 5) for params in candidates]
+
+        search = FakeSearch()
+        candidates, scores = successive_halving(
+            search, [{"x": x} for x in xrange(9)], 3, 1.0 / 9)
+
+        self.assertEqual([{"x": 5}], candidates)
+        self.assertEqual([0], scores)
+        self.assertEqual([9, 3, 1], [num for num, _ in search.budgets])
+        self.assertAlmostEqual(1.0, search.budgets[-1][1])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -7,12 +7,13 @@ Trains an Elastic Net Regressor.
 import argparse
 import pickle
 
-import numpy as np
 from sklearn.linear_model import ElasticNet
 
+from feature_store import load_features
 
-def train_model(features_filename):
-    training_data = np.loadtxt(features_filename, delimiter=",")
+
+def train_model(features_filename, mmap=False):
+    training_data = load_features(features_filename, mmap=mmap)
 
     X = training_data[:, :-1]
     y = training_data[:, -1]
@@ -37,10 +38,13 @@ def main():
                              "array.")
     parser.add_argument("model_filename",
                         help="The file to save the trained model to.")
+    parser.add_argument("--mmap", action="store_true",
+                        help="Memory-map the features instead of reading "
+                             "them into memory (binary files only).")
 
     args = parser.parse_args()
 
-    model = train_model(args.features_filename)
+    model = train_model(args.features_filename, mmap=args.mmap)
     save_model(model, args.model_filename)
 
 
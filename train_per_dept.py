@@ -5,25 +5,75 @@ Train an algorithm to process each department.
 """
 
 import argparse
-import pickle
-import os
+import collections
+import multiprocessing
+import cPickle as pickle
+import sqlite3
 
 import numpy as np
 from sklearn.linear_model import BayesianRidge, ElasticNet, SGDRegressor
 from sklearn import preprocessing
 from sklearn.svm import SVR
 
+from atomic_file import atomic_open
+from dept_dataset import open_dataset
+from feature_store import is_binary
+from linear_inference import LinearInferenceEngine, is_archive, load_model
+from submission import generate_ids
+
+
+GLOBAL_MODEL = ("global",)
+
+# Fallback models are fit to an evenly spaced sample of at most this many
+# records of the departments they pool.
+FALLBACK_MAX_RECORDS = 20000
+
 
 class CompositePredictor(object):
-    def __init__(self, per_dept_regressor_class):
+    def __init__(self, per_dept_regressor_class, random_state=None):
         self.per_dept_regressor_class = per_dept_regressor_class
+        self.random_state = random_state
 
         self.predictors = {}
         self.scalers = {}
 
-    def train(self, store_id, dept_id, data):
+        # Models pooling several departments, keyed by ("type", store_type,
+        # dept_id), ("store", store_id) or GLOBAL_MODEL
+        self.fallback_predictors = {}
+        self.fallback_scalers = {}
+
+        # Maps (store_id, dept_id) pairs without a model of their own to the
+        # key of their fallback model
+        self.fallbacks = {}
+        self.store_types = {}
+
+    def __setstate__(self, state):
+        # Models pickled before fallback models were added have none
+        self.__dict__.update(state)
+        self.__dict__.setdefault("random_state", None)
+        for name in ("fallback_predictors", "fallback_scalers", "fallbacks",
+                     "store_types"):
+            self.__dict__.setdefault(name, {})
+
+    def create_regressor(self):
+        regressor = self.per_dept_regressor_class()
+
+        if (self.random_state is not None and
+                "random_state" in regressor.get_params()):
+            regressor.set_params(random_state=self.random_state)
+
+        return regressor
+
+    def fit(self, data):
+        """
+        Fits a scaler and a regressor to one department's data without
+        storing them, so that departments can be fit in other processes.
+
+        Returns:
+          (scaler, predictor)
+        """
         scaler = preprocessing.StandardScaler()
-        predictor = self.per_dept_regressor_class()
+        predictor = self.create_regressor()
 
         feature_data = data[:, :-1]
         target_data = data[:, -1]
@@ -31,51 +81,211 @@ class CompositePredictor(object):
         scaler.fit(feature_data)
         predictor.fit(scaler.transform(feature_data), target_data)
 
+        return scaler, predictor
+
+    def train(self, store_id, dept_id, data):
+        self.add(store_id, dept_id, *self.fit(data))
+
+    def add(self, store_id, dept_id, scaler, predictor):
         self.scalers[(store_id, dept_id)] = scaler
         self.predictors[(store_id, dept_id)] = predictor
+        self.fallbacks.pop((store_id, dept_id), None)
+
+    def update(self, store_id, dept_id, data):
+        """
+        Updates a department's scaler statistics and regressor with new
+        records, or trains them if the department is new.  The regressor
+        must support partial_fit.
+        """
+        key = (store_id, dept_id)
+        if key not in self.predictors:
+            self.train(store_id, dept_id, data)
+            return
 
-    def generate_id(self, store_id, dept_id, record):
-        def intstr(float_num):
-            return str(int(float_num))
+        feature_data = data[:, :-1]
+        target_data = data[:, -1]
 
-        return (str(store_id) + "_" + str(dept_id) + "_" +
-                intstr(record[0]) + "-" + intstr(record[1]).zfill(2) +
-                "-" + intstr(record[2]).zfill(2))
+        scaler = self.scalers[key]
+        scaler.partial_fit(feature_data)
+        self.predictors[key].partial_fit(scaler.transform(feature_data),
+                                         target_data)
+
+    def train_fallbacks(self, dataset, store_types=None):
+        """
+        Trains the models used for departments without a model of their
+        own and precomputes the fallback of every store and department
+        pair in the dataset.  In order of preference a department falls
+        back to the same department in stores of the same type, then to
+        its store, then to all the data.
+
+        Each fallback model is fit to every step-th record of the
+        departments it pools, sliced a department at a time, so only that
+        sample of the pooled data is copied.  The dataset is read twice,
+        first to find each step.
+
+        Args:
+          dataset: a dataset from dept_dataset.open_dataset
+          store_types: dict mapping store_id to store type, or None to skip
+            the models for stores of the same type.
+        """
+        self.store_types = dict(store_types or {})
+
+        sizes = collections.defaultdict(int)
+        for (store_id, dept_id), data in dataset.iteritems():
+            for fallback in self.fallback_groups(store_id, dept_id):
+                sizes[fallback] += len(data)
+
+        steps = dict((fallback, max(1, -(-size // FALLBACK_MAX_RECORDS)))
+                     for fallback, size in sizes.iteritems())
+
+        # Rows of each group seen so far, to continue its stride
+        positions = collections.defaultdict(int)
+        samples = collections.defaultdict(list)
+        for (store_id, dept_id), data in dataset.iteritems():
+            for fallback in self.fallback_groups(store_id, dept_id):
+                step = steps[fallback]
+                start = -positions[fallback] % step
+                samples[fallback].append(data[start::step])
+                positions[fallback] += len(data)
+
+        for fallback, parts in samples.iteritems():
+            scaler, predictor = self.fit(np.vstack(parts))
+
+            self.fallback_scalers[fallback] = scaler
+            self.fallback_predictors[fallback] = predictor
+
+        store_ids = set(store_id for store_id, _ in dataset.keys())
+        store_ids.update(self.store_types)
+        dept_ids = set(dept_id for _, dept_id in dataset.keys())
+
+        self.fallbacks = {}
+        for store_id in store_ids:
+            for dept_id in dept_ids:
+                if (store_id, dept_id) not in self.predictors:
+                    self.fallbacks[(store_id, dept_id)] = self.find_fallback(
+                        store_id, dept_id)
+
+    def fallback_groups(self, store_id, dept_id):
+        """
+        Returns:
+          the keys of the fallback models pooling a department's data.
+        """
+        groups = [("store", store_id), GLOBAL_MODEL]
+        if store_id in self.store_types:
+            groups.insert(0, ("type", self.store_types[store_id], dept_id))
+
+        return groups
+
+    def find_fallback(self, store_id, dept_id):
+        """
+        Returns:
+          The key of the fallback model for a store and department, or
+          None if there are no fallback models.
+        """
+        for fallback in self.fallback_groups(store_id, dept_id):
+            if fallback in self.fallback_predictors:
+                return fallback
+
+        return None
 
     def predict(self, store_id, dept_id, data):
-        ids = []
-        for i in xrange(data.shape[0]):
-            ids.append(self.generate_id(store_id, dept_id, data[i, :]))
+        num_records = data.shape[0]
+        ids = generate_ids(np.repeat(store_id, num_records),
+                           np.repeat(dept_id, num_records),
+                           data[:, 0], data[:, 1], data[:, 2])
+
+        key = (store_id, dept_id)
+        if key in self.predictors:
+            scaler = self.scalers[key]
+            predictor = self.predictors[key]
+        else:
+            fallback = self.fallbacks.get(key)
+            if fallback is None:
+                # Department outside the precomputed table
+                fallback = self.find_fallback(store_id, dept_id)
+
+            if fallback is None:
+                return ids, np.zeros(len(ids))
+
+            scaler = self.fallback_scalers[fallback]
+            predictor = self.fallback_predictors[fallback]
+
+        return ids, predictor.predict(scaler.transform(data))
+
 
-        try:
-            scaled_data = self.scalers[(store_id, dept_id)].transform(data)
-            predictions = self.predictors[(store_id, dept_id)].predict(scaled_data)
-        except KeyError:
-            # TODO: find similar store/dept and use their models
-            predictions = np.zeros((len(ids), 1))
+# Set in each worker process by init_worker
+worker_dataset = None
+worker_model = None
 
-        return ids, predictions
 
+def init_worker(data_path, model):
+    global worker_dataset, worker_model
 
-def train_model(data_dir, model):
-    for filename in os.listdir(data_dir):
-        if not filename.endswith(".num"):
-            continue
+    # Memory-mapped so the workers share one copy of the packed dataset
+    worker_dataset = open_dataset(data_path, mmap=is_binary(data_path))
+    worker_model = model
 
-        store_id, dept_id = map(int, filename.split(".")[0].split("-"))
 
-        full_path = os.path.join(data_dir, filename)
+def fit_department(key):
+    return key, worker_model.fit(worker_dataset[key])
 
-        data = np.loadtxt(full_path, delimiter=",")
-        if data.ndim == 1:
-            data = data.reshape((1, -1))
 
-        model.train(store_id, dept_id, data)
+def train_model(dataset, model, jobs=1):
+    """
+    Args:
+      dataset: a dataset from dept_dataset.open_dataset
+      model: CompositePredictor
+      jobs: int
+        Number of worker processes.  Workers reopen the dataset from its
+        path and only the fitted models are sent back, so the result is the
+        same as training serially.
+    """
+    if jobs <= 1:
+        for (store_id, dept_id), data in dataset.iteritems():
+            model.train(store_id, dept_id, data)
+        return
+
+    pool = multiprocessing.Pool(jobs, init_worker, (dataset.filename, model))
+
+    try:
+        results = pool.imap_unordered(fit_department, dataset.keys(),
+                                      chunksize=16)
+        for (store_id, dept_id), (scaler, predictor) in results:
+            model.add(store_id, dept_id, scaler, predictor)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def update_model(dataset, model):
+    for (store_id, dept_id), data in dataset.iteritems():
+        model.update(store_id, dept_id, data)
+
+
+def read_store_types(dbname):
+    """
+    Returns:
+      dict mapping store_id to store type
+    """
+    con = sqlite3.connect(dbname)
+
+    try:
+        return dict(con.execute("SELECT store_id, type FROM Stores"))
+    finally:
+        con.close()
 
 
 def save_model(model, model_filename):
-    with open(model_filename, "wb") as filehandle:
-        pickle.dump(model, filehandle)
+    """
+    Saves linear models as a .npz archive if the filename has that
+    extension, and pickles the model otherwise.
+    """
+    if is_archive(model_filename):
+        LinearInferenceEngine.from_composite(model).save(model_filename)
+        return
+
+    with atomic_open(model_filename) as filehandle:
+        pickle.dump(model, filehandle, pickle.HIGHEST_PROTOCOL)
 
 
 def get_algorithm(name):
@@ -91,19 +301,75 @@ def get_algorithm(name):
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("data_dir",
-                        help="Directory containing data files.")
+    parser.add_argument("data_path",
+                        help="Packed dataset file or directory containing "
+                             "per-department feature files.")
     parser.add_argument("model_filename",
-                        help="The file to save the trained model to.")
+                        help="The file to save the trained model to.  "
+                             "Linear models are saved as a NumPy archive "
+                             "if it ends in .npz.")
     parser.add_argument("--alg", choices=["sgdr", "svr", "bayes", "elastic"],
                         default="sgdr",
                         help="The algorithm for the model being trained.")
+    parser.add_argument("--jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of worker processes.  Defaults to the "
+                             "number of CPUs.")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed for algorithms that use one, "
+                             "for reproducible models.")
+    parser.add_argument("--dbname",
+                        help="Database to read store types from, for the "
+                             "fallback models of each department in stores "
+                             "of the same type.")
+    parser.add_argument("--update", action="store_true",
+                        help="Update the pickled model in model_filename "
+                             "with the records in data_path, such as a new "
+                             "week of sales, instead of training a new one.  "
+                             "Only the sgdr algorithm supports updates.")
+    parser.add_argument("--archive", metavar="FILENAME",
+                        help="With --update, also save the updated model "
+                             "as a NumPy archive, for predict_server.py and "
+                             "predict_per_dept.py.")
 
     args = parser.parse_args()
 
-    model = CompositePredictor(get_algorithm(args.alg))
+    if args.archive is not None and not args.update:
+        parser.error("--archive is only used with --update")
+
+    if args.archive is not None and not is_archive(args.archive):
+        parser.error("--archive must end in .npz")
+
+    if args.update:
+        if is_archive(args.model_filename):
+            parser.error("Model archives cannot be updated; train a pickled "
+                         "model to update, and save the archive with "
+                         "--archive")
+
+        model = load_model(args.model_filename)
+        if not hasattr(model.per_dept_regressor_class, "partial_fit"):
+            parser.error("%s models cannot be updated" %
+                         model.per_dept_regressor_class.__name__)
+
+        update_model(open_dataset(args.data_path), model)
+        save_model(model, args.model_filename)
+        if args.archive is not None:
+            save_model(model, args.archive)
+        return
+
+    if is_archive(args.model_filename) and args.alg == "svr":
+        parser.error("SVR models are not linear and cannot be saved as "
+                     "a model archive")
+
+    model = CompositePredictor(get_algorithm(args.alg),
+                               random_state=args.seed)
+
+    dataset = open_dataset(args.data_path)
+    store_types = (read_store_types(args.dbname)
+                   if args.dbname is not None else None)
 
-    train_model(args.data_dir, model)
+    train_model(dataset, model, jobs=args.jobs)
+    model.train_fallbacks(dataset, store_types)
     save_model(model, args.model_filename)
 
 
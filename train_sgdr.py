@@ -5,14 +5,19 @@ Trains a Stochastic Gradient Descent Regressor.
 """
 
 import argparse
-import pickle
+import cPickle as pickle
 
-import numpy as np
 from sklearn.linear_model import SGDRegressor
 
+from atomic_file import atomic_open
+from feature_store import is_binary, load_features
 
-def train_model(features_filename, iterations):
-    training_data = np.loadtxt(features_filename, delimiter=",")
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def train_model(features_filename, iterations, mmap=False):
+    training_data = load_features(features_filename, mmap=mmap)
 
     model = SGDRegressor(n_iter=iterations)
     model.fit(training_data[:, :-1], training_data[:, -1])
@@ -20,9 +25,35 @@ def train_model(features_filename, iterations):
     return model
 
 
+def update_model(model, features_filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Continues training a model on new records with partial_fit.  The
+    records must be scaled like those the model was trained on, by
+    extracting them with --scaler and --update-scaler.  Binary feature files
+    are memory-mapped and read chunk_size records at a time.
+    """
+    data = load_features(features_filename,
+                         mmap=is_binary(features_filename))
+
+    if data.shape[1] - 1 != len(model.coef_):
+        raise ValueError("The model has %d features but the records have %d"
+                         % (len(model.coef_), data.shape[1] - 1))
+
+    for start in xrange(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        model.partial_fit(chunk[:, :-1], chunk[:, -1])
+
+    return model
+
+
+def load_model(model_filename):
+    with open(model_filename, "rb") as filehandle:
+        return pickle.load(filehandle)
+
+
 def save_model(model, model_filename):
-    with open(model_filename, "wb") as filehandle:
-        pickle.dump(model, filehandle)
+    with atomic_open(model_filename) as filehandle:
+        pickle.dump(model, filehandle, pickle.HIGHEST_PROTOCOL)
 
 
 def main():
@@ -36,10 +67,29 @@ def main():
     parser.add_argument("-i", dest="iterations", type=int, default=100,
                         help="Number of iterations of gradient descent "
                              "to perform.")
+    parser.add_argument("--mmap", action="store_true",
+                        help="Memory-map the features instead of reading "
+                             "them into memory (binary files only).")
+    parser.add_argument("--update", action="store_true",
+                        help="Update the model in model_filename with the "
+                             "records in features_filename, such as a new "
+                             "week of sales, instead of training a new one.")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Records per partial_fit call with --update.")
 
     args = parser.parse_args()
 
-    model = train_model(args.features_filename, args.iterations)
+    if args.update:
+        try:
+            model = update_model(load_model(args.model_filename),
+                                 args.features_filename,
+                                 chunk_size=args.chunk_size)
+        except ValueError as error:
+            parser.error(str(error))
+    else:
+        model = train_model(args.features_filename, args.iterations,
+                            mmap=args.mmap)
+
     save_model(model, args.model_filename)
 
 